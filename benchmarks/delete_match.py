@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Compare ORM cascade deletes with set-based deletes of a match
+
+Usage: delete_match.py [REPEAT]
+
+Inserts a fully populated 30 round match (10 players, with player rounds,
+frags and attacks for every round) into the configured database, then times
+deleting it through the ORM cascades and with CsgoMatch._delete_matches().
+Each method is run REPEAT times (default: 5). This writes to and deletes
+from the database, so point GOONPUG_CONFIG at a scratch database.
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from goonpug import create_app, db
+from goonpug.models import CsgoMatch, Round, Player, PlayerRound, Frag, \
+    match_players, Server, Attack
+
+
+ROUNDS = 30
+PLAYERS = 10
+ATTACKS_PER_ROUND = 40
+START_TIME = datetime.datetime(2000, 1, 1)
+
+
+def insert_match(server_id, player_ids):
+    result = db.session.execute(CsgoMatch.__table__.insert().values(
+        type=CsgoMatch.TYPE_PUG, server_id=server_id, map=u'de_dust2',
+        start_time=START_TIME, end_time=START_TIME))
+    match_id = result.inserted_primary_key[0]
+    player_rounds = []
+    frags = []
+    attacks = []
+    for period in range(1, ROUNDS + 1):
+        result = db.session.execute(Round.__table__.insert().values(
+            match_id=match_id, period=period, winning_team=period % 2))
+        round_id = result.inserted_primary_key[0]
+        for (i, player_id) in enumerate(player_ids):
+            player_rounds.append(dict(
+                player_id=player_id, round_id=round_id, team=i % 2,
+                assists=0, dead=True, damage=100, bomb_planted=False,
+                bomb_defused=False, won_1v=0, rws=10.0, dropped=False))
+            frags.append(dict(
+                round_id=round_id, fragger=player_id,
+                victim=player_ids[(i + 1) % len(player_ids)],
+                weapon=u'ak47', headshot=bool(i % 2), tk=False))
+        for i in range(ATTACKS_PER_ROUND):
+            attacks.append(dict(
+                round_id=round_id, attacker=player_ids[i % len(player_ids)],
+                target=player_ids[(i + 1) % len(player_ids)],
+                weapon=u'ak47', damage=27, damage_armor=5,
+                hitgroup=u'chest', ff=False))
+    db.session.execute(PlayerRound.__table__.insert(), player_rounds)
+    db.session.execute(Frag.__table__.insert(), frags)
+    db.session.execute(Attack.__table__.insert(), attacks)
+    db.session.execute(match_players.insert(), [
+        dict(match_id=match_id, player_id=player_id, team=i % 2)
+        for (i, player_id) in enumerate(player_ids)])
+    db.session.commit()
+    return match_id
+
+
+def orm_delete(match_id):
+    db.session.delete(CsgoMatch.query.get(match_id))
+    db.session.commit()
+
+
+def set_delete(match_id):
+    CsgoMatch._delete_matches([match_id])
+    db.session.commit()
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    create_app(web=False)
+    db.create_all()
+    server = Server.get_or_create(u'192.0.2.1', 27015)
+    players = [Player.get_or_create(76561197960265728 + i)
+               for i in range(PLAYERS)]
+    db.session.commit()
+    player_ids = [player.id for player in players]
+    print '%d rounds, %d player rounds, %d frags, %d attacks per match' % (
+        ROUNDS, ROUNDS * PLAYERS, ROUNDS * PLAYERS,
+        ROUNDS * ATTACKS_PER_ROUND)
+    for (name, delete) in (('ORM cascade', orm_delete),
+                           ('set-based', set_delete)):
+        elapsed = []
+        for _ in range(repeat):
+            match_id = insert_match(server.id, player_ids)
+            db.session.expire_all()
+            start = time.time()
+            delete(match_id)
+            elapsed.append(time.time() - start)
+            left = db.session.query(Round).filter_by(
+                match_id=match_id).count()
+            if left:
+                print '%s: %d rounds left behind' % (name, left)
+                sys.exit(1)
+        print '%s: best %.1fms, mean %.1fms' % (
+            name, min(elapsed) * 1000, sum(elapsed) / len(elapsed) * 1000)
+
+
+if __name__ == '__main__':
+    main()
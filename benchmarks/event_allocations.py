@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Compare memory allocated by srcds events and goonpugd's tuple events
+
+Usage: event_allocations.py LOGFILE
+
+Every attack, kill, assist and switch team line in LOGFILE is parsed into
+an event with both the srcds event classes and the lightweight events used
+by goonpugd, and the events are kept alive so their memory can be counted.
+Memory is measured with tracemalloc when it is available; otherwise the
+number of new gc tracked objects and the shallow size of each event is
+reported.
+"""
+
+from __future__ import absolute_import, division
+import os
+import re
+import sys
+import gc
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import srcds.events.csgo as csgo_events
+import goonpugd
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+SRCDS_EVENTS = [
+    csgo_events.CsgoAttackEvent,
+    csgo_events.CsgoKillEvent,
+    csgo_events.CsgoAssistEvent,
+    csgo_events.SwitchTeamEvent,
+]
+TUPLE_EVENTS = [
+    goonpugd.AttackEvent,
+    goonpugd.KillEvent,
+    goonpugd.AssistEvent,
+    goonpugd.SwitchTeamEvent,
+]
+
+
+def event_size(event):
+    """Return the shallow size of an event and the objects it owns"""
+    size = sys.getsizeof(event)
+    # namedtuples have a __dict__ property, but no instance dict
+    if not isinstance(event, tuple):
+        size += sys.getsizeof(event.__dict__)
+        for value in event.__dict__.values():
+            if hasattr(value, '__dict__'):
+                size += sys.getsizeof(value) + sys.getsizeof(value.__dict__)
+                for member in value.__dict__.values():
+                    if hasattr(member, '__dict__'):
+                        size += sys.getsizeof(member) + \
+                            sys.getsizeof(member.__dict__)
+    return size
+
+
+def parse(lines, classes):
+    regexes = [(re.compile(cls.regex), cls) for cls in classes]
+    events = []
+    for line in lines:
+        for (regex, cls) in regexes:
+            match = regex.match(line)
+            if match:
+                events.append(cls.from_re_match(match))
+                break
+    return events
+
+
+def measure(name, lines, classes):
+    gc.collect()
+    objects = len(gc.get_objects())
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    events = parse(lines, classes)
+    elapsed = time.time() - start
+    if tracemalloc:
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    gc.collect()
+    objects = len(gc.get_objects()) - objects
+    print '%s: %d events in %.3fs' % (name, len(events), elapsed)
+    if tracemalloc:
+        print '  %.1f KiB retained, %.1f KiB peak, %.1f bytes/event' % (
+            current / 1024, peak / 1024, current / max(len(events), 1))
+    else:
+        size = sum(event_size(event) for event in events)
+        print '  %d gc tracked objects, %.1f KiB, %.1f bytes/event' % (
+            objects, size / 1024, size / max(len(events), 1))
+    return events
+
+
+def main():
+    if len(sys.argv) != 2:
+        print __doc__
+        sys.exit(1)
+    with open(sys.argv[1]) as fd:
+        lines = [line.strip() for line in fd]
+    measure('srcds events', lines, SRCDS_EVENTS)
+    measure('goonpugd events', lines, TUPLE_EVENTS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Generate synthetic srcds logs of GoonPUG matches
+
+Usage: generate_log.py [SEED] [MATCHES] > LOGFILE
+
+Writes MATCHES (default: 1) random matches to stdout. The same SEED
+(default: 1) always gives the same log. Besides attacks and kills, the
+matches have team kills, suicides, bomb plants and defuses, players who
+drop and come back, late joiners and spectators, so that every path
+through goonpugd's match handling is exercised.
+"""
+
+from __future__ import absolute_import, division
+import sys
+import random
+import datetime
+
+
+SIDES = ('TERRORIST', 'CT')
+WEAPONS = ('ak47', 'm4a1', 'awp', 'glock', 'hkp2000', 'p250', 'deagle',
+           'knife')
+HITGROUPS = ('head', 'chest', 'stomach', 'left arm', 'right leg')
+MAPS = ('de_dust2', 'de_inferno', 'de_nuke', 'workshop/125438255/de_cbble')
+START_TIME = datetime.datetime(2013, 10, 1, 20, 0, 0)
+
+
+def ordered(players):
+    # sets of players iterate in memory order, which differs between runs
+    return sorted(players, key=lambda player: player.uid)
+
+
+def other(side):
+    return SIDES[1 - SIDES.index(side)]
+
+
+class LogWriter(object):
+
+    """Format log lines with an advancing timestamp"""
+
+    def __init__(self, start):
+        self.time = start
+        self.lines = []
+
+    def tick(self, seconds=1):
+        self.time += datetime.timedelta(seconds=seconds)
+
+    def emit(self, msg):
+        self.lines.append('L %s: %s' % (
+            self.time.strftime('%m/%d/%Y - %H:%M:%S'), msg))
+
+
+class MatchPlayer(object):
+
+    def __init__(self, number):
+        self.name = 'Player%d' % number
+        self.uid = number + 2
+        self.steam_id = 'STEAM_1:%d:%d' % (number % 2, 1000 + number)
+        self.side = None
+
+    def tag(self, side=None):
+        return '"%s<%d><%s><%s>"' % (self.name, self.uid, self.steam_id,
+                                     self.side if side is None else side)
+
+    def short_tag(self):
+        return '"%s<%d><%s>"' % (self.name, self.uid, self.steam_id)
+
+
+def generate_match(rnd, log, players, mapname):
+    """Write one match to a LogWriter
+
+    Parameters:
+        rnd: A random.Random
+        log: A LogWriter
+        players: A list of MatchPlayers to start the match with
+        mapname: The map to play on
+    """
+    emit = log.emit
+    emit('Log file started (file "logs/L000.log") (game "/csgo") '
+         '(version "5555")')
+    emit('Loading map "%s"' % mapname)
+    emit('Started map "%s" (CRC "-1")' % mapname)
+    log.tick(5)
+
+    def switch(player, side):
+        emit('%s switched from team <%s> to <%s>' % (
+            player.short_tag(), player.side or 'Unassigned',
+            side or 'Unassigned'))
+        player.side = side
+
+    for (i, player) in enumerate(players):
+        emit('%s entered the game' % player.tag(''))
+        player.side = None
+        switch(player, SIDES[i % 2])
+    emit('GoonPUG triggered "Start_Warmup"')
+    emit('World triggered "Restart_Round_(1_second)"')
+    log.tick(30)
+    emit('GoonPUG triggered "Start_Match"')
+
+    score = dict.fromkeys(SIDES, 0)
+    dropped = []
+    spectators = []
+    late = len(players) + 100
+    rounds = rnd.randint(16, 30)
+    for number in range(rounds):
+        if number == 15:
+            # halftime
+            for player in players:
+                if player.side in SIDES and player not in dropped:
+                    switch(player, other(player.side))
+            for player in dropped:
+                player.side = other(player.side)
+            score = dict((side, score[other(side)]) for side in SIDES)
+        log.tick(2)
+        emit('World triggered "Round_Start"')
+        for player in list(dropped):
+            if rnd.random() < 0.6:
+                dropped.remove(player)
+                side = player.side
+                player.side = None
+                switch(player, side)
+        if rnd.random() < 0.1:
+            # someone new joins mid match
+            player = MatchPlayer(late)
+            late += 1
+            emit('%s entered the game' % player.tag(''))
+            switch(player, rnd.choice(SIDES))
+            players.append(player)
+        if spectators and rnd.random() < 0.5:
+            player = spectators.pop()
+            switch(player, rnd.choice(SIDES))
+        health = dict((player, 100) for player in players)
+        alive = set(player for player in players
+                    if player.side in SIDES and player not in dropped)
+        bomb_planted = False
+        for _ in range(rnd.randint(5, 40)):
+            log.tick()
+            sides = set(player.side for player in alive)
+            if len(sides) < 2:
+                break
+            roll = rnd.random()
+            if roll < 0.02:
+                victim = rnd.choice(ordered(alive))
+                emit('%s committed suicide with "world"' % victim.tag())
+                alive.discard(victim)
+                continue
+            if roll < 0.04:
+                player = rnd.choice(ordered(alive))
+                alive.discard(player)
+                if rnd.random() < 0.5:
+                    dropped.append(player)
+                    side = player.side
+                    switch(player, None)
+                    player.side = side
+                else:
+                    switch(player, 'Spectator')
+                    spectators.append(player)
+                continue
+            if roll < 0.05 and not bomb_planted:
+                planters = [player for player in ordered(alive)
+                            if player.side == 'TERRORIST']
+                if planters:
+                    emit('%s triggered "Planted_The_Bomb"' %
+                         rnd.choice(planters).tag())
+                    bomb_planted = True
+                continue
+            attacker = rnd.choice(ordered(alive))
+            if rnd.random() < 0.05:
+                targets = [player for player in ordered(alive)
+                           if player.side == attacker.side
+                           and player is not attacker]
+            else:
+                targets = [player for player in ordered(alive)
+                           if player.side != attacker.side]
+            if not targets:
+                continue
+            target = rnd.choice(targets)
+            weapon = rnd.choice(WEAPONS)
+            damage = rnd.randint(5, 110)
+            hitgroup = rnd.choice(HITGROUPS)
+            health[target] = max(0, health[target] - damage)
+            emit('%s [1 2 3] attacked %s [4 -5 6] with "%s" (damage "%d") '
+                 '(damage_armor "%d") (health "%d") (armor "50") '
+                 '(hitgroup "%s")' % (attacker.tag(), target.tag(), weapon,
+                                      damage, rnd.randint(0, 5),
+                                      health[target], hitgroup))
+            if health[target] == 0:
+                emit('%s [1 2 3] killed %s [4 -5 6] with "%s"%s' % (
+                    attacker.tag(), target.tag(), weapon,
+                    ' (headshot)' if hitgroup == 'head' else ''))
+                helpers = [player for player in ordered(alive)
+                           if player.side == attacker.side
+                           and player is not attacker]
+                if helpers and rnd.random() < 0.3:
+                    emit('%s assisted killing %s' % (
+                        rnd.choice(helpers).tag(), target.tag()))
+                alive.discard(target)
+        sides = set(player.side for player in alive)
+        if len(sides) == 1:
+            winner = sides.pop()
+        else:
+            winner = rnd.choice(SIDES)
+        score[winner] += 1
+        notice = 'SFUI_Notice_%s' % ('Terrorists_Win' if winner == 'TERRORIST'
+                                     else 'CTs_Win')
+        if bomb_planted:
+            if winner == 'TERRORIST':
+                notice = 'SFUI_Notice_Target_Bombed'
+            else:
+                defusers = [player for player in ordered(alive)
+                            if player.side == 'CT']
+                if defusers:
+                    emit('%s triggered "Defused_The_Bomb"' %
+                         rnd.choice(defusers).tag())
+                    notice = 'SFUI_Notice_Bomb_Defused'
+        elif winner == 'CT' and rnd.random() < 0.1:
+            notice = 'SFUI_Notice_Target_Saved'
+        emit('Team "%s" triggered "%s" (CT "%d") (T "%d")' % (
+            winner, notice, score['CT'], score['TERRORIST']))
+        for side in ('CT', 'TERRORIST'):
+            emit('Team "%s" scored "%d" with "5" players' % (side,
+                                                             score[side]))
+        emit('World triggered "Round_End"')
+    emit('GoonPUG triggered "End_Match"')
+    log.tick(60)
+    emit('Log file closed')
+
+
+def generate(seed=1, matches=1, start=START_TIME):
+    """Return the lines of a log with matches random matches"""
+    rnd = random.Random(seed)
+    log = LogWriter(start)
+    for number in range(matches):
+        players = [MatchPlayer(i) for i in range(rnd.randint(6, 10))]
+        generate_match(rnd, log, players, MAPS[number % len(MAPS)])
+        log.tick(3600)
+    return log.lines
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    matches = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    for line in generate(seed, matches):
+        print line
+
+
+if __name__ == '__main__':
+    main()
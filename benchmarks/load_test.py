@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Load test a running GoonPUG web frontend
+
+Usage: load_test.py [-c CONCURRENCY] [-n REQUESTS] URL [PATH...]
+
+Requests PATHs (default: the stats pages) round-robin from CONCURRENCY
+threads until REQUESTS requests have been made, then reports requests per
+second and latency percentiles overall and for each path. Start the server
+with serve.py first, e.g. load_test.py -c 16 http://127.0.0.1:5000
+"""
+
+from __future__ import absolute_import, division
+import sys
+import time
+import urllib2
+import argparse
+import threading
+from itertools import count
+
+
+PATHS = [
+    '/stats/',
+    '/stats/player/',
+    '/stats/map/',
+    '/stats/weapon/',
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the GoonPUG web frontend')
+    parser.add_argument('url', help='base URL of the server')
+    parser.add_argument('paths', nargs='*', default=PATHS,
+                        help='paths to request')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='total number of requests')
+    args = parser.parse_args()
+    base = args.url.rstrip('/')
+
+    counter = count()
+    latencies = dict((path, []) for path in args.paths)
+    errors = []
+
+    def client():
+        while True:
+            i = next(counter)
+            if i >= args.requests:
+                return
+            path = args.paths[i % len(args.paths)]
+            start = time.time()
+            try:
+                response = urllib2.urlopen(base + path, timeout=60)
+                response.read()
+                response.close()
+            except Exception as e:
+                errors.append((path, e))
+                continue
+            latencies[path].append(time.time() - start)
+
+    threads = [threading.Thread(target=client)
+               for _ in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    done = [latency for path in args.paths for latency in latencies[path]]
+    print '%d requests in %.2fs, %d errors, %d concurrent clients' % (
+        len(done), elapsed, len(errors), args.concurrency)
+    print '%.1f requests/s' % (len(done) / elapsed)
+    print '%-24s %8s %8s %8s' % ('', 'p50 ms', 'p99 ms', 'max ms')
+    for (name, values) in [('all', done)] + [(path, latencies[path])
+                                             for path in args.paths]:
+        print '%-24s %8.1f %8.1f %8.1f' % (
+            name, percentile(values, 50) * 1000,
+            percentile(values, 99) * 1000, max(values or [0]) * 1000)
+    for (path, e) in errors[:5]:
+        print >>sys.stderr, '%s: %s' % (path, e)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Measure log parsing throughput with parallel parse workers
+
+Usage: parse_jobs.py [-c CHUNK_SIZE] LOGFILE [JOBS...]
+
+Times the stateless parsing stage (regex matching and event construction)
+over LOGFILE in a single process and with pools of JOBS worker processes
+(default: 2, 4 and the number of CPUs) handed chunks of CHUNK_SIZE bytes
+(default: goonpugd.PARSE_CHUNK_SIZE), and checks that every run yields
+the same events in the same order. The stateful match handling and the
+database are not involved.
+
+Besides the wall clock time, the CPU time used by the main process (which
+hands out chunks and unpickles the events) and by the workers is shown.
+The main process's share can't be spread over workers, so the speedup on
+a machine with at least JOBS idle CPUs is at most the single process time
+divided by the larger of the main process time and the workers' time over
+JOBS. This bound can be measured on any machine, even one with a single
+CPU, where the wall clock times themselves can't show a speedup.
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import goonpugd
+from goonpug.logreader import read_blocks
+
+
+def key(event):
+    if isinstance(event, tuple):
+        return tuple(event)
+    return (type(event).__name__, unicode(event))
+
+
+def cpu_times():
+    """Return the CPU time used by this process and its reaped children"""
+    times = os.times()
+    return (times[0] + times[1], times[2] + times[3])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure log parsing throughput with parse workers')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=goonpugd.PARSE_CHUNK_SIZE,
+                        help='bytes of log lines per worker task')
+    parser.add_argument('log', help='log file to parse')
+    parser.add_argument('jobs', type=int, nargs='*',
+                        help='worker pool sizes to time')
+    args = parser.parse_args()
+    blocks = list(read_blocks(args.log, use_mmap=False))
+    lines = sum(block.count('\n') for block in blocks)
+    jobs = args.jobs or sorted(set([2, 4, multiprocessing.cpu_count()]))
+    print '%d lines, %d CPUs, %d byte chunks' % (
+        lines, multiprocessing.cpu_count(), args.chunk_size)
+
+    start = time.time()
+    events = [event for block in blocks
+              for event in goonpugd.parse_chunk(block)]
+    baseline = time.time() - start
+    expected = [key(event) for event in events]
+    print ' 1 process: %.2fs (%.0f lines/s)' % (baseline,
+                                                lines / baseline)
+    for n in jobs:
+        (main_start, workers_start) = cpu_times()
+        start = time.time()
+        events = list(goonpugd.parse_parallel(blocks, n, args.chunk_size))
+        elapsed = time.time() - start
+        (main_end, workers_end) = cpu_times()
+        if [key(event) for event in events] != expected:
+            print '%2d jobs: events differ from the single process run' % n
+            sys.exit(1)
+        main_cpu = main_end - main_start
+        workers_cpu = workers_end - workers_start
+        print '%2d jobs: %.2fs (%.0f lines/s, %.2fx), CPU: main %.2fs, ' \
+            'workers %.2fs, at most %.2fx with %d idle CPUs' % (
+                n, elapsed, lines / elapsed, baseline / elapsed, main_cpu,
+                workers_cpu, baseline / max(main_cpu, workers_cpu / n), n)
+
+
+if __name__ == '__main__':
+    main()
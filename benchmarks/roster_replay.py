@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""Check goonpugd's roster bookkeeping against a scan of every player
+
+Usage: roster_replay.py [-s SEEDS] [-m MATCHES] [LOGFILE...]
+
+Replays each LOGFILE, or if none are given the logs generate_log.py
+writes for seeds 1 to SEEDS (default: 100) with MATCHES matches each
+(default: 2), through two parsers which handle the same events:
+
+    GoonPugParser counts the alive players on each side with the sets kept
+    by PlayerRoster, and looks up match teams in GoonPugPlayer.match_team.
+
+    BaselineParser has _check_1v, _sfui_notice, _commit_round and
+    handle_switch_team as they were before PlayerRoster kept track of
+    sides: they scan the whole roster and look players up in the team_a
+    and team_b steam id sets.
+
+After every event both parsers must agree on every player's team, alive,
+dropped, won_1v, rws and match team, and on the rounds buffered so far,
+and PlayerRoster's side and live sets must match a scan of its players.
+This covers the 1vN, drop, suicide and winning side RWS paths.
+
+Finished matches are kept in memory and never stored, but the parsers
+look up server and player rows, so point GOONPUG_CONFIG at a scratch
+database.
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import goonpugd
+from goonpug import create_app, db
+from goonpug.logreader import read_blocks
+from goonpug.models import CsgoMatch
+from generate_log import generate
+
+
+SERVER_ADDRESS = (u'192.0.2.1', 27015)
+
+
+class ReplayParser(goonpugd.GoonPugParser):
+
+    """GoonPugParser which keeps finished matches in memory"""
+
+    def __init__(self):
+        super(ReplayParser, self).__init__(SERVER_ADDRESS)
+        self.matches = []
+
+    def _end_match(self, event):
+        if self.round:
+            self._commit_round()
+        self.matches.append((self.match_rounds, set(self.team_a),
+                             set(self.team_b)))
+        self._reset_match()
+
+    def match_team(self, player):
+        if not self.match:
+            return None
+        return player.match_team
+
+
+class BaselineParser(ReplayParser):
+
+    """ReplayParser with the roster scans PlayerRoster replaced
+
+    PlayerRoster.kill() and reset_round() set the same player attributes
+    as the loops they replaced, so only the methods which read the roster
+    differ from GoonPugParser.
+    """
+
+    def match_team(self, player):
+        if not self.match:
+            return None
+        if player.id64 in self.team_a:
+            return CsgoMatch.TEAM_A
+        elif player.id64 in self.team_b:
+            return CsgoMatch.TEAM_B
+        return None
+
+    def _commit_round(self):
+        player_rounds = []
+        for player in self.players:
+            steam_id = player.id64
+            if steam_id in self.team_a or steam_id in self.team_b:
+                if steam_id in self.team_a:
+                    team = CsgoMatch.TEAM_A
+                else:
+                    team = CsgoMatch.TEAM_B
+                player_rounds.append(dict(
+                    player_id=self._player_id(player),
+                    dead=not player.alive,
+                    assists=player.assists,
+                    damage=player.damage,
+                    bomb_planted=player.bomb_planted,
+                    bomb_defused=player.bomb_defused,
+                    won_1v=player.won_1v,
+                    dropped=player.dropped,
+                    rws=player.rws,
+                    team=team,
+                ))
+        round_row = dict(period=self.round.period,
+                         winning_team=self.round.winning_team)
+        self.match_rounds.append((round_row, player_rounds, self.round_frags,
+                                  self.round_attacks))
+        self.round = None
+        self.round_frags = []
+        self.round_attacks = []
+
+    def _sfui_notice(self, winning_team, defused=False, exploded=False):
+        if winning_team == u'TERRORIST':
+            if self.period % 2 == 1:
+                self.round.winning_team = CsgoMatch.TEAM_A
+            else:
+                self.round.winning_team = CsgoMatch.TEAM_B
+        elif winning_team == u'CT':
+            if self.period % 2 == 1:
+                self.round.winning_team = CsgoMatch.TEAM_B
+            else:
+                self.round.winning_team = CsgoMatch.TEAM_A
+        else:
+            raise ValueError(u'Unknown team: %s' % winning_team)
+        team_damage = 0
+        for player in self.players:
+            if player.dropped:
+                player.won_1v = 0
+                player.rws = 0.0
+            if not player.dropped and \
+                    ((self.round.winning_team == CsgoMatch.TEAM_A
+                      and player.id64 in self.team_a)
+                        or (self.round.winning_team == CsgoMatch.TEAM_B
+                            and player.id64 in self.team_b)):
+                team_damage += player.damage
+            else:
+                player.won_1v = 0
+                player.rws = 0.0
+        if defused or exploded:
+            multi = 70.0
+        else:
+            multi = 100.0
+        for player in self.players:
+            if player.team == winning_team:
+                try:
+                    player.rws = multi * (player.damage / team_damage)
+                except ZeroDivisionError:
+                    player.rws = 0.0
+                if defused and player.bomb_defused:
+                    player.rws += 30.0
+                if exploded and player.bomb_planted:
+                    player.rws += 30.0
+
+    def _check_1v(self):
+        if not self.round:
+            return
+        live_ts = []
+        live_cts = []
+        for player in self.players:
+            if player.team == u'TERRORIST' and player.alive and \
+               not player.dropped:
+                live_ts.append(player)
+            elif player.team == u'CT' and player.alive and not player.dropped:
+                live_cts.append(player)
+        if len(live_ts) == 1 and live_ts[0].won_1v == 0:
+            live_ts[0].won_1v = len(live_cts)
+        elif len(live_cts) == 1 and live_cts[0].won_1v == 0:
+            live_cts[0].won_1v = len(live_ts)
+
+    def handle_switch_team(self, event):
+        steam_id = event.id64
+        if steam_id in self.players:
+            player = self.players[steam_id]
+        else:
+            player = self.players.add(event.player_name, event.uid, steam_id)
+        player.team = event.new_team
+        player.dropped = False
+        if self.round:
+            player.reset_round()
+        if self.match:
+            if event.new_team == u'Unassigned' \
+                    and event.orig_team in [u'CT', u'TERRORIST']:
+                player.dropped = True
+                player.alive = False
+                self._check_1v()
+            elif steam_id not in self.team_a and steam_id not in self.team_b:
+                if (self.period % 2) == 1:
+                    if event.new_team == u'TERRORIST':
+                        self.team_a.add(steam_id)
+                        self.team_b.discard(steam_id)
+                    elif event.new_team == u'CT':
+                        self.team_b.add(steam_id)
+                        self.team_a.discard(steam_id)
+                else:
+                    if event.new_team == u'TERRORIST':
+                        self.team_b.add(steam_id)
+                        self.team_a.discard(steam_id)
+                    elif event.new_team == u'CT':
+                        self.team_a.add(steam_id)
+                        self.team_b.discard(steam_id)
+        else:
+            if event.new_team == u'Unassigned':
+                self.players.remove(steam_id)
+
+
+def player_state(parser):
+    return sorted((player.id64, player.team, player.alive, player.dropped,
+                   player.won_1v, player.rws, parser.match_team(player))
+                  for player in parser.players)
+
+
+def roster_errors(roster):
+    """Return the sides whose PlayerRoster sets don't match a scan"""
+    errors = []
+    for side in roster.SIDES:
+        players = set(player for player in roster if player.team == side)
+        alive = set(player for player in players
+                    if player.alive and not player.dropped)
+        if roster.sides[side] != players:
+            errors.append('%s players' % side)
+        if roster.live[side] != alive:
+            errors.append('%s alive players' % side)
+    return errors
+
+
+def replay(name, blocks, counts):
+    """Replay a log through both parsers, returning False on a mismatch"""
+    parser = ReplayParser()
+    baseline = BaselineParser()
+    for block in blocks:
+        for event in goonpugd.parse_block(parser.event_types, block):
+            parser.event_handlers[type(event)](event)
+            baseline.event_handlers[type(event)](event)
+            counts['events'] += 1
+            errors = roster_errors(parser.players)
+            if player_state(parser) != player_state(baseline):
+                errors.append('player state %r != %r' % (
+                    player_state(parser), player_state(baseline)))
+            if parser.match_rounds != baseline.match_rounds:
+                errors.append('buffered rounds')
+            if parser.matches != baseline.matches:
+                errors.append('finished matches')
+            if errors:
+                print '%s: after %s' % (name, unicode(event))
+                for error in errors:
+                    print '    %s' % error
+                return False
+    for (match_rounds, _, _) in parser.matches:
+        counts['matches'] += 1
+        for (round_row, player_rounds, frags, _) in match_rounds:
+            counts['rounds'] += 1
+            for row in player_rounds:
+                counts['1vN wins'] += row['won_1v'] > 0
+                counts['drops'] += row['dropped']
+            for frag in frags:
+                counts['suicides'] += frag['fragger'] == frag['victim']
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the roster bookkeeping against player scans')
+    parser.add_argument('-s', '--seeds', type=int, default=100,
+                        help='generated logs to replay')
+    parser.add_argument('-m', '--matches', type=int, default=2,
+                        help='matches per generated log')
+    parser.add_argument('logs', nargs='*', help='log files to replay')
+    args = parser.parse_args()
+    create_app(web=False)
+    db.create_all()
+    counts = dict.fromkeys(['events', 'matches', 'rounds', '1vN wins',
+                            'drops', 'suicides'], 0)
+    if args.logs:
+        logs = [(filename, read_blocks(filename, use_mmap=False))
+                for filename in args.logs]
+    else:
+        logs = [('seed %d' % seed,
+                 ['\n'.join(generate(seed, args.matches)) + '\n'])
+                for seed in range(1, args.seeds + 1)]
+    for (name, blocks) in logs:
+        if not replay(name, blocks, counts):
+            sys.exit(1)
+    print 'Replayed %d logs: %s' % (len(logs), ', '.join(
+        '%d %s' % (counts[key], key) for key in ('events', 'matches',
+                                                 'rounds', '1vN wins',
+                                                 'drops', 'suicides')))
+    print 'PlayerRoster matches the baseline scans'
+
+
+if __name__ == '__main__':
+    main()
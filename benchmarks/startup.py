@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Measure how long goonpugd, the web app and the scripts take to start
+
+Usage: startup.py [REPEAT]
+
+Each case is run REPEAT times (default: 5) in a fresh interpreter, and the
+best and mean wall clock times are reported along with the number of
+modules each one loads. Nothing is read from or written to the database,
+but the configured database URI must be valid.
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import time
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ('goonpugd', 'import goonpugd\n'
+                 'from goonpug import create_app\n'
+                 'create_app(web=False)'),
+    ('web app', 'from goonpug import create_app\n'
+                'create_app()'),
+    ('initialize_db.py', 'from goonpug import create_app\n'
+                         'from goonpug.models import Player\n'
+                         'create_app(web=False)'),
+]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    for (name, code) in CASES:
+        code += '\nimport sys\nprint len(sys.modules)'
+        elapsed = []
+        for _ in range(repeat):
+            start = time.time()
+            modules = subprocess.check_output([sys.executable, '-c', code],
+                                              env=env)
+            elapsed.append(time.time() - start)
+        print '%-16s best %.3fs, mean %.3fs, %s modules' % (
+            name, min(elapsed), sum(elapsed) / len(elapsed),
+            modules.strip())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""Check the Steam profile refresher against a local stub Steam Web API
+
+Usage: steam_stub.py
+
+Starts a stub GetPlayerSummaries server on a free local port, points
+STEAM_API_URL at it and checks that the refresher:
+
+    looks up queued steam ids in batches of at most 100,
+    caches the ids Steam doesn't return as having no profile, and doesn't
+    look them up again until that expires,
+    refreshes profiles in the background once STEAM_PROFILE_TTL has
+    passed, still returning the expired profile meanwhile,
+    evicts the least recently used profiles beyond STEAM_PROFILE_CACHE_SIZE,
+    and backs off after failed lookups instead of retrying at once.
+
+Neither the database nor the real Steam Web API is used.
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import json
+import time
+import threading
+import urlparse
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import Flask
+from goonpug.steam import SteamProfiles, BATCH_SIZE
+
+
+FIRST_ID = 76561197960265728
+
+
+class StubSteam(BaseHTTPServer.HTTPServer):
+
+    """Stub GetPlayerSummaries endpoint
+
+    Every steam id has a profile except those for which unknown() is true.
+    While failing is set every request gets a 500 response.
+    """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.batches = []
+        self.failures = []
+        self.failing = False
+        self.names = {}
+
+    def unknown(self, steam_id):
+        return steam_id % 7 == 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_port
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stub = self.server
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        if stub.failing:
+            stub.failures.append(time.time())
+            self.send_error(500)
+            return
+        steam_ids = [int(steam_id)
+                     for steam_id in query['steamids'][0].split(',')]
+        stub.batches.append(steam_ids)
+        players = [{'steamid': str(steam_id),
+                    'personaname': stub.names.get(steam_id,
+                                                  u'player %d' % steam_id)}
+                   for steam_id in steam_ids if not stub.unknown(steam_id)]
+        body = json.dumps({'response': {'players': players}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def refresher(stub, **config):
+    app = Flask(__name__)
+    app.config.update(STEAM_API_KEY='stub', STEAM_API_URL=stub.url,
+                      STEAM_RETRY_DELAY=0.5, STEAM_RETRY_MAX_DELAY=1)
+    app.config.update(config)
+    return SteamProfiles(app)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def check(failures, description, ok):
+    print '%s: %s' % ('ok' if ok else 'FAILED', description)
+    if not ok:
+        failures.append(description)
+
+
+def check_batches(stub, failures):
+    profiles = refresher(stub, STEAM_PROFILE_CACHE_SIZE=1000)
+    steam_ids = range(FIRST_ID, FIRST_ID + 250)
+    del stub.batches[:]
+    for steam_id in steam_ids:
+        profiles.profile(steam_id)
+    wait_for(lambda: sum(len(batch) for batch in stub.batches) >= 250)
+    check(failures, '250 ids are looked up in batches of at most %d'
+          % BATCH_SIZE,
+          sorted(sum(stub.batches, [])) == steam_ids
+          and max(len(batch) for batch in stub.batches) <= BATCH_SIZE)
+    wait_for(lambda: len(profiles.cache) == 250)
+    found = [steam_id for steam_id in steam_ids
+             if profiles.profile(steam_id) is not None]
+    check(failures, 'profiles are cached for the ids Steam returned',
+          found == [steam_id for steam_id in steam_ids
+                    if not stub.unknown(steam_id)])
+    lookups = len(stub.batches)
+    for _ in range(10):
+        for steam_id in steam_ids:
+            profiles.profile(steam_id)
+    time.sleep(0.2)
+    check(failures, 'ids Steam does not know are not looked up again',
+          len(stub.batches) == lookups)
+
+
+def check_ttl(stub, failures):
+    profiles = refresher(stub, STEAM_PROFILE_TTL=0.5)
+    steam_id = FIRST_ID + 1
+    stub.names[steam_id] = u'old name'
+    profiles.profile(steam_id)
+    wait_for(lambda: profiles.profile(steam_id) is not None)
+    stub.names[steam_id] = u'new name'
+    lookups = len(stub.batches)
+    profiles.profile(steam_id)
+    time.sleep(0.2)
+    check(failures, 'fresh profiles are not looked up again',
+          len(stub.batches) == lookups)
+    time.sleep(0.5)
+    check(failures, 'an expired profile is returned until it is refreshed',
+          profiles.profile(steam_id)['personaname'] == u'old name')
+    check(failures, 'an expired profile is refreshed in the background',
+          wait_for(lambda: profiles.profile(steam_id)['personaname']
+                   == u'new name'))
+
+
+def check_eviction(stub, failures):
+    profiles = refresher(stub, STEAM_PROFILE_CACHE_SIZE=100)
+    steam_ids = [steam_id for steam_id in range(FIRST_ID, FIRST_ID + 200)
+                 if not stub.unknown(steam_id)][:150]
+    profiles.fetch(steam_ids[:100])
+    # looking a profile up makes it the most recently used
+    profiles.profile(steam_ids[0])
+    profiles.fetch(steam_ids[100:])
+    cached = [steam_id for steam_id in steam_ids
+              if profiles.cache.get(steam_id)[1]]
+    check(failures, 'the cache holds at most STEAM_PROFILE_CACHE_SIZE ids',
+          len(profiles.cache) == 100)
+    check(failures, 'the least recently used ids are evicted first',
+          cached == [steam_ids[0]] + steam_ids[51:])
+
+
+def check_back_off(stub, failures):
+    profiles = refresher(stub)
+    steam_id = FIRST_ID + 2
+    stub.failing = True
+    del stub.failures[:]
+    profiles.profile(steam_id)
+    wait_for(lambda: stub.failures)
+    # requests keep asking for the profile while the refresher backs off
+    deadline = time.time() + 2.5
+    while time.time() < deadline:
+        profiles.profile(steam_id)
+        time.sleep(0.01)
+    gaps = [b - a for (a, b) in zip(stub.failures, stub.failures[1:])]
+    check(failures, 'failed lookups are retried after 0.5s, then 1s',
+          len(stub.failures) in (3, 4) and gaps[0] >= 0.45
+          and all(gap >= 0.95 for gap in gaps[1:]))
+    stub.failing = False
+    check(failures, 'lookups succeed again once Steam is back',
+          wait_for(lambda: profiles.profile(steam_id) is not None))
+
+
+def main():
+    stub = StubSteam()
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    failures = []
+    check_batches(stub, failures)
+    check_ttl(stub, failures)
+    check_eviction(stub, failures)
+    check_back_off(stub, failures)
+    stub.shutdown()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
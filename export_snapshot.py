@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Export completed matches to a columnar snapshot for offline analysis"""
+
+from __future__ import absolute_import
+import sys
+import argparse
+
+from goonpug import create_app, snapshot
+from goonpug.arraystats import ArrayStats, verify
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export GoonPUG round level stats to a columnar snapshot')
+    parser.add_argument('path', help='snapshot directory')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=100, help='number of matches per chunk')
+    parser.add_argument('--compact', action='store_true',
+                        help='merge all chunks into one after exporting')
+    parser.add_argument('--verify', action='store_true',
+                        help='check stats computed from the snapshot against '
+                             'the database')
+    args = parser.parse_args()
+    create_app(web=False)
+
+    def progress(done, total):
+        sys.stdout.write('\r%d/%d matches' % (done, total))
+        sys.stdout.flush()
+
+    count = snapshot.export(args.path, chunk_size=args.chunk_size,
+                            progress=progress)
+    if count:
+        print
+    print 'Exported %d new matches to %s' % (count, args.path)
+    if args.compact:
+        snapshot.compact(args.path)
+        print 'Compacted %s' % args.path
+    if args.verify:
+        mismatches = verify(ArrayStats(snapshot.Snapshot(args.path)))
+        for (player_id, column, expected, got) in mismatches:
+            print 'player %s %s: database %s, snapshot %s' % (
+                player_id, column, expected, got)
+        if mismatches:
+            sys.exit(1)
+        print 'Snapshot stats match the database'
+
+
+if __name__ == '__main__':
+    main()
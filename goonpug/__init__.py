@@ -14,43 +14,67 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+"""GoonPUG
+
+Importing goonpug only sets up the database extension and models. The web
+frontend (views, the API and the login, OpenID and restless extensions)
+is only imported by create_app(), so goonpugd and the scripts, which call
+create_app(web=False), never load it.
+"""
 
 from __future__ import absolute_import
 import os
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
-from flask.ext.login import LoginManager
-from flask.ext.openid import OpenID
-from flask.ext.restless import APIManager
-from openid.fetchers import setDefaultFetcher, Urllib2Fetcher
-
-
-app = Flask(__name__)
-
-app.config.from_object('goonpug.default_config')
-if 'GOONPUG_CONFIG' in os.environ:
-    app.config.from_envvar('GOONPUG_CONFIG')
-elif os.path.isfile(os.path.join(os.getcwd(), 'config.py')):
-    app.config.from_pyfile(os.path.join(os.getcwd(), 'config.py'))
-
-app.config['SQLALCHEMY_DATABASE_URI'] = \
-    'mysql://%s:%s@%s:%d/%s?charset=utf8' % (
-    app.config['MYSQL_USER'], app.config['MYSQL_PASSWORD'],
-    app.config['MYSQL_SERVER'], app.config['MYSQL_PORT'],
-    app.config['MYSQL_DATABASE'],)
-app.config['SQLALCHEMY_POOL_RECYCLE'] = 7200
-
-# DB stuff
-db = SQLAlchemy(app)
-metadata = db.MetaData()
-metadata.bind = db.engine
-
-# Login stuff
-login_manager = LoginManager()
-login_manager.setup_app(app)
-setDefaultFetcher(Urllib2Fetcher())
-oid = OpenID(app)
-
-manager = APIManager(app, flask_sqlalchemy_db=db)
-
-from . import models, views, api
+
+from .routing import RoutingSQLAlchemy, replica
+from .pool import init_pool
+
+
+db = RoutingSQLAlchemy()
+
+
+def load_config(app):
+    """Load the default config and then the site config into app.config"""
+    app.config.from_object('goonpug.default_config')
+    if 'GOONPUG_CONFIG' in os.environ:
+        app.config.from_envvar('GOONPUG_CONFIG')
+    elif os.path.isfile(os.path.join(os.getcwd(), 'config.py')):
+        app.config.from_pyfile(os.path.join(os.getcwd(), 'config.py'))
+
+    if not app.config.get('SQLALCHEMY_DATABASE_URI'):
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'mysql://%s:%s@%s:%d/%s?charset=utf8' % (
+            app.config['MYSQL_USER'], app.config['MYSQL_PASSWORD'],
+            app.config['MYSQL_SERVER'], app.config['MYSQL_PORT'],
+            app.config['MYSQL_DATABASE'],)
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # sqlite databases don't use a sized connection pool
+        app.config['SQLALCHEMY_POOL_SIZE'] = None
+        app.config['SQLALCHEMY_MAX_OVERFLOW'] = None
+
+
+def create_app(web=True):
+    """Create and configure the GoonPUG application
+
+    The database is bound to the new application, so the models can be
+    used outside of an application context once this has been called.
+
+    Parameters:
+        web: If False, only the database is set up and the web frontend is
+            not imported.
+    """
+    app = Flask(__name__)
+    load_config(app)
+
+    db.init_app(app)
+    db.app = app
+    replica.init_app(app)
+    init_pool(db.engine, pre_ping=app.config['SQLALCHEMY_POOL_PRE_PING'])
+
+    from . import models
+    if web:
+        from .views import init_views
+        from .api import init_api
+        init_views(app)
+        init_api(app)
+    return app
@@ -16,10 +16,27 @@
 # along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import
+import json
+import time
+import threading
+from flask import Blueprint, current_app, request, abort
+from flask.ext.restless import APIManager
 from srcds.objects import SteamId
 
-from .models import Player
-from . import manager
+from .models import Player, PlayerOverallStatsSummary
+from . import db, generation, live
+
+
+# the most auth ids accepted by a single /api/player_stats request
+MAX_AUTH_IDS = 64
+# how often (in seconds) waiting /api/live requests check for new snapshots
+LIVE_POLL_INTERVAL = 0.5
+# idle event streams get a comment this often (in seconds) so that proxies
+# don't close them
+LIVE_KEEPALIVE = 10
+# clients turned away because too many requests are waiting are told to
+# retry after this many seconds
+LIVE_RETRY_AFTER = 5
 
 
 def player_pre_many(search_params=None, **kw):
@@ -33,7 +50,180 @@ def player_pre_many(search_params=None, **kw):
         search_params['filters'].append(filt)
 
 
-manager.create_api(Player, methods=['GET'],
-                   include_columns=['nickname', 'steam_id'],
-                   include_methods=['average_rws', 'auth_id'],
-                   preprocessors={'GET_MANY': [player_pre_many]})
+api = Blueprint('api', __name__)
+
+
+def init_api(app):
+    """Register the restless and bulk stats APIs on app"""
+    manager = APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Player, methods=['GET'],
+                       include_columns=['nickname', 'steam_id'],
+                       include_methods=['average_rws', 'auth_id'],
+                       preprocessors={'GET_MANY': [player_pre_many]})
+    app.register_blueprint(api)
+
+
+@generation.cached
+def _player_stats(steam_ids):
+    """Return the summaries for a tuple of steam id64s
+
+    Returns a dict of steam id64 to a dict of the player's id, nickname and
+    summary columns. Players with no summary yet have None for every
+    summary column.
+    """
+    summary_columns = [column for column
+                       in PlayerOverallStatsSummary.__table__.columns
+                       if column.name not in ('player_id', 'nickname')]
+    query = db.session.query(
+        Player.steam_id, Player.id, Player.nickname, *summary_columns
+    ).outerjoin(
+        PlayerOverallStatsSummary,
+        PlayerOverallStatsSummary.player_id == Player.id
+    ).filter(Player.steam_id.in_(steam_ids))
+    names = ['player_id', 'nickname'] + [column.name for column
+                                         in summary_columns]
+    return dict((row[0], dict(zip(names, row[1:]))) for row in query)
+
+
+@api.route('/api/player_stats')
+@generation.conditional
+def player_stats():
+    """Return the stats summaries for a list of players
+
+    Players are given as auth_id query parameters, either repeated or comma
+    separated, e.g. ?auth_id=STEAM_0:1:123,STEAM_0:0:456. The response maps
+    each requested auth id which belongs to a known player to their
+    summary.
+    """
+    auth_ids = [auth_id.strip() for value in request.args.getlist('auth_id')
+                for auth_id in value.split(',') if auth_id.strip()]
+    if len(auth_ids) > MAX_AUTH_IDS:
+        abort(400)
+    try:
+        steam_ids = dict((SteamId(auth_id).id64(), auth_id)
+                         for auth_id in auth_ids)
+    except ValueError:
+        abort(400)
+    stats = {}
+    if steam_ids:
+        summaries = _player_stats(tuple(sorted(steam_ids)))
+        for (steam_id, auth_id) in steam_ids.items():
+            if steam_id in summaries:
+                stats[auth_id] = summaries[steam_id]
+    body = json.dumps({'players': stats}, separators=(',', ':'))
+    return current_app.response_class(body, mimetype='application/json')
+
+
+_waiters = {'count': 0}
+_waiters_lock = threading.Lock()
+
+
+def _start_waiting():
+    """Claim one of this process's LIVE_MAX_WAITERS waiting slots
+
+    Returns False if they are all taken. Waiting requests hold on to their
+    worker thread, so the cap keeps spectators from starving the stats
+    pages.
+    """
+    with _waiters_lock:
+        if _waiters['count'] >= current_app.config['LIVE_MAX_WAITERS']:
+            return False
+        _waiters['count'] += 1
+        return True
+
+
+def _stop_waiting():
+    with _waiters_lock:
+        _waiters['count'] -= 1
+
+
+def _too_busy():
+    response = current_app.response_class(status=503)
+    response.headers['Retry-After'] = str(LIVE_RETRY_AFTER)
+    return response
+
+
+def _live_etag():
+    return '%s-%d' % (live.version(), len(live.matches()))
+
+
+def _live_body():
+    return json.dumps({'matches': live.matches()}, separators=(',', ':'))
+
+
+@api.route('/api/live')
+def live_matches():
+    """Return the state of every match in progress
+
+    Snapshots are read from LIVE_STATE_DIR, which goonpugd keeps up to
+    date, so this never queries the database. Polling clients should send
+    the ETag back in If-None-Match: unchanged snapshots get a 304, and with
+    ?wait=N the request is held open for up to N seconds (at most
+    LIVE_MAX_WAIT) until something changes (a long-poll). Long-polls get a
+    503 while LIVE_MAX_WAITERS requests are already waiting.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)),
+                   current_app.config['LIVE_MAX_WAIT'])
+    except ValueError:
+        abort(400)
+    etag = _live_etag()
+    if request.if_none_match.contains(etag) and wait > 0:
+        if not _start_waiting():
+            return _too_busy()
+        try:
+            deadline = time.time() + wait
+            while time.time() < deadline:
+                time.sleep(LIVE_POLL_INTERVAL)
+                if _live_etag() != etag:
+                    break
+        finally:
+            _stop_waiting()
+        etag = _live_etag()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(_live_body(),
+                                              mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@api.route('/api/live/stream')
+def live_stream():
+    """Stream the state of every match in progress as server-sent events
+
+    An event with every snapshot is sent straight away and then whenever
+    they change. The stream ends after LIVE_MAX_WAIT seconds, and
+    EventSource clients reconnect on their own. Like long-polls, streams
+    are limited to LIVE_MAX_WAITERS at a time.
+    """
+    max_wait = current_app.config['LIVE_MAX_WAIT']
+    if not _start_waiting():
+        return _too_busy()
+
+    def events():
+        deadline = time.time() + max_wait
+        etag = None
+        idle_since = time.time()
+        yield 'retry: %d\n\n' % (LIVE_POLL_INTERVAL * 1000)
+        while time.time() < deadline:
+            token = _live_etag()
+            if token != etag:
+                etag = token
+                yield 'id: %s\ndata: %s\n\n' % (etag, _live_body())
+                idle_since = time.time()
+            elif time.time() - idle_since >= LIVE_KEEPALIVE:
+                yield ':\n\n'
+                idle_since = time.time()
+            time.sleep(LIVE_POLL_INTERVAL)
+
+    response = current_app.response_class(events(),
+                                          mimetype='text/event-stream')
+    # also called if the stream is closed before it has started
+    response.call_on_close(_stop_waiting)
+    response.cache_control.no_cache = True
+    # stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,400 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory stats engine over a columnar snapshot
+
+Computes the same per-player metrics as Player.total_stats() with grouped
+numpy reductions instead of SQL, for every player (and every player/map
+pair) in one pass over the snapshot's arrays.
+
+Stats are returned as frames: dicts mapping a column name to an array with
+one entry per row. Ratios are NaN where the SQL expression would be NULL.
+"""
+
+from __future__ import absolute_import, division
+import calendar
+import datetime
+import numpy as np
+
+
+# summed columns, in the order of Player.total_stats()
+TOTAL_COLUMNS = (
+    'frags', 'tks', 'assists', 'deaths', 'bomb_planted', 'bomb_defused',
+    'rounds_won', 'rounds_lost', 'rounds_dropped', 'rounds_played',
+    'won_1v1', 'won_1v2', 'won_1v3', 'won_1v4', 'won_1v5',
+    'k1', 'k2', 'k3', 'k4', 'k5',
+)
+RATIO_COLUMNS = ('kdr', 'hsp', 'adr', 'fpr', 'rws')
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = numerator / denominator.astype('f8')
+    result[denominator == 0] = np.nan
+    return result
+
+
+def _pair_key(player_id, match_id):
+    return (player_id.astype('i8') << 32) | match_id.astype('i8')
+
+
+class ArrayStats(object):
+
+    """Stats engine for a loaded Snapshot"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.match = snapshot.table('match')
+        self.player_round = snapshot.table('player_round')
+        self.frag = snapshot.table('frag')
+        self.attack = snapshot.table('attack')
+        self.maps = snapshot.dictionary('map')
+        self.weapons = snapshot.dictionary('weapon')
+        # every player id that appears anywhere in the snapshot
+        self.player_ids = np.unique(np.concatenate([
+            self.player_round['player_id'], self.frag['fragger'],
+            self.frag['victim'], self.attack['attacker'],
+            self.attack['target'],
+        ]).astype('i8'))
+        self._index = {}
+        try:
+            self.head = snapshot.dictionary('hitgroup').index(u'head')
+        except ValueError:
+            self.head = -2
+        # per-match lookup tables
+        if len(self.match['id']):
+            size = self.match['id'].max() + 1
+        else:
+            size = 1
+        self.match_map = np.full(size, -1, dtype='i4')
+        self.match_map[self.match['id']] = self.match['map']
+        self.match_end = np.full(size, -1, dtype='i8')
+        self.match_end[self.match['id']] = self.match['end_time']
+
+    def index(self, table, column):
+        """Return each row's position in self.player_ids"""
+        key = (table, column)
+        if key not in self._index:
+            values = getattr(self, table)[column]
+            self._index[key] = np.searchsorted(self.player_ids, values)
+        return self._index[key]
+
+    def _aggregate(self, pr_group, frag_group, attack_group, groups):
+        """Sum the total_stats() columns into the specified groups
+
+        Each *_group argument gives the group of every row of that table,
+        or -1 to leave the row out.
+        """
+        pr = self.player_round
+        frag = self.frag
+        attack = self.attack
+        stats = {}
+
+        def count(group, mask=None, weights=None):
+            if mask is not None:
+                group = group[mask]
+                if weights is not None:
+                    weights = weights[mask]
+            keep = group >= 0
+            if weights is not None:
+                weights = weights[keep]
+            return np.bincount(group[keep], weights=weights,
+                               minlength=groups)[:groups]
+
+        decided = (pr['winning_team'] >= 0) & (pr['team'] >= 0) & \
+            ~pr['dropped']
+        stats['assists'] = count(pr_group, weights=pr['assists'])
+        stats['deaths'] = count(pr_group, pr['dead'])
+        stats['damage'] = count(pr_group, weights=pr['damage'])
+        stats['bomb_planted'] = count(pr_group, pr['bomb_planted'])
+        stats['bomb_defused'] = count(pr_group, pr['bomb_defused'])
+        stats['total_rws'] = count(pr_group, weights=pr['rws'])
+        stats['rounds_won'] = count(
+            pr_group, decided & (pr['team'] == pr['winning_team']))
+        stats['rounds_lost'] = count(
+            pr_group, decided & (pr['team'] != pr['winning_team']))
+        stats['rounds_dropped'] = count(pr_group, pr['dropped'])
+        for n in range(1, 6):
+            stats['won_1v%d' % n] = count(pr_group, pr['won_1v'] == n)
+        stats['has_rounds'] = count(pr_group) > 0
+
+        kills = ~frag['tk']
+        stats['frags'] = count(frag_group, kills)
+        stats['tks'] = count(frag_group,
+                             frag['tk'] & (frag['fragger'] != frag['victim']))
+        # multi kill rounds, from the kill count of every (group, round)
+        keep = kills & (frag_group >= 0)
+        if keep.any():
+            round_key = (frag_group[keep].astype('i8') << 32) | \
+                frag['round_id'][keep].astype('i8')
+            (round_key, round_kills) = np.unique(round_key,
+                                                 return_counts=True)
+            round_group = round_key >> 32
+        else:
+            round_group = np.zeros(0, dtype='i8')
+            round_kills = np.zeros(0, dtype='i8')
+        for n in range(1, 6):
+            stats['k%d' % n] = count(round_group, round_kills == n)
+
+        hits = ~attack['ff']
+        stats['hits'] = count(attack_group, hits)
+        stats['headshots'] = count(attack_group,
+                                   hits & (attack['hitgroup'] == self.head))
+
+        for column in stats:
+            if column not in ('total_rws', 'has_rounds'):
+                stats[column] = stats[column].astype('i8')
+        played = stats['rounds_won'] + stats['rounds_lost']
+        stats['rounds_played'] = played
+        stats['kdr'] = _ratio(stats['frags'], stats['deaths'])
+        stats['hsp'] = _ratio(stats['headshots'], stats['hits'])
+        stats['adr'] = _ratio(stats['damage'], played)
+        stats['fpr'] = _ratio(stats['frags'], played)
+        stats['rws'] = _ratio(stats['total_rws'],
+                              played + stats['rounds_dropped'])
+        return stats
+
+    def _frag_groups(self, pr_group):
+        """Return frag and attack groups matching the player_round groups
+
+        Like the SQL outer joins, frags and hits only count in matches the
+        player has player_round rows for.
+        """
+        pr = self.player_round
+        pairs = _pair_key(pr['player_id'], pr['match_id'])
+        frag_in = np.in1d(_pair_key(self.frag['fragger'],
+                                    self.frag['match_id']), pairs)
+        attack_in = np.in1d(_pair_key(self.attack['attacker'],
+                                      self.attack['match_id']), pairs)
+        return (frag_in, attack_in)
+
+    def player_stats(self):
+        """Return overall stats for every player with recorded rounds"""
+        n = len(self.player_ids)
+        pr_group = self.index('player_round', 'player_id')
+        (frag_in, attack_in) = self._frag_groups(pr_group)
+        frag_group = np.where(frag_in, self.index('frag', 'fragger'), -1)
+        attack_group = np.where(attack_in,
+                                self.index('attack', 'attacker'), -1)
+        stats = self._aggregate(pr_group, frag_group, attack_group, n)
+        stats['player_id'] = self.player_ids
+        return _select(stats, stats['has_rounds'])
+
+    def map_stats(self):
+        """Return a dict of player stats frames keyed by map name"""
+        n = len(self.player_ids)
+        groups = n * max(len(self.maps), 1)
+
+        def map_group(table, column):
+            maps = self.match_map[getattr(self, table)['match_id']]
+            return np.where(maps >= 0,
+                            maps.astype('i8') * n + self.index(table, column),
+                            -1)
+
+        pr_group = map_group('player_round', 'player_id')
+        (frag_in, attack_in) = self._frag_groups(pr_group)
+        frag_group = np.where(frag_in, map_group('frag', 'fragger'), -1)
+        attack_group = np.where(attack_in,
+                                map_group('attack', 'attacker'), -1)
+        stats = self._aggregate(pr_group, frag_group, attack_group, groups)
+        result = {}
+        for (code, mapname) in enumerate(self.maps):
+            rows = slice(code * n, (code + 1) * n)
+            frame = dict((column, values[rows])
+                         for (column, values) in stats.items())
+            frame['player_id'] = self.player_ids
+            result[mapname] = _select(frame, frame['has_rounds'])
+        return result
+
+    def weapon_stats(self):
+        """Return a dict of weapon stats frames keyed by weapon name
+
+        Each frame has the frags, hsp and deaths of every player that used
+        or died to the weapon, as in Player.weapon_kill_stats() and
+        Player.weapon_death_stats().
+        """
+        n = len(self.player_ids)
+        groups = n * max(len(self.weapons), 1)
+        frag = self.frag
+        attack = self.attack
+
+        def weapon_group(table, column):
+            # NULL weapons are stored as -1 and left out
+            weapons = getattr(self, table)['weapon']
+            return np.where(weapons >= 0,
+                            weapons.astype('i8') * n +
+                            self.index(table, column), -1)
+
+        def count(group, mask=None):
+            if mask is not None:
+                group = group[mask]
+            return np.bincount(group[group >= 0], minlength=groups)[:groups]
+
+        kills = ~frag['tk']
+        fragger = weapon_group('frag', 'fragger')
+        victim = weapon_group('frag', 'victim')
+        attacker = weapon_group('attack', 'attacker')
+        hits = ~attack['ff']
+        frags = count(fragger, kills)
+        deaths = count(victim, kills)
+        used = count(fragger) + count(victim)
+        hit_count = count(attacker, hits)
+        headshots = count(attacker, hits & (attack['hitgroup'] == self.head))
+        hsp = _ratio(headshots, hit_count)
+        result = {}
+        for (code, weapon) in enumerate(self.weapons):
+            rows = slice(code * n, (code + 1) * n)
+            frame = {
+                'player_id': self.player_ids,
+                'frags': frags[rows],
+                'deaths': deaths[rows],
+                'hsp': hsp[rows],
+            }
+            result[weapon] = _select(frame, used[rows] > 0)
+        return result
+
+    def recent_rws(self, day_range=30, now=None):
+        """Return each player's RWS over the previous day_range days
+
+        This is the RWS stored in PlayerOverallStatsSummary.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        start = calendar.timegm(now.timetuple()) - day_range * 86400
+        pr = self.player_round
+        recent = self.match_end[pr['match_id']] >= start
+        group = self.index('player_round', 'player_id')[recent]
+        n = len(self.player_ids)
+        total = np.bincount(group, weights=pr['rws'][recent], minlength=n)
+        rounds = np.bincount(group, minlength=n)
+        rws = _ratio(total, rounds)
+        rws[rounds == 0] = 0.0
+        return {'player_id': self.player_ids, 'rws': rws}
+
+
+def _select(frame, mask):
+    return dict((column, values[mask]) for (column, values) in frame.items())
+
+
+def leaderboard(frame, column, min_rounds=0, limit=None, ascending=False):
+    """Return the rows of a stats frame sorted by the specified column
+
+    Rows are returned as dicts. NaN values always sort last.
+    """
+    mask = np.ones(len(frame['player_id']), dtype=bool)
+    if min_rounds and 'rounds_played' in frame:
+        mask &= frame['rounds_played'] >= min_rounds
+    rows = np.flatnonzero(mask)
+    values = frame[column][rows].astype('f8')
+    if not ascending:
+        values = -values
+    # nan sorts after every number in argsort
+    rows = rows[np.argsort(values, kind='mergesort')]
+    if limit is not None:
+        rows = rows[:limit]
+    return [dict((key, frame[key][i]) for key in frame) for i in rows]
+
+
+def _ratio_matches(expected, got, tolerance):
+    if expected is None:
+        return bool(np.isnan(got))
+    if np.isnan(got):
+        return False
+    if isinstance(expected, (int, long)):
+        # the database did integer division (sqlite)
+        return expected == int(got)
+    return abs(float(expected) - float(got)) <= tolerance
+
+
+def _compare(mismatches, prefix, frame, rows, columns, ratios, tolerance,
+             ratio_tolerance, required=None):
+    """Compare a stats frame with a dict of SQL rows keyed by player id
+
+    Array rows where required is False may be missing from the SQL rows.
+    """
+    if required is None:
+        required = np.ones(len(frame['player_id']), dtype=bool)
+    array_rows = dict((int(player_id), i)
+                      for (i, player_id) in enumerate(frame['player_id']))
+    for player_id in sorted(set(rows) | set(array_rows)):
+        expected = rows.get(player_id)
+        i = array_rows.get(player_id)
+        if expected is None or i is None:
+            if i is None or required[i]:
+                mismatches.append((player_id, prefix + 'player',
+                                   expected is not None, i is not None))
+            continue
+        for column in columns:
+            got = frame[column][i]
+            value = expected[column] or 0
+            if abs(float(value) - float(got)) > tolerance:
+                mismatches.append((player_id, prefix + column, value, got))
+        for column in ratios:
+            got = frame[column][i]
+            if not _ratio_matches(expected[column], got, ratio_tolerance):
+                mismatches.append((player_id, prefix + column,
+                                   expected[column], got))
+
+
+def verify(stats, tolerance=1e-6, ratio_tolerance=1e-4):
+    """Compare ArrayStats results with the SQL stats
+
+    player_stats() is compared with the Player.match_stats() rows summed
+    over the matches in the snapshot and with the Player.total_stats()
+    ratios, map_stats() with Player.map_stats() and weapon_stats() with
+    Player.weapon_kill_stats(). Returns a list of (player_id, column, sql,
+    array) tuples for every value that differs, with map and weapon
+    columns prefixed by the map or weapon name.
+
+    Ratios the database computed with integer division are compared with
+    the truncated array values, others to within ratio_tolerance (MySQL
+    division rounds to 4 extra decimal places).
+    """
+    from .models import Player
+    match_ids = sorted(set(int(match_id) for match_id in stats.match['id']))
+    mismatches = []
+
+    sums = {}
+    summed = ('frags', 'tks', 'assists', 'deaths', 'damage', 'bomb_planted',
+              'bomb_defused', 'total_rws', 'rounds_won', 'rounds_lost',
+              'rounds_dropped', 'won_1v1', 'won_1v2', 'won_1v3', 'won_1v4',
+              'won_1v5', 'k1', 'k2', 'k3', 'k4', 'k5', 'hits', 'headshots')
+    for row in Player.match_stats(match_ids=match_ids):
+        totals = sums.setdefault(row.player_id, dict.fromkeys(summed, 0))
+        for column in summed:
+            totals[column] += getattr(row, column) or 0
+    for row in Player.total_stats(match_ids=match_ids).group_by('player_id'):
+        if row.player_id in sums:
+            sums[row.player_id].update((column, getattr(row, column))
+                                       for column in RATIO_COLUMNS)
+    _compare(mismatches, '', stats.player_stats(), sums, summed,
+             RATIO_COLUMNS, tolerance, ratio_tolerance)
+
+    for (mapname, frame) in sorted(stats.map_stats().items()):
+        rows = dict((row.player_id, row._asdict()) for row
+                    in Player.map_stats(mapname, match_ids))
+        _compare(mismatches, '%s ' % mapname, frame, rows, TOTAL_COLUMNS,
+                 RATIO_COLUMNS, tolerance, ratio_tolerance)
+
+    for (weapon, frame) in sorted(stats.weapon_stats().items()):
+        rows = dict((row.player_id, row._asdict()) for row
+                    in Player.weapon_kill_stats(weapon, match_ids))
+        # players who only died to the weapon have no SQL row
+        _compare(mismatches, '%s ' % weapon, frame, rows, ('frags',),
+                 ('hsp',), tolerance, ratio_tolerance,
+                 required=frame['frags'] > 0)
+    return mismatches
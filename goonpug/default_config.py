@@ -8,7 +8,71 @@ MYSQL_USER = 'goonpug_user'
 MYSQL_PASSWORD = 'password1'
 MYSQL_DATABASE = 'goonpug'
 
+# Set this to use a database other than the MySQL database above, e.g.
+# 'sqlite:////var/goonpug/goonpug.db'
+SQLALCHEMY_DATABASE_URI = None
+
+# Optional read replica (or read-only sqlite snapshot) for the web frontend.
+# Reads fall back to the primary database if the replica lags behind it by
+# more than READ_REPLICA_MAX_LAG seconds.
+SQLALCHEMY_READ_DATABASE_URI = None
+READ_REPLICA_MAX_LAG = 300
+READ_REPLICA_CHECK_INTERVAL = 30
+
+# Connection pool settings. Each goonpugd worker process gets its own pool.
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_RECYCLE = 7200
+# Test pooled connections with a lightweight query before handing them out
+SQLALCHEMY_POOL_PRE_PING = True
+
+# goonpugd writes a new token to this file whenever it stores new stats.
+# The web frontend caches anything it reads from the database until the
+# token changes, so this must be the same file for goonpugd and the web
+# frontend.
+GENERATION_FILE = '/tmp/goonpug.generation'
+# Directory (ideally on tmpfs) for sharing cached pages and leaderboards
+# between web worker processes. If None every process keeps its own cache.
+CACHE_DIR = None
+
+# How long shared caches (e.g. a reverse proxy) may serve stats pages to
+# anonymous users without revalidating them
+HTTP_CACHE_MAX_AGE = 60
+
+# goonpugd publishes the state of matches in progress to files in this
+# directory (ideally on tmpfs, e.g. /dev/shm/goonpug-live), which the web
+# frontend serves from /api/live. Set to None to disable. Snapshots which
+# haven't been updated for LIVE_STATE_TTL seconds are ignored.
+LIVE_STATE_DIR = '/tmp/goonpug-live'
+LIVE_STATE_TTL = 600
+# The longest (in seconds) a /api/live long-poll or event stream request is
+# held open. Keep this below gunicorn's 30 second worker timeout.
+LIVE_MAX_WAIT = 25
+# The most long-poll and event stream requests each web process holds open
+# at once, further ones get a 503. Each one ties up a worker thread, so they
+# need threaded (gthread) or async (gevent) workers: serve.py sets this to 0
+# for single threaded workers, and to at most SERVER_THREADS - 1.
+LIVE_MAX_WAITERS = 2
+
+# serve.py settings. SERVER_WORKERS defaults to 2 * CPUs + 1.
+SERVER_BIND = '127.0.0.1:5000'
+SERVER_WORKERS = None
+SERVER_THREADS = 4
+
 STEAM_API_KEY = None
+# Steam Web API GetPlayerSummaries endpoint (point this at a stub server for
+# testing) and the request timeout in seconds
+STEAM_API_URL = 'http://api.steampowered.com/ISteamUser/' \
+                'GetPlayerSummaries/v0002/'
+STEAM_API_TIMEOUT = 5
+# Cached Steam profiles are refreshed in the background after
+# STEAM_PROFILE_TTL seconds
+STEAM_PROFILE_TTL = 3600
+STEAM_PROFILE_CACHE_SIZE = 10000
+# After a failed lookup the refresher waits STEAM_RETRY_DELAY seconds,
+# doubling after each further failure up to STEAM_RETRY_MAX_DELAY
+STEAM_RETRY_DELAY = 30
+STEAM_RETRY_MAX_DELAY = 900
 
 SECRET_KEY = '\xd8\xbf\xa0\xf4jn\xb7\x17\x99\xe9\x9dD' \
              '\xc0\x04T\x87\xd1V\x05\x93o\xc0H\x81'
@@ -0,0 +1,211 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Data generation stamp
+
+goonpugd bumps the generation whenever it has stored a match or refreshed
+player summaries, by writing a new token to the GENERATION_FILE stamp file.
+Web processes read the token (once per request) instead of asking the
+database whether anything has changed, and anything computed from the
+database can be cached until the token changes.
+
+Cached values live in each process's memory. If CACHE_DIR is set they are
+also pickled to files under CACHE_DIR/<generation>/, so that every worker
+process of a pre-forking server (and every server sharing the directory)
+only computes each value once per generation.
+
+Views decorated with conditional() get an ETag and Last-Modified header
+derived from the generation, and conditional GETs with a current ETag are
+answered with a 304 before the view (and any of its queries) runs.
+"""
+
+from __future__ import absolute_import
+import os
+import time
+import shutil
+import hashlib
+import datetime
+import cPickle as pickle
+from functools import wraps
+from flask import g, session, request, current_app, make_response, \
+    has_request_context
+
+from . import db
+
+
+def _config():
+    # db is bound to the application by create_app(), which works outside
+    # of an application context too
+    return db.get_app().config
+
+
+def _read():
+    try:
+        with open(_config()['GENERATION_FILE']) as fd:
+            return fd.read().strip() or '0'
+    except IOError:
+        return '0'
+
+
+def current():
+    """Return the current generation token
+
+    The token is only read once per request.
+    """
+    if not has_request_context():
+        return _read()
+    token = getattr(g, 'generation', None)
+    if token is None:
+        token = g.generation = _read()
+    return token
+
+
+def modified():
+    """Return when the current generation started, or None"""
+    try:
+        mtime = os.stat(_config()['GENERATION_FILE']).st_mtime
+    except OSError:
+        return None
+    return datetime.datetime.utcfromtimestamp(int(mtime))
+
+
+def bump():
+    """Start a new generation"""
+    filename = _config()['GENERATION_FILE']
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    # tokens only need to differ, several processes may bump at once
+    with open(tmp, 'w') as fd:
+        fd.write('%x-%x\n' % (int(time.time() * 1000000), os.getpid()))
+    os.rename(tmp, filename)
+
+
+_expired = {'generation': None}
+
+
+def _expire_shared(cache_dir, token):
+    """Remove the shared cache files of every other generation"""
+    if _expired['generation'] == token:
+        return
+    _expired['generation'] = token
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        if name != token:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def _load_shared(filename):
+    """Return (True, value) for a shared cache file, or (False, None)"""
+    try:
+        with open(filename, 'rb') as fd:
+            return (True, pickle.load(fd))
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return (False, None)
+
+
+def _store_shared(filename, value):
+    dirname = os.path.dirname(filename)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+        with open(tmp, 'wb') as fd:
+            pickle.dump(value, fd, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+    except (OSError, IOError, pickle.PicklingError):
+        # another process may have expired this generation meanwhile
+        pass
+
+
+def cached(f):
+    """Decorator which caches a function's results for the current generation
+
+    Results are cached keyed on the (hashable) positional arguments, whose
+    repr() must identify them, and are all dropped when the generation
+    changes. Results must be picklable if CACHE_DIR is set.
+    """
+    state = {'generation': None, 'values': {}}
+    name = '%s.%s' % (f.__module__, f.__name__)
+
+    @wraps(f)
+    def decorated(*args):
+        token = current()
+        if state['generation'] != token:
+            state['values'] = {}
+            state['generation'] = token
+        values = state['values']
+        try:
+            return values[args]
+        except KeyError:
+            pass
+        cache_dir = _config()['CACHE_DIR']
+        if not cache_dir:
+            value = values[args] = f(*args)
+            return value
+        _expire_shared(cache_dir, token)
+        filename = os.path.join(cache_dir, token, hashlib.sha1(
+            repr((name, args))).hexdigest())
+        (found, value) = _load_shared(filename)
+        if not found:
+            value = f(*args)
+            _store_shared(filename, value)
+        values[args] = value
+        return value
+    decorated.uncached = f
+    return decorated
+
+
+def conditional(f):
+    """Decorator for views which only depend on the data and logged in user
+
+    Responses get an ETag made from the generation token and the logged in
+    user's id, a Last-Modified time from the generation stamp and
+    Vary: Cookie. Requests whose If-None-Match is still current are
+    answered with a 304 without calling the view. If-Modified-Since is
+    ignored: Last-Modified only has a resolution of a second, and the
+    generation may be bumped more than once in a second.
+    Anonymous responses may be cached by shared caches for
+    HTTP_CACHE_MAX_AGE seconds; pages for logged in users are private and
+    must be revalidated.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if session.get('_flashes'):
+            # the page will include a one off message
+            return f(*args, **kwargs)
+        user_id = session.get('user_id')
+        etag = '%s-%s' % (current(), user_id if user_id else 'anon')
+        last_modified = modified()
+        if request.if_none_match and request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        response.vary.add('Cookie')
+        if user_id:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = \
+                current_app.config['HTTP_CACHE_MAX_AGE']
+        return response
+    return decorated
@@ -0,0 +1,130 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Live match state
+
+goonpugd's parsers publish a JSON snapshot of each match in progress to
+a file per server in LIVE_STATE_DIR (ideally on tmpfs), replacing it
+atomically as rounds are played and removing it once the match has been
+stored or abandoned. The web frontend serves the snapshots straight from
+the directory, so following a match never touches the database.
+
+The directory's mtime changes whenever a snapshot is written or removed,
+which is all the web side needs to check to know whether anything
+changed.
+"""
+
+from __future__ import absolute_import
+import os
+import json
+import time
+
+from . import db
+
+
+def _directory():
+    return db.get_app().config['LIVE_STATE_DIR']
+
+
+def enabled():
+    """Return whether live match state is being published"""
+    return bool(_directory())
+
+
+def _filename(directory, server_address):
+    return os.path.join(directory, '%s_%d.json' % server_address)
+
+
+def publish(server_address, snapshot):
+    """Replace the snapshot for a server
+
+    Does nothing if LIVE_STATE_DIR is not set.
+
+    Parameters:
+        server_address: The server's (ip, port)
+        snapshot: A JSON serializable dict describing the match
+    """
+    directory = _directory()
+    if not directory:
+        return
+    filename = _filename(directory, server_address)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    snapshot = dict(snapshot, server='%s:%d' % server_address,
+                    updated=time.time())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'w') as fd:
+            json.dump(snapshot, fd, separators=(',', ':'))
+        os.rename(tmp, filename)
+    except (OSError, IOError) as e:
+        # spectators missing an update is no reason to stop parsing
+        print u'goonpugd: could not publish live state: %s' % e
+
+
+def clear(server_address):
+    """Remove the snapshot for a server"""
+    directory = _directory()
+    if not directory:
+        return
+    try:
+        os.unlink(_filename(directory, server_address))
+    except OSError:
+        pass
+
+
+def version():
+    """Return a token which changes whenever any snapshot changes"""
+    directory = _directory()
+    try:
+        return repr(os.stat(directory).st_mtime)
+    except (OSError, TypeError):
+        return '0'
+
+
+_snapshots = {'version': None, 'matches': []}
+
+
+def matches():
+    """Return the snapshots of every match in progress
+
+    Snapshots are only read again when the directory has changed, and
+    snapshots which haven't been updated for LIVE_STATE_TTL seconds (left
+    behind by a server or goonpugd going away mid match) are skipped.
+    """
+    token = version()
+    if _snapshots['version'] != token:
+        snapshots = []
+        directory = _directory()
+        try:
+            names = sorted(os.listdir(directory))
+        except (OSError, TypeError):
+            names = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as fd:
+                    snapshots.append(json.load(fd))
+            except (IOError, ValueError):
+                # removed since listing the directory
+                continue
+        _snapshots['matches'] = snapshots
+        _snapshots['version'] = token
+    oldest = time.time() - db.get_app().config['LIVE_STATE_TTL']
+    return [snapshot for snapshot in _snapshots['matches']
+            if snapshot['updated'] >= oldest]
@@ -0,0 +1,177 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming srcds log reader
+
+Logs are read as blocks of complete lines rather than as one string per
+line. Uncompressed files are memory mapped and handed out as a single
+block; gzip and bz2 compressed files (detected by their magic bytes, since
+rotated logs are not always renamed) and pipes are read in fixed size
+chunks. line_spans() returns the (start, end) offsets of each line in a
+block, which can be passed straight to a compiled regex's match() as pos
+and endpos, so lines are never copied out of the block.
+
+DirectoryWatcher waits for changes to a log directory, using inotify if
+pyinotify is installed and polling otherwise.
+"""
+
+from __future__ import absolute_import
+import os
+import bz2
+import gzip
+import mmap
+import time
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+BLOCK_SIZE = 1 << 20
+WHITESPACE = ' \t\r\n\x0b\x0c'
+
+
+def open_log(filename):
+    """Open a plain, gzip or bz2 compressed log file for reading"""
+    with open(filename, 'rb') as fd:
+        magic = fd.read(3)
+    if magic[:2] == '\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    elif magic == 'BZh':
+        return bz2.BZ2File(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def iter_blocks(fd, block_size=BLOCK_SIZE):
+    """Yield blocks of complete lines read from a file object
+
+    Pipes and ttys are read with os.read() so that lines are handed on as
+    soon as they arrive instead of once a full block has been buffered.
+    """
+    if isinstance(fd, file) and not os.path.isfile(fd.name):
+        fileno = fd.fileno()
+        read = lambda: os.read(fileno, block_size)
+    else:
+        read = lambda: fd.read(block_size)
+    partial = ''
+    while True:
+        data = read()
+        if not data:
+            break
+        eol = data.rfind('\n')
+        if eol < 0:
+            partial += data
+            continue
+        yield partial + data[:eol + 1]
+        partial = data[eol + 1:]
+    if partial:
+        yield partial
+
+
+def read_blocks(filename, use_mmap=True, block_size=BLOCK_SIZE):
+    """Yield blocks of complete lines from a log file
+
+    Parameters:
+        filename: The log file to read
+        use_mmap: If True, uncompressed files are memory mapped and
+            returned as a single block. Blocks from a memory mapped file
+            can't be pickled, so this must be False if blocks are going to
+            be passed to other processes.
+        block_size: The size of blocks read from compressed files
+    """
+    fd = open_log(filename)
+    try:
+        if use_mmap and isinstance(fd, file):
+            if os.fstat(fd.fileno()).st_size == 0:
+                return
+            block = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield block
+            finally:
+                block.close()
+        else:
+            for block in iter_blocks(fd, block_size):
+                yield block
+    finally:
+        fd.close()
+
+
+def split_block(block, size):
+    """Yield pieces of a block of complete lines, each of about size bytes
+
+    Every piece but the last ends with a newline.
+    """
+    end = len(block)
+    start = 0
+    while start < end:
+        eol = block.find('\n', start + size - 1, end)
+        stop = end if eol < 0 else eol + 1
+        yield block[start:stop]
+        start = stop
+
+
+def line_spans(block):
+    """Yield the (start, end) offsets of the stripped lines in a block
+
+    Blank lines are skipped.
+    """
+    find = block.find
+    end = len(block)
+    pos = 0
+    while pos < end:
+        eol = find('\n', pos, end)
+        if eol < 0:
+            eol = end
+        stop = eol
+        while stop > pos and block[stop - 1] in WHITESPACE:
+            stop -= 1
+        while pos < stop and block[pos] in WHITESPACE:
+            pos += 1
+        if pos < stop:
+            yield (pos, stop)
+        pos = eol + 1
+
+
+class DirectoryWatcher(object):
+
+    """Wait for files in a directory to be created or written to
+
+    Parameters:
+        path: The directory to watch
+        interval: The polling interval in seconds. With inotify this is
+            the longest wait() will block.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self._notifier = None
+        if pyinotify is not None:
+            manager = pyinotify.WatchManager()
+            manager.add_watch(path, pyinotify.IN_MODIFY | pyinotify.IN_CREATE
+                              | pyinotify.IN_MOVED_TO)
+            self._notifier = pyinotify.Notifier(
+                manager, default_proc_fun=pyinotify.ProcessEvent(),
+                timeout=int(interval * 1000))
+
+    def wait(self):
+        """Block until the directory may have changed"""
+        if self._notifier is None:
+            time.sleep(self.interval)
+        elif self._notifier.check_events():
+            self._notifier.read_events()
+            self._notifier.process_events()
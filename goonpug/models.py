@@ -16,10 +16,11 @@
 # along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import
+import json
 import datetime
 from flask.ext.login import UserMixin
 from srcds.objects import SteamId
-from sqlalchemy import func, case, not_, and_
+from sqlalchemy import func, case, not_, and_, select
 
 from . import db
 
@@ -48,7 +49,7 @@ class Player(db.Model, UserMixin):
         return player
 
     @classmethod
-    def round_frags(cls):
+    def round_frags(cls, player_ids=None):
         """Return all of a Player's frags grouped by round"""
         query = db.session.query(
             Frag.fragger.label('player_id'),
@@ -64,12 +65,14 @@ class Player(db.Model, UserMixin):
                 ], else_=0)
             ).label('tks'),
         ).group_by(Frag.round_id, Frag.fragger)
+        if player_ids is not None:
+            query = query.filter(Frag.fragger.in_(player_ids))
         return query
 
     @classmethod
-    def match_frags(cls):
+    def match_frags(cls, player_ids=None):
         """Return all of a Player's frags grouped by match"""
-        player_round_frags = cls.round_frags().subquery()
+        player_round_frags = cls.round_frags(player_ids).subquery()
         query = db.session.query(
             player_round_frags.c.player_id,
             Round.match_id,
@@ -112,7 +115,7 @@ class Player(db.Model, UserMixin):
         return query
 
     @classmethod
-    def round_hits(cls):
+    def round_hits(cls, player_ids=None):
         """Return all of a Player's hits grouped by round"""
         query = db.session.query(
             Attack.attacker.label('player_id'),
@@ -128,12 +131,14 @@ class Player(db.Model, UserMixin):
                 ], else_=0)
             ).label('headshots'),
         ).group_by(Attack.round_id, Attack.attacker)
+        if player_ids is not None:
+            query = query.filter(Attack.attacker.in_(player_ids))
         return query
 
     @classmethod
-    def match_hits(cls):
+    def match_hits(cls, player_ids=None):
         """Return all of a Player's hits grouped by match"""
-        player_round_hits = cls.round_hits().subquery()
+        player_round_hits = cls.round_hits(player_ids).subquery()
         query = db.session.query(
             player_round_hits.c.player_id,
             Round.match_id,
@@ -151,10 +156,15 @@ class Player(db.Model, UserMixin):
         return query
 
     @classmethod
-    def match_stats(cls):
-        """Return stats for Player has played in grouped by match"""
-        player_match_frags = cls.match_frags().subquery()
-        player_match_hits = cls.match_hits().subquery()
+    def match_stats(cls, player_ids=None, match_ids=None):
+        """Return stats for Player has played in grouped by match
+
+        If player_ids is given, only those players' rows are read from the
+        round level tables. If match_ids is given, only those matches are
+        included.
+        """
+        player_match_frags = cls.match_frags(player_ids).subquery()
+        player_match_hits = cls.match_hits(player_ids).subquery()
         player_match_rounds = db.session.query(
             PlayerRound.player_id,
             Round.match_id,
@@ -223,7 +233,14 @@ class Player(db.Model, UserMixin):
             CsgoMatch,
             and_(Round.match_id == CsgoMatch.id,
                  CsgoMatch.end_time is not None)
-        ).group_by(PlayerRound.player_id, Round.match_id).subquery()
+        ).group_by(PlayerRound.player_id, Round.match_id)
+        if player_ids is not None:
+            player_match_rounds = player_match_rounds.filter(
+                PlayerRound.player_id.in_(player_ids))
+        if match_ids is not None:
+            player_match_rounds = player_match_rounds.filter(
+                Round.match_id.in_(match_ids))
+        player_match_rounds = player_match_rounds.subquery()
         query = db.session.query(
             player_match_rounds,
             player_match_frags.c.frags,
@@ -251,8 +268,9 @@ class Player(db.Model, UserMixin):
         return query
 
     @classmethod
-    def total_stats(cls, *match_filters):
-        player_match_stats = cls.match_stats()
+    def total_stats(cls, *match_filters, **kwargs):
+        player_match_stats = cls.match_stats(kwargs.get('player_ids'),
+                                             kwargs.get('match_ids'))
         for arg in match_filters:
             player_match_stats = player_match_stats.filter(arg)
         player_match_stats = player_match_stats.subquery()
@@ -320,12 +338,21 @@ class Player(db.Model, UserMixin):
         return query
 
     @classmethod
-    def map_stats(cls, mapname):
-        query = cls.total_stats("map = '%s'" % mapname).group_by('player_id')
+    def map_stats(cls, mapname, match_ids=None):
+        """Return per player stats for a map
+
+        If match_ids is given, only those matches are included.
+        """
+        query = cls.total_stats("map = '%s'" % mapname,
+                                match_ids=match_ids).group_by('player_id')
         return query
 
     @classmethod
-    def weapon_kill_stats(cls, weapon):
+    def weapon_kill_stats(cls, weapon, match_ids=None):
+        """Return per player frags and hsp with a weapon
+
+        If match_ids is given, only those matches are included.
+        """
         frags_query = db.session.query(
             Frag.fragger.label('player_id'),
             Frag.weapon,
@@ -334,7 +361,7 @@ class Player(db.Model, UserMixin):
                     (not_(Frag.tk), 1),
                 ], else_=0)
             ).label('frags'),
-        ).group_by(Frag.fragger, Frag.weapon).subquery()
+        ).group_by(Frag.fragger, Frag.weapon)
         hits_query = db.session.query(
             Attack.attacker.label('player_id'),
             Attack.weapon,
@@ -349,7 +376,16 @@ class Player(db.Model, UserMixin):
                     ], else_=0)
                 )
             ).label('hsp'),
-        ).group_by(Attack.weapon, Attack.attacker).subquery()
+        ).group_by(Attack.weapon, Attack.attacker)
+        if match_ids is not None:
+            frags_query = frags_query.join(
+                Round, Frag.round_id == Round.id
+            ).filter(Round.match_id.in_(match_ids))
+            hits_query = hits_query.join(
+                Round, Attack.round_id == Round.id
+            ).filter(Round.match_id.in_(match_ids))
+        frags_query = frags_query.subquery()
+        hits_query = hits_query.subquery()
         query = db.session.query(
             frags_query.c.player_id,
             Player.nickname,
@@ -445,8 +481,10 @@ class CsgoMatch(db.Model):
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'),
                           nullable=False)
     start_time = db.Column(db.DateTime, nullable=False, index=True)
-    end_time = db.Column(db.DateTime)
+    end_time = db.Column(db.DateTime, index=True)
     map = db.Column(db.Unicode(64))
+    # sha1 of the stored match data, used to skip unchanged re-imports
+    content_hash = db.Column(db.String(40))
     rounds = db.relationship('Round', backref='csgo_match', lazy='dynamic',
                              cascade='all, delete-orphan')
     team_a = db.ForeignKey('team')
@@ -455,6 +493,33 @@ class CsgoMatch(db.Model):
                               backref='matches')
     db.UniqueConstraint('server_id', 'start_time', name='uidx_server_match')
 
+    @classmethod
+    def _delete_matches(cls, match_ids):
+        """Delete matches and all of their round level rows
+
+        Rows are removed with one DELETE statement per table instead of
+        through the ORM cascades, which load every child row into the
+        session first. Matching objects already loaded into the session are
+        not expired. The caller is responsible for committing.
+
+        Parameters:
+            match_ids: A list of match IDs
+        """
+        if not match_ids:
+            return
+        round_ids = select([Round.__table__.c.id]).where(
+            Round.__table__.c.match_id.in_(match_ids))
+        for table in (Attack.__table__, Frag.__table__,
+                      PlayerRound.__table__):
+            db.session.execute(table.delete().where(
+                table.c.round_id.in_(round_ids)))
+        db.session.execute(Round.__table__.delete().where(
+            Round.__table__.c.match_id.in_(match_ids)))
+        db.session.execute(match_players.delete().where(
+            match_players.c.match_id.in_(match_ids)))
+        db.session.execute(cls.__table__.delete().where(
+            cls.__table__.c.id.in_(match_ids)))
+
 
 team_players = db.Table(
     'team_players',
@@ -531,6 +596,56 @@ class Round(db.Model):
                               lazy="dynamic")
 
 
+class StatsDimension(db.Model):
+
+    """Every distinct map and weapon name in the stats
+
+    The stats menus are built from this table rather than from DISTINCT
+    scans of csgo_match and frag. goonpugd adds new names as it stores
+    matches, and rebuild_stats.py rebuilds it from scratch.
+    """
+
+    KIND_MAP = u'map'
+    KIND_WEAPON = u'weapon'
+
+    kind = db.Column(db.Unicode(16), primary_key=True)
+    value = db.Column(db.Unicode(64), primary_key=True)
+
+    @classmethod
+    def values(cls, kind):
+        """Return the sorted names of one kind"""
+        return [value for (value,) in db.session.query(cls.value).filter_by(
+            kind=kind).order_by(cls.value)]
+
+    @classmethod
+    def _add(cls, rows):
+        """Add (kind, value) pairs, skipping any which already exist
+
+        Several goonpugd processes may add the same name at once, so
+        duplicates are ignored by the INSERT itself. The caller is
+        responsible for committing.
+        """
+        if not rows:
+            return
+        insert = cls.__table__.insert().prefix_with(
+            'IGNORE', dialect='mysql').prefix_with(
+            'OR IGNORE', dialect='sqlite')
+        db.session.execute(insert, [dict(kind=kind, value=value)
+                                    for (kind, value) in rows])
+
+    @classmethod
+    def _rebuild(cls):
+        """Replace every row with the names in the match data"""
+        db.session.execute(cls.__table__.delete())
+        rows = set()
+        for (kind, column) in ((cls.KIND_MAP, CsgoMatch.map),
+                               (cls.KIND_WEAPON, Frag.weapon)):
+            rows.update((kind, value) for (value,) in db.session.query(
+                column).distinct() if value is not None)
+        cls._add(rows)
+        db.session.commit()
+
+
 class PlayerOverallStatsSummary(db.Model):
 
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'),
@@ -562,12 +677,19 @@ class PlayerOverallStatsSummary(db.Model):
     fpr = db.Column(db.Float, default=0.0)
     rws = db.Column(db.Float, default=0.0)
 
+    # columns copied straight from Player.total_stats() into the summary
+    _stats_columns = (
+        'nickname', 'frags', 'tks', 'assists', 'deaths', 'bomb_planted',
+        'bomb_defused', 'rounds_won', 'rounds_lost', 'rounds_dropped',
+        'rounds_played', 'won_1v1', 'won_1v2', 'won_1v3', 'won_1v4',
+        'won_1v5', 'k1', 'k2', 'k3', 'k4', 'k5', 'kdr', 'hsp', 'adr', 'fpr',
+    )
+
     @classmethod
-    def _update_rws(cls, player_id, day_range=30):
-        """Update the specified player's RWS
+    def _rws_query(cls, day_range=30):
+        """Return recent RWS totals grouped by player
 
         Parameters:
-            player_id: The player ID
             day_range: An integer specifying the number of previous days'
                 matches to include in the RWS calculation.
         """
@@ -584,9 +706,21 @@ class PlayerOverallStatsSummary(db.Model):
         ).join(
             CsgoMatch,
         ).filter(
-            PlayerRound.player_id == player_id,
             CsgoMatch.end_time >= date_range_start
         ).group_by(PlayerRound.player_id)
+        return query
+
+    @classmethod
+    def _update_rws(cls, player_id, day_range=30):
+        """Update the specified player's RWS
+
+        Parameters:
+            player_id: The player ID
+            day_range: An integer specifying the number of previous days'
+                matches to include in the RWS calculation.
+        """
+        query = cls._rws_query(day_range).filter(
+            PlayerRound.player_id == player_id)
         result = query.first()
         player_summary = cls.query.filter_by(player_id=player_id).first()
         if not player_summary:
@@ -599,45 +733,263 @@ class PlayerOverallStatsSummary(db.Model):
             player_summary.rws = 0.0
         db.session.commit()
 
+    @classmethod
+    def _summary_rows(cls, player_ids, day_range=30):
+        """Return summary values for the specified players
+
+        Overall stats and recent RWS for every player are fetched with a
+        single aggregate query. Players with no recorded rounds are omitted.
+
+        Parameters:
+            player_ids: A list of player IDs
+            day_range: An integer specifying the number of previous days'
+                matches to include in the RWS calculation.
+        """
+        stats = Player.total_stats(
+            player_ids=player_ids
+        ).group_by('player_id').subquery()
+        recent = cls._rws_query(day_range).filter(
+            PlayerRound.player_id.in_(player_ids)
+        ).subquery()
+        query = db.session.query(
+            stats,
+            (recent.c.total_rws / recent.c.round_count).label('rws'),
+        ).outerjoin(
+            recent,
+            stats.c.player_id == recent.c.player_id
+        )
+        rows = []
+        for result in query:
+            row = dict((column, getattr(result, column))
+                       for column in cls._stats_columns)
+            row['player_id'] = result.player_id
+            row['rws'] = result.rws or 0.0
+            rows.append(row)
+        return rows
+
+    @classmethod
+    def _refresh_stats(cls, player_ids, day_range=30):
+        """Update the summaries for a set of players
+
+        All of the summaries are written back in a single transaction.
+
+        Parameters:
+            player_ids: A list of player IDs
+            day_range: An integer specifying the number of previous days'
+                matches to include in the RWS calculation.
+        """
+        player_ids = list(set(player_ids))
+        if not player_ids:
+            return
+        rows = dict((row['player_id'], row)
+                    for row in cls._summary_rows(player_ids, day_range))
+        summaries = dict(
+            (summary.player_id, summary) for summary in
+            cls.query.filter(cls.player_id.in_(player_ids))
+        )
+        for player_id in player_ids:
+            player_summary = summaries.get(player_id)
+            if not player_summary:
+                player_summary = PlayerOverallStatsSummary()
+                player_summary.player_id = player_id
+                db.session.add(player_summary)
+            row = rows.get(player_id)
+            if row:
+                for column in cls._stats_columns:
+                    setattr(player_summary, column, row[column])
+                player_summary.rws = row['rws']
+            else:
+                player_summary.rws = 0.0
+        db.session.commit()
+
     @classmethod
     def _update_stats(cls, player_id):
-        player = Player.total_stats(player_id).filter_by(id=player_id).first()
-        player_summary = cls.query.filter_by(player_id=player_id).first()
-        if not player_summary:
-            player_summary = PlayerOverallStatsSummary()
-            player_summary.player_id = player_id
-            db.session.add(player_summary)
-        if player:
-            player_summary.nickname = player.nickname
-            player_summary.frags = player.frags
-            player_summary.tks = player.tks
-            player_summary.assists = player.assists
-            player_summary.deaths = player.deaths
-            player_summary.bomb_planted = player.bomb_planted
-            player_summary.bomb_defused = player.bomb_defused
-            player_summary.rounds_won = player.rounds_won
-            player_summary.rounds_lost = player.rounds_lost
-            player_summary.rounds_dropped = player.rounds_dropped
-            player_summary.rounds_played = player.rounds_played
-            player_summary.won_1v1 = player.won_1v1
-            player_summary.won_1v2 = player.won_1v2
-            player_summary.won_1v3 = player.won_1v3
-            player_summary.won_1v4 = player.won_1v4
-            player_summary.won_1v5 = player.won_1v5
-            player_summary.k1 = player.k1
-            player_summary.k2 = player.k2
-            player_summary.k3 = player.k3
-            player_summary.k4 = player.k4
-            player_summary.k5 = player.k5
-            player_summary.kdr = player.kdr
-            player_summary.hsp = player.hsp
-            player_summary.adr = player.adr
-            player_summary.fpr = player.fpr
+        cls._refresh_stats([player_id])
+
+    @classmethod
+    def _update_all_stats(cls, chunk_size=100):
+        player_ids = [player.id for player in db.session.query(Player.id)]
+        for i in range(0, len(player_ids), chunk_size):
+            cls._refresh_stats(player_ids[i:i + chunk_size])
+
+
+def _ratio(numerator, denominator):
+    if not denominator:
+        return 0.0
+    return float(numerator) / denominator
+
+
+class PlayerProfile(db.Model):
+
+    """Denormalized profile page for a player
+
+    The document holds everything /player/<id> shows: the player's summary,
+    per-map splits, top weapons and most recent matches. goonpugd rebuilds
+    it whenever a match the player played in is stored, so rendering a
+    profile is a single keyed read regardless of how many matches the
+    player has played.
+    """
+
+    RECENT_MATCHES = 10
+    TOP_WEAPONS = 5
+
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'),
+                          primary_key=True)
+    updated_at = db.Column(db.DateTime)
+    document = db.Column(db.Text)
+
+    @classmethod
+    def load(cls, player_id):
+        """Return the profile document for a player, or None"""
+        row = db.session.query(cls.document).filter_by(
+            player_id=player_id).first()
+        if row is None:
+            return None
+        return json.loads(row.document)
+
+    @classmethod
+    def _documents(cls, player_ids):
+        """Build the profile documents for a set of players
+
+        Returns a dict of player ID to document. Every document is built
+        from the same four queries, regardless of how many players there
+        are.
+        """
+        documents = {}
+        for player in db.session.query(Player.id, Player.nickname,
+                                       Player.steam_id).filter(
+                Player.id.in_(player_ids)):
+            documents[player.id] = {
+                'player_id': player.id,
+                'nickname': player.nickname,
+                'auth_id': SteamId.id64_to_str(player.steam_id),
+                'summary': None,
+                'maps': [],
+                'weapons': [],
+                'recent_matches': [],
+            }
+        columns = [column.name for column
+                   in PlayerOverallStatsSummary.__table__.columns
+                   if column.name != 'player_id']
+        for summary in PlayerOverallStatsSummary.query.filter(
+                PlayerOverallStatsSummary.player_id.in_(player_ids)):
+            if summary.player_id in documents:
+                documents[summary.player_id]['summary'] = dict(
+                    (column, getattr(summary, column)) for column in columns)
+
+        match_stats = Player.match_stats(player_ids).subquery()
+        query = db.session.query(
+            match_stats, CsgoMatch.end_time
+        ).join(
+            CsgoMatch, CsgoMatch.id == match_stats.c.match_id
+        ).filter(
+            CsgoMatch.end_time != None
+        ).order_by(CsgoMatch.end_time.desc())
+        maps = {}
+        for row in query:
+            document = documents.get(row.player_id)
+            if document is None:
+                continue
+            frags = row.frags or 0
+            rounds_played = row.rounds_won + row.rounds_lost
+            if len(document['recent_matches']) < cls.RECENT_MATCHES:
+                document['recent_matches'].append({
+                    'match_id': row.match_id,
+                    'map': row.map,
+                    'end_time': row.end_time.strftime(u'%Y-%m-%d %H:%M:%S'),
+                    'rounds_won': row.rounds_won,
+                    'rounds_lost': row.rounds_lost,
+                    'frags': frags,
+                    'assists': row.assists,
+                    'deaths': row.deaths,
+                    'adr': _ratio(row.damage, rounds_played),
+                    'rws': _ratio(row.total_rws,
+                                  rounds_played + row.rounds_dropped),
+                })
+            totals = maps.setdefault((row.player_id, row.map), {
+                'map': row.map, 'matches': 0, 'rounds_won': 0,
+                'rounds_lost': 0, 'rounds_dropped': 0, 'frags': 0,
+                'deaths': 0, 'damage': 0, 'total_rws': 0.0, 'hits': 0,
+                'headshots': 0,
+            })
+            totals['matches'] += 1
+            for column in ('rounds_won', 'rounds_lost', 'rounds_dropped',
+                           'deaths', 'damage', 'total_rws', 'hits',
+                           'headshots'):
+                totals[column] += getattr(row, column) or 0
+            totals['frags'] += frags
+        for ((player_id, mapname), totals) in maps.items():
+            rounds_played = totals['rounds_won'] + totals['rounds_lost']
+            documents[player_id]['maps'].append({
+                'map': mapname,
+                'matches': totals['matches'],
+                'rounds_played': rounds_played,
+                'rounds_won': totals['rounds_won'],
+                'rounds_lost': totals['rounds_lost'],
+                'frags': totals['frags'],
+                'deaths': totals['deaths'],
+                'kdr': _ratio(totals['frags'], totals['deaths']),
+                'hsp': _ratio(totals['headshots'], totals['hits']),
+                'adr': _ratio(totals['damage'], rounds_played),
+                'rws': _ratio(totals['total_rws'],
+                              rounds_played + totals['rounds_dropped']),
+            })
+        for document in documents.values():
+            document['maps'].sort(key=lambda m: (-m['rounds_played'],
+                                                 m['map']))
+
+        query = db.session.query(
+            Frag.fragger,
+            Frag.weapon,
+            func.count(Frag.id).label('frags'),
+            func.sum(case([(Frag.headshot, 1)], else_=0)).label('headshots'),
+        ).filter(
+            Frag.fragger.in_(player_ids), not_(Frag.tk)
+        ).group_by(Frag.fragger, Frag.weapon).order_by(
+            Frag.fragger, func.count(Frag.id).desc(), Frag.weapon)
+        for row in query:
+            document = documents.get(row.fragger)
+            if document is None or \
+                    len(document['weapons']) >= cls.TOP_WEAPONS:
+                continue
+            document['weapons'].append({
+                'weapon': row.weapon,
+                'frags': row.frags,
+                'headshots': row.headshots,
+                'hsp': _ratio(row.headshots, row.frags),
+            })
+        return documents
+
+    @classmethod
+    def _refresh_profiles(cls, player_ids):
+        """Rebuild the profiles for a set of players
+
+        All of the profiles are written back in a single transaction.
+
+        Parameters:
+            player_ids: A list of player IDs
+        """
+        player_ids = list(set(player_ids))
+        if not player_ids:
+            return
+        documents = cls._documents(player_ids)
+        profiles = dict(
+            (profile.player_id, profile) for profile in
+            cls.query.filter(cls.player_id.in_(documents.keys()))
+        ) if documents else {}
+        now = datetime.datetime.utcnow()
+        for (player_id, document) in documents.items():
+            profile = profiles.get(player_id)
+            if not profile:
+                profile = PlayerProfile()
+                profile.player_id = player_id
+                db.session.add(profile)
+            profile.updated_at = now
+            profile.document = json.dumps(document, separators=(',', ':'))
         db.session.commit()
-        cls._update_rws(player_id)
 
     @classmethod
-    def _update_all_stats(cls):
-        players = db.session.query(Player.id).all()
-        for player in players:
-            cls._update_stats(player.id)
+    def _update_all_profiles(cls, chunk_size=100):
+        player_ids = [player.id for player in db.session.query(Player.id)]
+        for i in range(0, len(player_ids), chunk_size):
+            cls._refresh_profiles(player_ids[i:i + chunk_size])
@@ -0,0 +1,106 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Database connection pool setup
+
+goonpugd forks worker processes after the parent has already opened
+database connections. Every pooled connection is tagged with the pid of
+the process that opened it, and a process never hands out a connection it
+did not open itself, so sockets are never shared across a fork.
+"""
+
+from __future__ import absolute_import
+import os
+from sqlalchemy import event, exc
+
+
+_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'invalidated': 0,
+    'stale': 0,
+    'inherited': 0,
+}
+
+# DBAPI connections inherited from a parent process. We hold on to them so
+# that they are never closed (and the parent's socket shut down) from here.
+_inherited = []
+
+
+def init_pool(engine, pre_ping=True):
+    """Install the fork guard, pre-ping and usage counters on an engine"""
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        _stats['connects'] += 1
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get('pid') != os.getpid():
+            _inherited.append(dbapi_connection)
+            connection_record.connection = connection_proxy.connection = None
+            _stats['inherited'] += 1
+            raise exc.DisconnectionError(
+                'Connection belongs to pid %s, attempting to check out in '
+                'pid %s' % (connection_record.info.get('pid'), os.getpid()))
+        if pre_ping:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            except Exception:
+                _stats['stale'] += 1
+                raise exc.DisconnectionError('Stale pooled connection')
+            finally:
+                cursor.close()
+        _stats['checkouts'] += 1
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        _stats['checkins'] += 1
+
+    @event.listens_for(engine, 'invalidate')
+    def invalidate(dbapi_connection, connection_record, exception):
+        _stats['invalidated'] += 1
+
+
+def after_fork():
+    """Set up database access for a newly forked worker process
+
+    The session registry is discarded without closing the session, since
+    any connection it holds belongs to the parent process. The pool itself
+    is left alone; inherited connections are replaced as they are checked
+    out.
+    """
+    from . import db
+    db.session.registry.clear()
+    for key in _stats:
+        _stats[key] = 0
+
+
+def pool_status():
+    """Return connection pool usage for this process"""
+    from . import db
+    pool = db.engine.pool
+    status = dict(_stats)
+    status['pid'] = os.getpid()
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if method:
+            status[name] = method()
+    return status
@@ -0,0 +1,162 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read/write routing between the primary database and a read replica
+
+Reads made while handling GET requests go to the replica configured in
+SQLALCHEMY_READ_DATABASE_URI. Everything else (goonpugd, scripts, flushes
+and explicit INSERT/UPDATE/DELETE statements) goes to the primary. If the
+replica falls more than READ_REPLICA_MAX_LAG seconds behind the primary, or
+can't be reached, reads fall back to the primary until the next check.
+"""
+
+from __future__ import absolute_import
+import time
+from functools import partial, wraps
+import sqlalchemy
+from sqlalchemy import event, exc, func, orm, select
+from sqlalchemy.sql.expression import UpdateBase
+from flask import g, request, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy
+try:
+    from flask.ext.sqlalchemy import SignallingSession
+except ImportError:
+    from flask.ext.sqlalchemy import _SignallingSession as SignallingSession
+
+from .pool import init_pool
+
+
+class ReadReplica(object):
+
+    """Read replica engine with a lag check"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._engine = None
+        self._checked_at = 0
+        self._available = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_READ_DATABASE_URI', None)
+        app.config.setdefault('READ_REPLICA_MAX_LAG', 300)
+        app.config.setdefault('READ_REPLICA_CHECK_INTERVAL', 30)
+        self.app = app
+
+    @property
+    def uri(self):
+        if self.app is None:
+            return None
+        return self.app.config['SQLALCHEMY_READ_DATABASE_URI']
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = self._create_engine(self.uri)
+        return self._engine
+
+    def _create_engine(self, uri):
+        config = self.app.config
+        options = {}
+        if uri.startswith('sqlite'):
+            engine = sqlalchemy.create_engine(uri)
+
+            @event.listens_for(engine, 'connect')
+            def connect(dbapi_connection, connection_record):
+                # the replica may be a snapshot file, never write to it
+                dbapi_connection.execute('PRAGMA query_only = ON')
+        else:
+            for (option, key) in (('pool_size', 'SQLALCHEMY_POOL_SIZE'),
+                                  ('max_overflow', 'SQLALCHEMY_MAX_OVERFLOW'),
+                                  ('pool_recycle', 'SQLALCHEMY_POOL_RECYCLE')):
+                if config.get(key) is not None:
+                    options[option] = config[key]
+            engine = sqlalchemy.create_engine(uri, **options)
+        init_pool(engine, pre_ping=config['SQLALCHEMY_POOL_PRE_PING'])
+        return engine
+
+    def lag(self, primary):
+        """Return how many seconds the replica is behind the primary"""
+        from .models import CsgoMatch
+        query = select([func.max(CsgoMatch.__table__.c.end_time)])
+        primary_time = primary.execute(query).scalar()
+        replica_time = self.engine.execute(query).scalar()
+        if primary_time is None:
+            return 0
+        if replica_time is None:
+            return None
+        return (primary_time - replica_time).total_seconds()
+
+    def available(self, primary):
+        """Return True if reads should currently go to the replica"""
+        if not self.uri:
+            return False
+        now = time.time()
+        if now - self._checked_at >= \
+                self.app.config['READ_REPLICA_CHECK_INTERVAL']:
+            self._checked_at = now
+            try:
+                lag = self.lag(primary)
+            except exc.SQLAlchemyError:
+                lag = None
+            self._available = lag is not None and \
+                lag <= self.app.config['READ_REPLICA_MAX_LAG']
+        return self._available
+
+
+replica = ReadReplica()
+
+
+def use_replica():
+    """Return True if the current request may read from the replica"""
+    if not has_request_context():
+        return False
+    if getattr(g, 'use_primary', False):
+        return False
+    return request.method in ('GET', 'HEAD')
+
+
+def primary(f):
+    """Decorator for views which must read their own writes"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.use_primary = True
+        return f(*args, **kwargs)
+    return decorated
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        primary_bind = SignallingSession.get_bind(self, mapper, clause)
+        if self._flushing or isinstance(clause, UpdateBase):
+            return primary_bind
+        if use_replica() and replica.available(primary_bind):
+            return replica.engine
+        return primary_bind
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(
+            partial(RoutingSession, self, **options), scopefunc=scopefunc
+        )
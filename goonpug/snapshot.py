@@ -0,0 +1,366 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar snapshots of the round level stats tables
+
+A snapshot is a directory of chunks, each holding one .npy file per column
+for the completed matches it covers::
+
+    manifest.json
+    00000001-00000100/match.id.npy
+    00000001-00000100/player_round.player_id.npy
+    ...
+
+String columns (maps, weapons and hitgroups) are stored as small integer
+codes into the dictionaries kept in the manifest. Exports are incremental:
+only completed matches which are not already in the snapshot are read from
+the database, and matches which have since been deleted are recorded in
+the manifest and masked out when the snapshot is loaded.
+"""
+
+from __future__ import absolute_import, division
+import os
+import json
+import time
+import shutil
+import calendar
+import numpy as np
+from sqlalchemy import select
+
+from . import db
+from .models import CsgoMatch, Round, PlayerRound, Frag, Attack
+
+
+SNAPSHOT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+# (column, dtype) for every exported column of each table. Nullable integer
+# columns are stored as -1.
+COLUMNS = {
+    'match': [
+        ('id', 'i4'),
+        ('server_id', 'i4'),
+        ('map', 'i2'),
+        ('start_time', 'i8'),
+        ('end_time', 'i8'),
+    ],
+    'player_round': [
+        ('match_id', 'i4'),
+        ('round_id', 'i4'),
+        ('period', 'i2'),
+        ('winning_team', 'i1'),
+        ('player_id', 'i4'),
+        ('team', 'i1'),
+        ('assists', 'i2'),
+        ('dead', '?'),
+        ('damage', 'i4'),
+        ('bomb_planted', '?'),
+        ('bomb_defused', '?'),
+        ('won_1v', 'i1'),
+        ('rws', 'f8'),
+        ('dropped', '?'),
+    ],
+    'frag': [
+        ('match_id', 'i4'),
+        ('round_id', 'i4'),
+        ('fragger', 'i4'),
+        ('victim', 'i4'),
+        ('weapon', 'i2'),
+        ('headshot', '?'),
+        ('tk', '?'),
+    ],
+    'attack': [
+        ('match_id', 'i4'),
+        ('round_id', 'i4'),
+        ('attacker', 'i4'),
+        ('target', 'i4'),
+        ('weapon', 'i2'),
+        ('damage', 'i4'),
+        ('damage_armor', 'i4'),
+        ('hitgroup', 'i1'),
+        ('ff', '?'),
+    ],
+}
+
+# dictionary encoded columns
+DICTIONARIES = {
+    ('match', 'map'): 'map',
+    ('frag', 'weapon'): 'weapon',
+    ('attack', 'weapon'): 'weapon',
+    ('attack', 'hitgroup'): 'hitgroup',
+}
+
+
+def _timestamp(value):
+    if value is None:
+        return -1
+    return calendar.timegm(value.timetuple())
+
+
+def _read_manifest(path):
+    filename = os.path.join(path, MANIFEST)
+    if not os.path.isfile(filename):
+        return {
+            'version': SNAPSHOT_VERSION,
+            'chunks': [],
+            'dictionaries': {'map': [], 'weapon': [], 'hitgroup': []},
+            'deleted_match_ids': [],
+        }
+    with open(filename) as fd:
+        manifest = json.load(fd)
+    if manifest['version'] != SNAPSHOT_VERSION:
+        raise ValueError('Unsupported snapshot version %s'
+                         % manifest['version'])
+    return manifest
+
+
+def _write_manifest(path, manifest):
+    filename = os.path.join(path, MANIFEST)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(manifest, fd, indent=1)
+    os.rename(tmp, filename)
+
+
+class Snapshot(object):
+
+    """A columnar snapshot on disk
+
+    Parameters:
+        path: The snapshot directory
+        mmap: If True, column files are memory mapped instead of being read
+            into memory.
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap_mode = 'r' if mmap else None
+        self.manifest = _read_manifest(path)
+        self._tables = {}
+
+    @property
+    def chunks(self):
+        return self.manifest['chunks']
+
+    def dictionary(self, name):
+        """Return the list of strings for a dictionary encoded column"""
+        return self.manifest['dictionaries'][name]
+
+    def chunk_column(self, chunk, table, column):
+        filename = os.path.join(self.path, chunk,
+                                '%s.%s.npy' % (table, column))
+        return np.load(filename, mmap_mode=self.mmap_mode)
+
+    def match_ids(self):
+        """Return the ids of every match stored in the snapshot"""
+        ids = [self.chunk_column(chunk, 'match', 'id')
+               for chunk in self.chunks]
+        if not ids:
+            return np.zeros(0, dtype='i4')
+        return np.concatenate(ids)
+
+    def table(self, name):
+        """Return a dict of column arrays for the specified table
+
+        With a single chunk and no deleted matches the arrays are the memory
+        mapped files themselves; otherwise chunks are concatenated.
+        """
+        if name in self._tables:
+            return self._tables[name]
+        columns = {}
+        for (column, dtype) in COLUMNS[name]:
+            arrays = [self.chunk_column(chunk, name, column)
+                      for chunk in self.chunks]
+            if not arrays:
+                columns[column] = np.zeros(0, dtype=dtype)
+            elif len(arrays) == 1:
+                columns[column] = arrays[0]
+            else:
+                columns[column] = np.concatenate(arrays)
+        deleted = self.manifest['deleted_match_ids']
+        if deleted:
+            key = 'id' if name == 'match' else 'match_id'
+            keep = ~np.in1d(columns[key], deleted)
+            columns = dict((column, values[keep])
+                           for (column, values) in columns.items())
+        self._tables[name] = columns
+        return columns
+
+
+def _encode(manifest, name, value):
+    values = manifest['dictionaries'][name]
+    if value is None:
+        return -1
+    try:
+        return values.index(value)
+    except ValueError:
+        values.append(value)
+        return len(values) - 1
+
+
+def _fetch(manifest, match_ids):
+    """Return column arrays for every table for the specified matches"""
+    match_table = CsgoMatch.__table__
+    round_table = Round.__table__
+    pr_table = PlayerRound.__table__
+    frag_table = Frag.__table__
+    attack_table = Attack.__table__
+
+    queries = {
+        'match': select([
+            match_table.c.id, match_table.c.server_id, match_table.c.map,
+            match_table.c.start_time, match_table.c.end_time,
+        ]).where(match_table.c.id.in_(match_ids)).order_by(match_table.c.id),
+        'player_round': select([
+            round_table.c.match_id, pr_table.c.round_id,
+            round_table.c.period, round_table.c.winning_team,
+            pr_table.c.player_id, pr_table.c.team, pr_table.c.assists,
+            pr_table.c.dead, pr_table.c.damage, pr_table.c.bomb_planted,
+            pr_table.c.bomb_defused, pr_table.c.won_1v, pr_table.c.rws,
+            pr_table.c.dropped,
+        ]).select_from(
+            pr_table.join(round_table,
+                          pr_table.c.round_id == round_table.c.id)
+        ).where(round_table.c.match_id.in_(match_ids)).order_by(
+            round_table.c.match_id, pr_table.c.round_id),
+        'frag': select([
+            round_table.c.match_id, frag_table.c.round_id,
+            frag_table.c.fragger, frag_table.c.victim, frag_table.c.weapon,
+            frag_table.c.headshot, frag_table.c.tk,
+        ]).select_from(
+            frag_table.join(round_table,
+                            frag_table.c.round_id == round_table.c.id)
+        ).where(round_table.c.match_id.in_(match_ids)).order_by(
+            round_table.c.match_id, frag_table.c.round_id, frag_table.c.id),
+        'attack': select([
+            round_table.c.match_id, attack_table.c.round_id,
+            attack_table.c.attacker, attack_table.c.target,
+            attack_table.c.weapon, attack_table.c.damage,
+            attack_table.c.damage_armor, attack_table.c.hitgroup,
+            attack_table.c.ff,
+        ]).select_from(
+            attack_table.join(round_table,
+                              attack_table.c.round_id == round_table.c.id)
+        ).where(round_table.c.match_id.in_(match_ids)).order_by(
+            round_table.c.match_id, attack_table.c.round_id,
+            attack_table.c.id),
+    }
+
+    tables = {}
+    for (name, query) in queries.items():
+        columns = COLUMNS[name]
+        values = [[] for _ in columns]
+        for row in db.session.execute(query):
+            for (i, (column, dtype)) in enumerate(columns):
+                value = row[i]
+                if (name, column) in DICTIONARIES:
+                    value = _encode(manifest, DICTIONARIES[(name, column)],
+                                    value)
+                elif column in ('start_time', 'end_time'):
+                    value = _timestamp(value)
+                elif value is None:
+                    value = -1 if dtype[0] == 'i' else 0
+                values[i].append(value)
+        tables[name] = dict(
+            (column, np.array(values[i], dtype=dtype))
+            for (i, (column, dtype)) in enumerate(columns)
+        )
+    return tables
+
+
+def export(path, chunk_size=100, progress=None):
+    """Export completed matches which are not yet in the snapshot
+
+    Parameters:
+        path: The snapshot directory. It will be created if necessary.
+        chunk_size: The maximum number of matches per chunk.
+        progress: Optional callable, called with (matches_done, total)
+            after each chunk is written.
+
+    Returns the number of matches exported.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    snapshot = Snapshot(path)
+    manifest = snapshot.manifest
+    exported = set(int(match_id) for match_id in snapshot.match_ids())
+    match_table = CsgoMatch.__table__
+    finished = set(match_id for (match_id,) in db.session.execute(
+        select([match_table.c.id]).where(match_table.c.end_time != None)))
+    # matches that were re-imported or removed from the db since export
+    deleted = set(manifest['deleted_match_ids'])
+    deleted.update(exported - finished - deleted)
+    manifest['deleted_match_ids'] = sorted(deleted)
+    pending = sorted(finished - exported)
+    for i in range(0, len(pending), chunk_size):
+        match_ids = pending[i:i + chunk_size]
+        tables = _fetch(manifest, match_ids)
+        chunk = '%08d-%08d' % (match_ids[0], match_ids[-1])
+        chunk_path = os.path.join(path, chunk)
+        if os.path.isdir(chunk_path):
+            # left over from an interrupted export
+            shutil.rmtree(chunk_path)
+        os.makedirs(chunk_path)
+        for (name, columns) in tables.items():
+            for (column, values) in columns.items():
+                np.save(os.path.join(chunk_path, '%s.%s.npy' % (name, column)),
+                        values)
+        manifest['chunks'].append(chunk)
+        manifest['exported_at'] = int(time.time())
+        _write_manifest(path, manifest)
+        if progress:
+            progress(i + len(match_ids), len(pending))
+    if not pending:
+        _write_manifest(path, manifest)
+    db.session.remove()
+    return len(pending)
+
+
+def compact(path):
+    """Merge all of a snapshot's chunks into a single chunk
+
+    Deleted matches are dropped while merging. Loading a compacted snapshot
+    needs no concatenation, so every column stays memory mapped.
+    """
+    snapshot = Snapshot(path, mmap=False)
+    if len(snapshot.chunks) <= 1 and not snapshot.manifest[
+            'deleted_match_ids']:
+        return
+    tables = dict((name, snapshot.table(name)) for name in COLUMNS)
+    match_ids = tables['match']['id']
+    if len(match_ids):
+        chunk = '%08d-%08d' % (match_ids.min(), match_ids.max())
+    else:
+        chunk = 'empty'
+    tmp_path = os.path.join(path, chunk + '.tmp')
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for (name, columns) in tables.items():
+        for (column, values) in columns.items():
+            np.save(os.path.join(tmp_path, '%s.%s.npy' % (name, column)),
+                    values)
+    old_chunks = snapshot.chunks
+    manifest = snapshot.manifest
+    manifest['deleted_match_ids'] = []
+    manifest['chunks'] = [chunk + '.tmp']
+    _write_manifest(path, manifest)
+    for old in old_chunks:
+        shutil.rmtree(os.path.join(path, old))
+    os.rename(tmp_path, os.path.join(path, chunk))
+    manifest['chunks'] = [chunk]
+    _write_manifest(path, manifest)
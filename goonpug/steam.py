@@ -0,0 +1,249 @@
+# Copyright (c) 2013 Peter Rowlands
+#
+# This file is part of GoonPUG
+#
+# GoonPUG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GoonPUG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GoonPUG.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cached Steam Web API profile lookups
+
+Profiles (the player objects returned by ISteamUser/GetPlayerSummaries) are
+kept in an in-process LRU cache. Requests never wait for Steam: profile()
+returns whatever is cached, even if it has expired, and queues the steam id
+for the background refresher thread, which looks up queued ids in batches
+of up to 100 (the most the API accepts per call).
+
+Steam ids which Steam doesn't return a profile for are cached as None, so
+they are only looked up again once that has expired too. When a lookup
+fails the refresher backs off, starting at STEAM_RETRY_DELAY seconds and
+doubling up to STEAM_RETRY_MAX_DELAY, and the ids it was looking up aren't
+queued again until the delay has passed.
+
+STEAM_API_URL can be pointed at a local stub server for testing.
+"""
+
+from __future__ import absolute_import
+import os
+import json
+import time
+import socket
+import urllib2
+import threading
+from collections import OrderedDict
+from werkzeug.urls import url_encode
+
+
+# GetPlayerSummaries accepts at most 100 steam ids per call
+BATCH_SIZE = 100
+
+
+class ProfileCache(object):
+
+    """Thread-safe LRU cache of profiles with a TTL
+
+    Parameters:
+        maxsize: The maximum number of cached profiles
+        ttl: How many seconds a profile is fresh for
+
+    Profiles are stored with the time they expire at. A profile of None
+    records that the steam id has no profile.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def get(self, steam_id):
+        """Return (profile, fresh) for a steam id
+
+        profile is None if the steam id isn't cached or has no profile.
+        """
+        with self._lock:
+            try:
+                (profile, expires) = self._profiles.pop(steam_id)
+            except KeyError:
+                return (None, False)
+            self._profiles[steam_id] = (profile, expires)
+        return (profile, time.time() < expires)
+
+    def set(self, steam_id, profile):
+        with self._lock:
+            self._store(steam_id, profile, time.time() + self.ttl)
+
+    def defer(self, steam_id, delay):
+        """Keep whatever is cached for a steam id fresh for delay seconds"""
+        with self._lock:
+            (profile, _) = self._profiles.get(steam_id, (None, 0))
+            self._store(steam_id, profile, time.time() + delay)
+
+    def _store(self, steam_id, profile, expires):
+        # called with the lock held
+        self._profiles.pop(steam_id, None)
+        self._profiles[steam_id] = (profile, expires)
+        while len(self._profiles) > self.maxsize:
+            self._profiles.popitem(last=False)
+
+
+class SteamProfiles(object):
+
+    """Steam profile lookups with a cache and a background refresher"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = None
+        self._pending = OrderedDict()
+        self._ready = threading.Condition()
+        self._listeners = []
+        self._pid = None
+        self._retry_delay = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault(
+            'STEAM_API_URL', 'http://api.steampowered.com/ISteamUser/'
+            'GetPlayerSummaries/v0002/')
+        app.config.setdefault('STEAM_API_TIMEOUT', 5)
+        app.config.setdefault('STEAM_PROFILE_TTL', 3600)
+        app.config.setdefault('STEAM_PROFILE_CACHE_SIZE', 10000)
+        app.config.setdefault('STEAM_RETRY_DELAY', 30)
+        app.config.setdefault('STEAM_RETRY_MAX_DELAY', 900)
+        self.app = app
+        self.cache = ProfileCache(app.config['STEAM_PROFILE_CACHE_SIZE'],
+                                  app.config['STEAM_PROFILE_TTL'])
+
+    def on_update(self, f):
+        """Register a function to call with each batch of fetched profiles
+
+        f is called from the refresher thread with a dict of steam id64 to
+        profile.
+        """
+        self._listeners.append(f)
+        return f
+
+    def fetch(self, steam_ids):
+        """Look up profiles from the Steam Web API, blocking
+
+        Returns a dict of steam id64 to profile. Steam ids which Steam
+        doesn't know about are left out, and cached as having no profile.
+        """
+        config = self.app.config
+        steam_ids = [int(steam_id) for steam_id in steam_ids]
+        profiles = {}
+        for i in range(0, len(steam_ids), BATCH_SIZE):
+            batch = steam_ids[i:i + BATCH_SIZE]
+            options = {
+                'key': config['STEAM_API_KEY'],
+                'steamids': ','.join(str(steam_id) for steam_id in batch),
+            }
+            url = '%s?%s' % (config['STEAM_API_URL'], url_encode(options))
+            response = urllib2.urlopen(url,
+                                       timeout=config['STEAM_API_TIMEOUT'])
+            try:
+                data = json.load(response)
+            finally:
+                response.close()
+            for profile in data['response']['players']:
+                profile_id = int(profile['steamid'])
+                profiles[profile_id] = profile
+                self.cache.set(profile_id, profile)
+            for steam_id in batch:
+                if steam_id not in profiles:
+                    self.cache.set(steam_id, None)
+        return profiles
+
+    def profile(self, steam_id):
+        """Return the cached profile for a steam id without blocking
+
+        Returns None if the profile isn't cached yet. Missing and expired
+        profiles are queued for the refresher.
+        """
+        steam_id = int(steam_id)
+        (profile, fresh) = self.cache.get(steam_id)
+        if not fresh:
+            self.request([steam_id])
+        return profile
+
+    def request(self, steam_ids):
+        """Queue steam ids for the background refresher
+
+        Nothing is queued if STEAM_API_KEY isn't set.
+        """
+        if not self.app.config['STEAM_API_KEY']:
+            return
+        with self._ready:
+            self._start()
+            for steam_id in steam_ids:
+                self._pending[int(steam_id)] = True
+            self._ready.notify()
+
+    def _start(self):
+        # the refresher is started lazily, so that it runs in the process
+        # serving requests and not in a parent which forks worker processes
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._pending:
+                    self._ready.wait()
+                steam_ids = []
+                while self._pending and len(steam_ids) < BATCH_SIZE:
+                    steam_ids.append(self._pending.popitem(last=False)[0])
+            try:
+                profiles = self.fetch(steam_ids)
+            except (urllib2.URLError, socket.error, ValueError,
+                    KeyError) as e:
+                self.app.logger.warning('Steam profile lookup failed: %s', e)
+                self._back_off(steam_ids)
+                continue
+            except Exception:
+                # e.g. httplib.BadStatusLine, this thread must keep running
+                self.app.logger.exception('Steam profile lookup failed')
+                self._back_off(steam_ids)
+                continue
+            self._retry_delay = 0
+            if not profiles:
+                continue
+            for f in self._listeners:
+                try:
+                    f(profiles)
+                except Exception:
+                    self.app.logger.exception('Steam profile listener failed')
+
+    def _back_off(self, steam_ids):
+        """Wait before the next lookup after a failed one
+
+        The failed ids are only queued again by requests for them once the
+        delay has passed.
+        """
+        config = self.app.config
+        self._retry_delay = min(
+            self._retry_delay * 2 or config['STEAM_RETRY_DELAY'],
+            config['STEAM_RETRY_MAX_DELAY'])
+        for steam_id in steam_ids:
+            self.cache.defer(steam_id, self._retry_delay)
+        time.sleep(self._retry_delay)
+
+
+profiles = SteamProfiles()
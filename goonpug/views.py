@@ -17,33 +17,51 @@
 
 from __future__ import absolute_import, division
 import re
-import urllib2
-from flask import g, session, json, flash, redirect, render_template, \
-    request, url_for, Markup, make_response
-from flask.ext.login import login_user, logout_user
+from flask import Blueprint, g, session, json, flash, redirect, \
+    render_template, request, url_for, Markup, make_response, jsonify, abort
+from flask.ext.login import LoginManager, UserMixin, login_user, logout_user
+from flask.ext.openid import OpenID
 from flask.ext.sqlalchemy import Pagination
-from werkzeug.urls import url_encode
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import select
+from sqlalchemy.util import KeyedTuple
+from openid.fetchers import setDefaultFetcher, Urllib2Fetcher
 from srcds import objects
 
-from . import app, db, oid, login_manager
-from .models import Frag, CsgoMatch, Player, PlayerOverallStatsSummary
+from . import db, generation
+from .models import CsgoMatch, Player, PlayerOverallStatsSummary, \
+    PlayerProfile, StatsDimension
+from .pool import pool_status
+from .routing import primary
+from .steam import profiles
 
 _steam_id_re = re.compile('steamcommunity.com/openid/id/(.*?)$')
 
+views = Blueprint('views', __name__)
+login_manager = LoginManager()
+oid = OpenID()
+
+
+def init_views(app):
+    """Set up the login extensions and register the views on app"""
+    login_manager.init_app(app)
+    setDefaultFetcher(Urllib2Fetcher())
+    oid.init_app(app)
+    profiles.init_app(app)
+    app.register_blueprint(views)
+
 
 def url_for_other_page(page):
     args = request.view_args.copy()
     args['page'] = page
     return url_for(request.endpoint, **args)
-app.jinja_env.globals['url_for_other_page'] = url_for_other_page
+views.add_app_template_global(url_for_other_page, 'url_for_other_page')
 
 
 def url_for_other(**kwargs):
     args = request.view_args.copy()
     args.update(kwargs)
     return url_for(request.endpoint, **args)
-app.jinja_env.globals['url_for_other'] = url_for_other
+views.add_app_template_global(url_for_other, 'url_for_other')
 
 
 def sortable_th(display, title="", column_name=""):
@@ -69,38 +87,170 @@ def sortable_th(display, title="", column_name=""):
     return Markup('<th><a href="%s" rel="tooltip" title="%s">'
                   '<i class="%s"></i> %s</a></th>'
                   % (url, title, ico, display))
-app.jinja_env.globals['sortable_th'] = sortable_th
+views.add_app_template_global(sortable_th, 'sortable_th')
+
+
+def _window_functions(bind):
+    """Return whether a database supports COUNT(*) OVER ()"""
+    dialect = bind.dialect
+    if dialect.server_version_info is None:
+        # only known once the engine has connected
+        bind.connect().close()
+    version = dialect.server_version_info
+    if dialect.name == 'sqlite':
+        return version >= (3, 25)
+    elif dialect.name == 'mysql':
+        if 'MariaDB' in version:
+            # older MariaDB servers report themselves as 5.5.5-10.x
+            if version[:3] == (5, 5, 5) and isinstance(version[3], int):
+                version = version[3:]
+            return version >= (10, 2)
+        return version >= (8, 0)
+    return dialect.name == 'postgresql'
+
+
+class _CountQuery(object):
+
+    """A count query which compares equal to others with the same SQL
+
+    Used as the generation.cached key for paginate()'s totals.
+    """
+
+    def __init__(self, query):
+        self.statement = select([db.func.count()]).select_from(
+            query.order_by(None).subquery())
+        compiled = self.statement.compile(bind=query.session.get_bind())
+        self.key = (unicode(compiled),
+                    tuple(sorted(compiled.params.items())))
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __repr__(self):
+        return repr(self.key)
+
+
+@generation.cached
+def _count(count_query):
+    return db.session.execute(count_query.statement).scalar()
+
+
+def paginate(query, page, per_page):
+    """Return a Pagination of one page of a query's results
+
+    The total is fetched along with the page as a COUNT(*) OVER () column,
+    so the query (usually a large aggregate over every match) is only run
+    once. Databases without window functions (MySQL before 8.0) instead
+    count the query once per data generation, as does a page past the
+    last one, which has no rows to carry the total.
+    """
+    offset = (page - 1) * per_page
+    if not _window_functions(query.session.get_bind()):
+        total = _count(_CountQuery(query))
+        items = query.limit(per_page).offset(offset).all()
+        return Pagination(query, page, per_page, total, items)
+    rows = query.add_columns(
+        db.func.count().over().label('pagination_total')
+    ).limit(per_page).offset(offset).all()
+    if rows:
+        total = rows[0][-1]
+        if len(query.column_descriptions) == 1 and \
+                query.column_descriptions[0]['expr'] is \
+                query.column_descriptions[0]['type']:
+            # a query for a single mapped class
+            items = [row[0] for row in rows]
+        else:
+            items = [KeyedTuple(row[:-1], row.keys()[:-1]) for row in rows]
+    else:
+        total = _count(_CountQuery(query)) if page > 1 else 0
+        items = []
+    return Pagination(query, page, per_page, total, items)
 
 
+@generation.cached
 def last_updated():
-    (last_updated,) = db.session.query(CsgoMatch.end_time) \
-        .order_by(db.desc('end_time')).first()
+    last_updated = db.session.query(db.func.max(CsgoMatch.end_time)).scalar()
+    if last_updated is None:
+        return u''
     return last_updated.strftime(u'%Y-%m-%d %H:%M:%S %Z')
-app.jinja_env.globals['last_updated'] = last_updated
+views.add_app_template_global(last_updated, 'last_updated')
+
+
+views.add_app_template_global(profiles.profile, 'steam_profile')
+
+
+def refresh_renamed(player_ids):
+    """Refresh the stored copies of renamed players' nicknames
+
+    Summaries and profile documents hold the player's nickname too. Only
+    the ones which already exist are refreshed.
+    """
+    PlayerOverallStatsSummary._refresh_stats([
+        player_id for (player_id,) in db.session.query(
+            PlayerOverallStatsSummary.player_id).filter(
+            PlayerOverallStatsSummary.player_id.in_(player_ids))])
+    PlayerProfile._refresh_profiles([
+        player_id for (player_id,) in db.session.query(
+            PlayerProfile.player_id).filter(
+            PlayerProfile.player_id.in_(player_ids))])
+
+
+@profiles.on_update
+def update_nicknames(steam_profiles):
+    """Store the Steam persona names of players with fetched profiles"""
+    with profiles.app.app_context():
+        players = Player.query.filter(
+            Player.steam_id.in_(steam_profiles.keys()))
+        renamed = []
+        for player in players:
+            nickname = steam_profiles[player.steam_id]['personaname']
+            if player.nickname != nickname:
+                player.nickname = nickname
+                renamed.append(player.id)
+        db.session.commit()
+        if renamed:
+            refresh_renamed(renamed)
+            generation.bump()
+
+
+@views.route('/')
+def index():
+    return render_template('index.html')
 
 
-def get_steam_userinfo(steam_id):
-    options = {
-        'key': app.config['STEAM_API_KEY'],
-        'steamids': steam_id
-    }
-    url = 'http://api.steampowered.com/ISteamUser/' \
-          'GetPlayerSummaries/v0002/?%s' % url_encode(options)
-    retval = json.load(urllib2.urlopen(url))
-    return retval['response']['players'][0] or {}
+class SessionUser(UserMixin):
 
+    """Lightweight copy of a logged in Player
+
+    These are cached per process between requests (see session_user()), so
+    they are never attached to a database session.
+    """
+
+    def __init__(self, player):
+        self.id = player.id
+        self.steam_id = player.steam_id
+        self.nickname = player.nickname
+        self.role = player.role
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+
+@generation.cached
+def session_user(user_id):
+    player = Player.query.get(user_id)
+    if player is None:
+        return None
+    return SessionUser(player)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return Player.query.get(int(user_id))
+    return session_user(int(user_id))
 
 
-@app.route('/login')
+@views.route('/login')
+@primary
 @oid.loginhandler
 def login():
     if g.user is not None and g.user.is_authenticated():
@@ -112,88 +262,119 @@ def login():
 def create_or_login(resp):
     match = _steam_id_re.search(resp.identity_url)
     g.user = Player.get_or_create(int(match.group(1)))
-    steam_data = get_steam_userinfo(g.user.steam_id)
-    g.user.nickname = steam_data['personaname']
-    db.session.commit()
+    # never wait for Steam here, the nickname is updated by update_nicknames
+    # once the profile has been fetched
+    steam_data = profiles.profile(g.user.steam_id)
+    if steam_data and g.user.nickname != steam_data['personaname']:
+        g.user.nickname = steam_data['personaname']
+        db.session.commit()
+        refresh_renamed([g.user.id])
+        generation.bump()
+    else:
+        db.session.commit()
     login_user(g.user)
     flash(u'You are now logged in')
     return redirect(oid.get_next_url())
 
 
-@app.before_request
+@views.before_app_request
 def before_request():
     g.user = None
     if 'user_id' in session:
-        g.user = Player.query.get(session['user_id'])
+        g.user = session_user(int(session['user_id']))
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     flash(u'You are now logged out')
     logout_user()
     return redirect(oid.get_next_url())
 
 
-@app.route('/player/<int:player_id>')
+@views.route('/status/pool')
+def status_pool():
+    if g.user is None or g.user.role != Player.ROLE_ADMIN:
+        abort(404)
+    return jsonify(pool_status())
+
+
+@views.route('/player/<int:player_id>')
+@generation.conditional
 def player(player_id=None):
     if player_id:
-        g.player = Player.query.get(player_id)
-        query = db.session.query(PlayerOverallStatsSummary) \
-            .filter_by(player_id=player_id)
-        try:
-            g.stats = query.one()
-        except NoResultFound:
+        g.player = PlayerProfile.load(player_id)
+        if g.player is not None:
+            g.stats = g.player['summary']
+        else:
+            # players who have never finished a match have no profile
+            g.player = Player.query.get(player_id)
             g.stats = None
     return render_template('player.html')
 
 
-@app.route('/stats/')
-def stats():
+@generation.cached
+def dimension_values(kind):
+    """Return every map or weapon name, for the stats menus"""
+    return StatsDimension.values(kind)
+
+
+@generation.cached
+def leaderboards():
+    """Return the leaderboards shown on /stats/"""
+    leaders = {}
     subquery = db.session.query(PlayerOverallStatsSummary).filter(
         PlayerOverallStatsSummary.rounds_played >= 100).subquery()
-    g.rws_leaders = db.session.query(
+    leaders['rws_leaders'] = db.session.query(
         subquery.c.nickname,
         subquery.c.player_id,
         subquery.c.rws
     ).order_by(
         db.desc('rws')
     ).limit(5).all()
-    g.kdr_leaders = db.session.query(
+    leaders['kdr_leaders'] = db.session.query(
         subquery.c.nickname,
         subquery.c.player_id,
         subquery.c.kdr
     ).order_by(
         db.desc('kdr')
     ).limit(5).all()
-    g.ace_leaders = db.session.query(
+    leaders['ace_leaders'] = db.session.query(
         subquery.c.nickname,
         subquery.c.player_id,
         subquery.c.k5
     ).filter('k5 > 0').order_by(
         db.desc('k5')
     ).limit(5).all()
-    maps = db.session.query(CsgoMatch.map).distinct().order_by('map')
-    g.map_leaders = []
-    for (mapname,) in maps:
+    leaders['map_leaders'] = []
+    for mapname in dimension_values(StatsDimension.KIND_MAP):
         leader = Player.map_stats(mapname=mapname) \
             .order_by(db.desc('rws')).first()
-        g.map_leaders.append((mapname, leader))
+        leaders['map_leaders'].append((mapname, leader))
     weapons = ['ak47', 'm4a1', 'awp', 'glock', 'hkp2000', 'p250', 'deagle',
                'knife', 'taser']
-    g.weapon_leaders = []
+    leaders['weapon_leaders'] = []
     for weapon in weapons:
         leader = Player.weapon_kill_stats(weapon=weapon) \
             .order_by(db.desc('frags')).first()
-        g.weapon_leaders.append((weapon, leader))
+        leaders['weapon_leaders'].append((weapon, leader))
+    return leaders
+
+
+@views.route('/stats/')
+@generation.conditional
+def stats():
+    for (name, leaders) in leaderboards().items():
+        setattr(g, name, leaders)
     return render_template('stats.html')
 
 
-@app.route('/stats/player/')
-@app.route('/stats/player/<int:page>')
-@app.route('/stats/player/sort/<sort_by>/')
-@app.route('/stats/player/sort/<sort_by>/<int:page>')
-@app.route('/stats/player/sort/<sort_by>/order/<sort_order>/')
-@app.route('/stats/player/sort/<sort_by>/order/<sort_order>/<int:page>')
+@views.route('/stats/player/')
+@views.route('/stats/player/<int:page>')
+@views.route('/stats/player/sort/<sort_by>/')
+@views.route('/stats/player/sort/<sort_by>/<int:page>')
+@views.route('/stats/player/sort/<sort_by>/order/<sort_order>/')
+@views.route('/stats/player/sort/<sort_by>/order/<sort_order>/<int:page>')
+@generation.conditional
 def stats_player(page=1, sort_by='rws', sort_order='desc'):
     query = db.session.query(PlayerOverallStatsSummary).filter(
         PlayerOverallStatsSummary.rounds_played >= 100)
@@ -202,58 +383,57 @@ def stats_player(page=1, sort_by='rws', sort_order='desc'):
         query = query.order_by(db.asc(sort_by))
     else:
         query = query.order_by(db.desc(sort_by))
-    total = query.count()
-    items = query.limit(per_page).offset((page - 1) * per_page).all()
-    g.pagination = Pagination(query, page, per_page, total, items)
+    g.pagination = paginate(query, page, per_page)
     return render_template('stats_player.html')
 
 
-@app.route('/stats/map/')
-@app.route('/stats/map/<int:page>')
-@app.route('/stats/map/sort/<sort_by>/')
-@app.route('/stats/map/sort/<sort_by>/<int:page>')
-@app.route('/stats/map/sort/<sort_by>/order/<sort_order>/')
-@app.route('/stats/map/sort/<sort_by>/order/<sort_order>/<int:page>')
-@app.route('/stats/map/<mapname>/')
-@app.route('/stats/map/<mapname>/<int:page>')
-@app.route('/stats/map/<mapname>/sort/<sort_by>/')
-@app.route('/stats/map/<mapname>/sort/<sort_by>/<int:page>')
-@app.route('/stats/map/<mapname>/sort/<sort_by>/order/<sort_order>/')
-@app.route('/stats/map/<mapname>/sort/<sort_by>/order/<sort_order>/<int:page>')
+@views.route('/stats/map/')
+@views.route('/stats/map/<int:page>')
+@views.route('/stats/map/sort/<sort_by>/')
+@views.route('/stats/map/sort/<sort_by>/<int:page>')
+@views.route('/stats/map/sort/<sort_by>/order/<sort_order>/')
+@views.route('/stats/map/sort/<sort_by>/order/<sort_order>/<int:page>')
+@views.route('/stats/map/<mapname>/')
+@views.route('/stats/map/<mapname>/<int:page>')
+@views.route('/stats/map/<mapname>/sort/<sort_by>/')
+@views.route('/stats/map/<mapname>/sort/<sort_by>/<int:page>')
+@views.route('/stats/map/<mapname>/sort/<sort_by>/order/<sort_order>/')
+@views.route('/stats/map/<mapname>/sort/<sort_by>/order/<sort_order>/'
+             '<int:page>')
+@generation.conditional
 def stats_map(mapname='', page=1, sort_by='rws', sort_order='desc'):
-    g.maps = db.session.query(CsgoMatch.map).distinct().order_by('map')
+    g.maps = dimension_values(StatsDimension.KIND_MAP)
     if not mapname and g.maps:
-        (mapname,) = g.maps[0]
+        mapname = g.maps[0]
     query = Player.map_stats(mapname=mapname)
     per_page = 20
     if sort_order == 'asc':
         query = query.order_by(db.asc(sort_by))
     else:
         query = query.order_by(db.desc(sort_by))
-    total = query.count()
-    items = query.limit(per_page).offset((page - 1) * per_page).all()
-    g.pagination = Pagination(query, page, per_page, total, items)
+    g.pagination = paginate(query, page, per_page)
     g.mapname = mapname
     return render_template('stats_map.html')
 
 
-@app.route('/stats/weapon/')
-@app.route('/stats/weapon/<int:page>')
-@app.route('/stats/weapon/sort/<sort_by>/')
-@app.route('/stats/weapon/sort/<sort_by>/<int:page>')
-@app.route('/stats/weapon/sort/<sort_by>/order/<sort_order>/')
-@app.route('/stats/weapon/sort/<sort_by>/order/<sort_order>/<int:page>')
-@app.route('/stats/weapon/<weapon>/')
-@app.route('/stats/weapon/<weapon>/<int:page>')
-@app.route('/stats/weapon/<weapon>/sort/<sort_by>/')
-@app.route('/stats/weapon/<weapon>/sort/<sort_by>/<int:page>')
-@app.route('/stats/weapon/<weapon>/sort/<sort_by>/order/<sort_order>/')
-@app.route('/stats/weapon/<weapon>/sort/<sort_by>/order/<sort_order>/'
-           '<int:page>')
+@views.route('/stats/weapon/')
+@views.route('/stats/weapon/<int:page>')
+@views.route('/stats/weapon/sort/<sort_by>/')
+@views.route('/stats/weapon/sort/<sort_by>/<int:page>')
+@views.route('/stats/weapon/sort/<sort_by>/order/<sort_order>/')
+@views.route('/stats/weapon/sort/<sort_by>/order/<sort_order>/<int:page>')
+@views.route('/stats/weapon/<weapon>/')
+@views.route('/stats/weapon/<weapon>/<int:page>')
+@views.route('/stats/weapon/<weapon>/sort/<sort_by>/')
+@views.route('/stats/weapon/<weapon>/sort/<sort_by>/<int:page>')
+@views.route('/stats/weapon/<weapon>/sort/<sort_by>/order/<sort_order>/')
+@views.route('/stats/weapon/<weapon>/sort/<sort_by>/order/<sort_order>/'
+             '<int:page>')
+@generation.conditional
 def stats_weapon(weapon='', page=1, sort_by='frags', sort_order='desc'):
-    g.weapons = db.session.query(Frag.weapon).distinct().order_by('weapon')
+    g.weapons = dimension_values(StatsDimension.KIND_WEAPON)
     if not weapon and g.weapons:
-        (weapon,) = g.weapons[0]
+        weapon = g.weapons[0]
     if sort_by == 'deaths':
         query = Player.weapon_death_stats(weapon=weapon)
     else:
@@ -263,8 +443,6 @@ def stats_weapon(weapon='', page=1, sort_by='frags', sort_order='desc'):
         query = query.order_by(db.asc(sort_by))
     else:
         query = query.order_by(db.desc(sort_by))
-    total = query.count()
-    items = query.limit(per_page).offset((page - 1) * per_page).all()
-    g.pagination = Pagination(query, page, per_page, total, items)
+    g.pagination = paginate(query, page, per_page)
     g.weapon = weapon
     return render_template('stats_weapon.html')
@@ -2,24 +2,174 @@
 """GoonPUG-stats log handling daemon"""
 
 from __future__ import absolute_import, division
+import os
 import sys
+import json
+import time
+import hashlib
 import argparse
 import multiprocessing
 import SocketServer
+import threading
 import re
+from collections import namedtuple, deque, OrderedDict
 import srcds.events.generic as generic_events
 import srcds.events.csgo as csgo_events
-from srcds.objects import BasePlayer
-from Queue import Empty
+from srcds.objects import SteamId
+from Queue import Empty, Full
 from daemon import Daemon
 
-from goonpug import db
+from goonpug import create_app, db, generation, live
+from goonpug.logreader import iter_blocks, read_blocks, line_spans, \
+    split_block, DirectoryWatcher, BLOCK_SIZE
+from goonpug.pool import after_fork, pool_status
 from goonpug.models import CsgoMatch, Round, Player, PlayerRound, Frag, \
-    match_players, Server, Attack, PlayerOverallStatsSummary
+    match_players, Server, Attack, PlayerOverallStatsSummary, PlayerProfile, \
+    StatsDimension
 
 
-class GoonPugPlayer(BasePlayer):
-    pass
+# the most log lines buffered for a single server before new ones are dropped
+SERVER_QUEUE_SIZE = 10000
+# the most lines handed to one server's parser before moving on to the next
+DISPATCH_BATCH = 100
+# niceness of the background summary refresh process
+SUMMARY_NICE = 10
+# live match state is published at the start and end of every round, and
+# at most this often (in seconds) as players are killed mid round
+LIVE_PUBLISH_INTERVAL = 1.0
+# parse workers (goonpugd -j) are handed chunks of about this many bytes of
+# log lines, with up to PARSE_CHUNKS_IN_FLIGHT chunks per worker queued
+PARSE_CHUNK_SIZE = 64 << 10
+PARSE_CHUNKS_IN_FLIGHT = 4
+
+
+class GoonPugPlayer(object):
+
+    """Live state for a player on the server
+
+    The 64-bit steam id is computed once when the player joins, and the
+    player's database id is looked up the first time it is needed. team is
+    the side the player is currently on, match_team is the CsgoMatch team
+    the player is playing for in the current match.
+
+    team, alive and dropped must only be changed through the PlayerRoster,
+    which keeps track of who is alive on each side.
+    """
+
+    __slots__ = ('slot', 'name', 'uid', 'id64', 'player_id', 'team',
+                 'match_team', 'dropped', 'alive', 'health', 'damage',
+                 'assists', 'rws', 'bomb_defused', 'bomb_planted', 'won_1v')
+
+    def __init__(self, slot, name, uid, id64):
+        self.slot = slot
+        self.name = name
+        self.uid = uid
+        self.id64 = id64
+        self.player_id = None
+        self.team = u''
+        self.match_team = None
+        self.dropped = False
+        self.reset_round()
+
+    def reset_round(self):
+        # count drops and spectators as alive since we don't want to record
+        # them as dead at the end of a round
+        self.alive = True
+        self.health = 100
+        self.damage = 0
+        self.assists = 0
+        self.rws = 0.0
+        self.bomb_defused = False
+        self.bomb_planted = False
+        self.won_1v = 0
+
+
+class PlayerRoster(object):
+
+    """The players on a server, by slot and by 64-bit steam id
+
+    Slots are small integers which are reused when players leave, so the
+    roster stays as small as the server. The players on each side, and the
+    ones still alive, are kept up to date as their state changes so that
+    they can be counted without scanning the roster.
+    """
+
+    SIDES = (u'TERRORIST', u'CT')
+
+    def __init__(self):
+        self.slots = []
+        self.by_id64 = {}
+        self._free = []
+        self.sides = dict((side, set()) for side in self.SIDES)
+        self.live = dict((side, set()) for side in self.SIDES)
+
+    def __len__(self):
+        return len(self.by_id64)
+
+    def __contains__(self, id64):
+        return id64 in self.by_id64
+
+    def __getitem__(self, id64):
+        return self.by_id64[id64]
+
+    def __iter__(self):
+        for player in self.slots:
+            if player is not None:
+                yield player
+
+    def add(self, name, uid, id64):
+        """Add a player and return its GoonPugPlayer"""
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self.slots)
+            self.slots.append(None)
+        player = GoonPugPlayer(slot, name, uid, id64)
+        self.slots[slot] = player
+        self.by_id64[player.id64] = player
+        return player
+
+    def remove(self, id64):
+        player = self.by_id64.pop(id64)
+        self._unplace(player)
+        self.slots[player.slot] = None
+        self._free.append(player.slot)
+
+    def _place(self, player):
+        if player.team in self.sides:
+            self.sides[player.team].add(player)
+            if player.alive and not player.dropped:
+                self.live[player.team].add(player)
+
+    def _unplace(self, player):
+        if player.team in self.sides:
+            self.sides[player.team].discard(player)
+            self.live[player.team].discard(player)
+
+    def update(self, player, **kwargs):
+        """Change a player's team, alive or dropped attributes"""
+        self._unplace(player)
+        for (name, value) in kwargs.items():
+            setattr(player, name, value)
+        self._place(player)
+
+    def kill(self, player):
+        player.alive = False
+        if player.team in self.live:
+            self.live[player.team].discard(player)
+
+    def reset_round(self, player=None):
+        """Reset the round state of one player, or of every player"""
+        if player is not None:
+            self._unplace(player)
+            player.reset_round()
+            self._place(player)
+            return
+        for player in self:
+            player.reset_round()
+        for side in self.SIDES:
+            self.live[side] = set(player for player in self.sides[side]
+                                  if not player.dropped)
 
 
 class GoonPugActionEvent(generic_events.BaseEvent):
@@ -40,14 +190,241 @@ class GoonPugActionEvent(generic_events.BaseEvent):
         return ' '.join([super(GoonPugActionEvent, self).__unicode__(), msg])
 
 
+_id64s = {}
+
+
+def steam_id64(steam_id):
+    """Return the SteamID64 for a STEAM_X:Y:Z string"""
+    try:
+        return _id64s[steam_id]
+    except KeyError:
+        id64 = _id64s[steam_id] = SteamId(steam_id).id64()
+        return id64
+
+
+# The srcds event classes build BasePlayer and SteamId objects for every
+# player in every line. The events below are plain tuples holding just the
+# fields goonpugd uses, for the event types that make up almost all of a
+# match log. They match the same regexes as the srcds events they replace,
+# and only look at their own match groups, so they can be matched directly
+# against a block of lines.
+
+class AttackEvent(namedtuple('AttackEvent', [
+        'timestamp', 'player_id64', 'player_team', 'target_id64',
+        'target_team', 'weapon', 'damage', 'damage_armor', 'health',
+        'hitgroup'])):
+
+    __slots__ = ()
+    regex = csgo_events.CsgoAttackEvent.regex
+
+    @classmethod
+    def from_re_match(cls, match):
+        (timestamp, player_steam_id, player_team, target_steam_id,
+         target_team, weapon, damage, damage_armor, health,
+         hitgroup) = match.group(
+            'timestamp', 'player_steam_id', 'player_team', 'target_steam_id',
+            'target_team', 'weapon', 'damage', 'damage_armor', 'health',
+            'hitgroup')
+        return cls(timestamp, steam_id64(player_steam_id), player_team,
+                   steam_id64(target_steam_id), target_team, weapon,
+                   int(damage), int(damage_armor), int(health), hitgroup)
+
+    def __unicode__(self):
+        return u'L %s: %s attacked %s with "%s" (damage "%d") (health "%d")' \
+            % (self.timestamp, self.player_id64, self.target_id64,
+               self.weapon, self.damage, self.health)
+
+
+class KillEvent(namedtuple('KillEvent', [
+        'timestamp', 'player_id64', 'player_team', 'target_id64',
+        'target_team', 'weapon', 'headshot'])):
+
+    __slots__ = ()
+    regex = csgo_events.CsgoKillEvent.regex
+
+    @classmethod
+    def from_re_match(cls, match):
+        (timestamp, player_steam_id, player_team, target_steam_id,
+         target_team, weapon) = match.group(
+            'timestamp', 'player_steam_id', 'player_team', 'target_steam_id',
+            'target_team', 'weapon')
+        return cls(timestamp, steam_id64(player_steam_id), player_team,
+                   steam_id64(target_steam_id), target_team, weapon,
+                   match.group(match.re.groups) is not None)
+
+    def __unicode__(self):
+        msg = u'L %s: %s killed %s with "%s"' % (
+            self.timestamp, self.player_id64, self.target_id64, self.weapon)
+        if self.headshot:
+            msg += u' (headshot)'
+        return msg
+
+
+class AssistEvent(namedtuple('AssistEvent', [
+        'timestamp', 'player_id64', 'target_id64'])):
+
+    __slots__ = ()
+    regex = csgo_events.CsgoAssistEvent.regex
+
+    @classmethod
+    def from_re_match(cls, match):
+        (timestamp, player_steam_id, target_steam_id) = match.group(
+            'timestamp', 'player_steam_id', 'target_steam_id')
+        return cls(timestamp, steam_id64(player_steam_id),
+                   steam_id64(target_steam_id))
+
+    def __unicode__(self):
+        return u'L %s: %s assisted killing %s' % (
+            self.timestamp, self.player_id64, self.target_id64)
+
+
+class SwitchTeamEvent(namedtuple('SwitchTeamEvent', [
+        'timestamp', 'player_name', 'uid', 'id64', 'orig_team',
+        'new_team'])):
+
+    __slots__ = ()
+    regex = csgo_events.SwitchTeamEvent.regex
+
+    @classmethod
+    def from_re_match(cls, match):
+        (timestamp, player_name, uid, steam_id, orig_team,
+         new_team) = match.group('timestamp', 'player_name', 'uid',
+                                 'steam_id', 'orig_team', 'new_team')
+        return cls(timestamp, player_name, uid, steam_id64(steam_id),
+                   orig_team, new_team)
+
+    def __unicode__(self):
+        return u'L %s: "%s<%s><%s>" switched from team <%s> to <%s>' % (
+            self.timestamp, self.player_name, self.uid, self.id64,
+            self.orig_team, self.new_team)
+
+
+# Event types in the order their regexes are tried
+EVENT_TYPES = [
+    AttackEvent,
+    KillEvent,
+    AssistEvent,
+    SwitchTeamEvent,
+    generic_events.LogFileEvent,
+    generic_events.ChangeMapEvent,
+    generic_events.EnterGameEvent,
+    generic_events.SuicideEvent,
+    generic_events.DisconnectionEvent,
+    generic_events.KickEvent,
+    generic_events.PlayerActionEvent,
+    generic_events.TeamActionEvent,
+    generic_events.WorldActionEvent,
+    generic_events.RoundEndTeamEvent,
+    GoonPugActionEvent,
+]
+
+# events which can be built from a match against a whole block of lines
+BLOCK_EVENTS = (AttackEvent, KillEvent, AssistEvent, SwitchTeamEvent)
+
+_event_types = None
+
+
+def compile_event_types(event_types=EVENT_TYPES):
+    """Return a list of (compiled regex, event class) tuples
+
+    Regexes are compiled with re.MULTILINE so that their leading ^ also
+    matches at the start of each line in a block.
+    """
+    return [(re.compile(cls.regex, re.MULTILINE), cls)
+            for cls in event_types]
+
+
+def parse_event(event_types, block, pos=0, endpos=None):
+    """Return the event for a log line, or None if it isn't one we handle
+
+    Parameters:
+        event_types: A list from compile_event_types()
+        block: A string (or memory mapped file) holding the line
+        pos, endpos: The offsets of the stripped line in block
+    """
+    if endpos is None:
+        endpos = len(block)
+    if pos > 0 and block[pos - 1] != '\n':
+        # the line was indented, and ^ only matches after a newline, not
+        # at pos, so match the stripped line on its own
+        block = block[pos:endpos]
+        pos = 0
+        endpos = len(block)
+    for (regex, cls) in event_types:
+        match = regex.match(block, pos, endpos)
+        if match:
+            if not issubclass(cls, BLOCK_EVENTS):
+                # srcds events look at match.string, which has to be the
+                # line itself
+                match = regex.match(block[pos:endpos])
+            return cls.from_re_match(match)
+    return None
+
+
+def parse_block(event_types, block):
+    """Yield the events for every line in a block of lines"""
+    for (pos, endpos) in line_spans(block):
+        event = parse_event(event_types, block, pos, endpos)
+        if event is not None:
+            yield event
+
+
+def parse_chunk(block):
+    """Parse a block of log lines into a list of events
+
+    This is the stateless half of log parsing, and runs in parse worker
+    processes.
+    """
+    global _event_types
+    if _event_types is None:
+        _event_types = compile_event_types()
+    return list(parse_block(_event_types, block))
+
+
+def parse_parallel(blocks, jobs, chunk_size=PARSE_CHUNK_SIZE):
+    """Parse blocks of log lines with a pool of worker processes
+
+    Blocks are split into chunks of about chunk_size bytes, so that the
+    work is spread over every worker even for short logs and the first
+    events arrive quickly. Events are yielded in log order. At most
+    PARSE_CHUNKS_IN_FLIGHT chunks per worker are in flight, so memory use
+    does not grow with the size of the log.
+    """
+    pool = multiprocessing.Pool(jobs)
+    pending = deque()
+    try:
+        for block in blocks:
+            for chunk in split_block(block, chunk_size):
+                pending.append(pool.apply_async(parse_chunk, (chunk,)))
+                if len(pending) >= jobs * PARSE_CHUNKS_IN_FLIGHT:
+                    for event in pending.popleft().get():
+                        yield event
+        while pending:
+            for event in pending.popleft().get():
+                yield event
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class GoonPugParser(object):
 
     """GoonPUG log parser class"""
 
-    def __init__(self, server_address, verbose=False, force=False):
+    def __init__(self, server_address, verbose=False, force=False,
+                 summaryq=None):
         self.verbose = verbose
         self.force = force
         self.eventq = multiprocessing.Queue(100)
+        # player ids whose summaries need refreshing are handed to
+        # refresh_summaries() through this queue when it is set
+        self.summaryq = summaryq
+        self.server_address = server_address
+        self.live_published = 0
+        # (kind, value) pairs known to be in StatsDimension, loaded when
+        # the first match is stored
+        self.dimensions = None
         self.event_handlers = {
             generic_events.LogFileEvent: self.handle_log_file,
             generic_events.ChangeMapEvent: self.handle_change_map,
@@ -59,10 +436,10 @@ class GoonPugParser(object):
             generic_events.TeamActionEvent: self.handle_team_action,
             generic_events.WorldActionEvent: self.handle_world_action,
             generic_events.RoundEndTeamEvent: self.handle_round_end_team,
-            csgo_events.CsgoKillEvent: self.handle_kill,
-            csgo_events.CsgoAttackEvent: self.handle_attack,
-            csgo_events.CsgoAssistEvent: self.handle_assist,
-            csgo_events.SwitchTeamEvent: self.handle_switch_team,
+            KillEvent: self.handle_kill,
+            AttackEvent: self.handle_attack,
+            AssistEvent: self.handle_assist,
+            SwitchTeamEvent: self.handle_switch_team,
             GoonPugActionEvent: self.handle_goonpug_action,
         }
         self._compile_regexes()
@@ -71,33 +448,44 @@ class GoonPugParser(object):
         db.session.commit()
         self.match = None
         self.round = None
-        self.players = {}
+        self.match_rounds = []
+        self.players = PlayerRoster()
 
     def _compile_regexes(self):
         """Add event types"""
-        self.event_types = []
-        for cls in self.event_handlers.keys():
-            regex = re.compile(cls.regex)
-            self.event_types.append((regex, cls))
+        self.event_types = compile_event_types(
+            [cls for cls in EVENT_TYPES if cls in self.event_handlers])
 
     def parse_line(self, line):
         """Parse a single log line"""
-        line = line.strip()
-        for (regex, cls) in self.event_types:
-            match = regex.match(line)
-            if match:
-                event = cls.from_re_match(match)
-                self.eventq.put(event)
-                return
+        event = parse_event(self.event_types, line.strip())
+        if event is not None:
+            self.eventq.put(event)
 
-    def read(self, filename):
-        """Read in a log file"""
-        fd = open(filename)
-        for line in fd.readlines():
-            self.parse_line(line)
-        fd.close()
+    def parse_blocks(self, blocks, jobs=1):
+        """Parse blocks of complete log lines
+
+        Parameters:
+            blocks: An iterable of blocks from goonpug.logreader
+            jobs: If greater than 1, the number of worker processes used
+                to parse lines. Events are still handled in log order by
+                process_events.
+        """
+        if jobs > 1:
+            events = parse_parallel(blocks, jobs)
+        else:
+            events = (event for block in blocks
+                      for event in parse_block(self.event_types, block))
+        for event in events:
+            self.eventq.put(event)
+
+    def read(self, filename, jobs=1):
+        """Read in a (possibly gzip or bz2 compressed) log file"""
+        self.parse_blocks(read_blocks(filename, use_mmap=(jobs <= 1)),
+                          jobs=jobs)
 
     def process_events(self):
+        after_fork()
         while not self.eventq._closed:
             event = None
             try:
@@ -108,125 +496,274 @@ class GoonPugParser(object):
                 pass
 
     def _abandon_match(self):
-        db.session.rollback()
+        # nothing is written to the database until the match ends
         if self.match:
-            match = db.session.query(CsgoMatch).get(self.match.id)
-            if match:
-                db.session.delete(match)
-                db.session.expunge(self.match)
-                db.session.commit()
+            live.clear(self.server_address)
         self.match = None
         self.round = None
+        self.match_rounds = []
 
     def _start_match(self, timestamp):
-        # If this match exists already, delete the existing one
-        match = CsgoMatch.query.filter_by(server_id=self.server.id,
-                                          start_time=timestamp).first()
-        if match:
-            if self.force:
-                db.session.delete(match)
-                db.session.commit()
-            else:
-                self.match = None
-                return
+        # The match is kept in memory (self.match is never added to the
+        # session) and only written to the database once it has ended
         self.match = CsgoMatch()
         # we only support pugs right now
         self.match.type = CsgoMatch.TYPE_PUG
         self.match.map = self.mapname
         self.match.server_id = self.server.id
         self.match.start_time = timestamp
-        db.session.add(self.match)
-        db.session.commit()
+        self.match_rounds = []
         self.team_a = set()
         self.team_b = set()
-        for player in self.players.values():
+        for player in self.players:
+            player.match_team = None
             if player.team == u'TERRORIST':
-                self.team_a.add(player.steam_id.id64())
+                self._join_team(player, CsgoMatch.TEAM_A)
             elif player.team == u'CT':
-                self.team_b.add(player.steam_id.id64())
+                self._join_team(player, CsgoMatch.TEAM_B)
         self.period = 1
         self.t_score = 0
         self.ct_score = 0
         self.round = None
+        self._publish_live()
 
     def _end_match(self, event):
-        self._commit_round()
+        if self.round:
+            self._commit_round()
         self.match.end_time = event.timestamp
-        db.session.commit()
-        for steam_id in self.team_a:
-            player = Player.query.filter_by(steam_id=steam_id).first()
-            db.session.execute(match_players.insert().values(
-                player_id=player.id,
-                match_id=self.match.id,
-                team=CsgoMatch.TEAM_A,
-            ))
-            PlayerOverallStatsSummary._update_stats(player.id)
-        for steam_id in self.team_b:
-            player = Player.query.filter_by(steam_id=steam_id).first()
-            db.session.execute(match_players.insert().values(
-                player_id=player.id,
-                match_id=self.match.id,
-                team=CsgoMatch.TEAM_A,
-            ))
-            PlayerOverallStatsSummary._update_stats(player.id)
+        steam_ids = self.team_a | self.team_b
+        players = []
+        if steam_ids:
+            players = Player.query.filter(Player.steam_id.in_(steam_ids)).all()
+        match_teams = []
+        for player in players:
+            if player.steam_id in self.team_a:
+                team = CsgoMatch.TEAM_A
+            else:
+                team = CsgoMatch.TEAM_B
+            match_teams.append(dict(player_id=player.id, team=team))
+        content_hash = self._content_hash(match_teams)
+        player_ids = [player.id for player in players]
+        existing = CsgoMatch.query.filter_by(
+            server_id=self.server.id, start_time=self.match.start_time
+        ).first()
+        if existing:
+            if existing.content_hash == content_hash and not self.force:
+                if self.verbose:
+                    print u'goonpugd: match %d is unchanged' % existing.id
+                self._reset_match()
+                return
+            # the stats of anyone who was dropped from the match change too
+            player_ids.extend(player_id for (player_id,) in db.session.query(
+                match_players.c.player_id
+            ).filter(match_players.c.match_id == existing.id))
+            db.session.expunge(existing)
+            CsgoMatch._delete_matches([existing.id])
+        self._store_match(content_hash, match_teams)
+        if self.summaryq is None:
+            PlayerOverallStatsSummary._refresh_stats(player_ids)
+            PlayerProfile._refresh_profiles(player_ids)
+        else:
+            self.summaryq.put(player_ids)
+        generation.bump()
+        if self.verbose:
+            print u'goonpugd: connection pool %s' % pool_status()
+        self._reset_match()
+
+    def _reset_match(self):
+        live.clear(self.server_address)
         self.team_a = None
         self.team_b = None
         self.match = None
         self.round = None
+        self.match_rounds = []
 
-    def _commit_round(self):
-        db.session.add(self.round)
-        db.session.commit()
-        for player in self.players.values():
-            steam_id = player.steam_id.id64()
-            db_player = Player.query.filter_by(steam_id=steam_id).first()
-            if steam_id in self.team_a or steam_id in self.team_b:
-                player_round = PlayerRound()
-                player_round.player_id = db_player.id
-                player_round.round_id = self.round.id
-                player_round.dead = not player.alive
-                player_round.assists = player.assists
-                player_round.damage = player.damage
-                player_round.bomb_planted = player.bomb_planted
-                player_round.bomb_defused = player.bomb_defused
-                player_round.won_1v = player.won_1v
-                player_round.dropped = player.dropped
-                player_round.rws = player.rws
-                if steam_id in self.team_a:
-                    player_round.team = CsgoMatch.TEAM_A
-                elif steam_id in self.team_b:
-                    player_round.team = CsgoMatch.TEAM_B
-                db.session.add(player_round)
-        for frag in self.round_frags:
-            frag.round_id = self.round.id
-            db.session.add(frag)
-        for attack in self.round_attacks:
-            attack.round_id = self.round.id
-            db.session.add(attack)
+    def _content_hash(self, match_teams):
+        """Return a hash of everything that would be stored for the match"""
+        digest = hashlib.sha1()
+        digest.update(repr((self.match.type, self.match.map,
+                            self.match.start_time, self.match.end_time)))
+        digest.update(repr(sorted(sorted(row.items()) for row in match_teams)))
+        for (round_row, player_rounds, frags, attacks) in self.match_rounds:
+            digest.update(repr(sorted(round_row.items())))
+            for rows in (player_rounds, frags, attacks):
+                for row in rows:
+                    digest.update(repr(sorted(row.items())))
+        return digest.hexdigest()
+
+    def _store_match(self, content_hash, match_teams):
+        """Write the buffered match in a single transaction"""
+        result = db.session.execute(CsgoMatch.__table__.insert(), dict(
+            type=self.match.type,
+            server_id=self.match.server_id,
+            start_time=self.match.start_time,
+            end_time=self.match.end_time,
+            map=self.match.map,
+            content_hash=content_hash,
+        ))
+        match_id = result.inserted_primary_key[0]
+        all_player_rounds = []
+        all_frags = []
+        all_attacks = []
+        for (round_row, player_rounds, frags, attacks) in self.match_rounds:
+            round_row = dict(round_row, match_id=match_id)
+            result = db.session.execute(Round.__table__.insert(), round_row)
+            round_id = result.inserted_primary_key[0]
+            for (rows, all_rows) in ((player_rounds, all_player_rounds),
+                                     (frags, all_frags),
+                                     (attacks, all_attacks)):
+                for row in rows:
+                    all_rows.append(dict(row, round_id=round_id))
+        for (table, rows) in (
+                (PlayerRound.__table__, all_player_rounds),
+                (Frag.__table__, all_frags),
+                (Attack.__table__, all_attacks),
+                (match_players, [dict(row, match_id=match_id)
+                                 for row in match_teams])):
+            if rows:
+                db.session.execute(table.insert(), rows)
+        dimensions = self._new_dimensions(all_frags)
+        StatsDimension._add(dimensions)
         db.session.commit()
+        self.dimensions |= dimensions
+
+    def _new_dimensions(self, frags):
+        """Return the match's map and weapon names not yet in the menus"""
+        if self.dimensions is None:
+            self.dimensions = set(tuple(row) for row in db.session.query(
+                StatsDimension.kind, StatsDimension.value))
+        dimensions = set((StatsDimension.KIND_WEAPON, frag['weapon'])
+                         for frag in frags if frag['weapon'] is not None)
+        if self.match.map is not None:
+            dimensions.add((StatsDimension.KIND_MAP, self.match.map))
+        return dimensions - self.dimensions
+
+    def _commit_round(self):
+        """Add the current round to the buffered match"""
+        player_rounds = []
+        for player in self.players:
+            if player.match_team is not None:
+                player_rounds.append(dict(
+                    player_id=self._player_id(player),
+                    dead=not player.alive,
+                    assists=player.assists,
+                    damage=player.damage,
+                    bomb_planted=player.bomb_planted,
+                    bomb_defused=player.bomb_defused,
+                    won_1v=player.won_1v,
+                    dropped=player.dropped,
+                    rws=player.rws,
+                    team=player.match_team,
+                ))
+        round_row = dict(period=self.round.period,
+                         winning_team=self.round.winning_team)
+        self.match_rounds.append((round_row, player_rounds, self.round_frags,
+                                  self.round_attacks))
         self.round = None
         self.round_frags = []
         self.round_attacks = []
 
+    def _live_snapshot(self):
+        """Return the state of the match in progress
+
+        Team scores and player totals include the current round, and are
+        worked out from the buffered rounds so that no database queries
+        are needed.
+        """
+        rounds = [(round_row['winning_team'], player_rounds, frags)
+                  for (round_row, player_rounds, frags, _)
+                  in self.match_rounds]
+        if self.round:
+            player_rounds = []
+            for player in self.players:
+                if player.match_team is not None \
+                        and player.player_id is not None:
+                    player_rounds.append(dict(
+                        player_id=player.player_id, assists=player.assists,
+                        damage=player.damage, rws=player.rws))
+            rounds.append((self.round.winning_team, player_rounds,
+                           self.round_frags))
+        score = {CsgoMatch.TEAM_A: 0, CsgoMatch.TEAM_B: 0}
+        totals = {}
+        for (winning_team, player_rounds, frags) in rounds:
+            if winning_team in score:
+                score[winning_team] += 1
+            for row in player_rounds:
+                total = totals.setdefault(row['player_id'], dict(
+                    rounds=0, frags=0, deaths=0, assists=0, damage=0,
+                    rws=0.0))
+                total['rounds'] += 1
+                total['assists'] += row['assists']
+                total['damage'] += row['damage']
+                total['rws'] += row['rws']
+            for frag in frags:
+                if frag['fragger'] in totals and not frag['tk']:
+                    totals[frag['fragger']]['frags'] += 1
+                if frag['victim'] in totals:
+                    totals[frag['victim']]['deaths'] += 1
+        players = []
+        for player in self.players:
+            if player.match_team is None:
+                continue
+            total = totals.get(player.player_id, dict(
+                rounds=0, frags=0, deaths=0, assists=0, damage=0, rws=0.0))
+            rounds_played = total['rounds'] or 1
+            players.append(dict(
+                # as a string, javascript can't hold 64-bit integers
+                steam_id=str(player.id64),
+                name=player.name,
+                team=player.match_team,
+                side=player.team,
+                alive=player.alive,
+                dropped=player.dropped,
+                frags=total['frags'],
+                deaths=total['deaths'],
+                assists=total['assists'],
+                adr=total['damage'] / rounds_played,
+                rws=total['rws'] / rounds_played,
+            ))
+        return dict(
+            map=self.match.map,
+            start_time=self.match.start_time.isoformat(),
+            round=len(rounds),
+            score={'a': score[CsgoMatch.TEAM_A],
+                   'b': score[CsgoMatch.TEAM_B]},
+            players=players,
+        )
+
+    def _publish_live(self):
+        """Publish the state of the match in progress for spectators"""
+        if not live.enabled():
+            return
+        live.publish(self.server_address, self._live_snapshot())
+        self.live_published = time.time()
+
+    def _player_id(self, player):
+        """Return the database id for a GoonPugPlayer"""
+        if player.player_id is None:
+            db_player = Player.query.filter_by(steam_id=player.id64).first()
+            player.player_id = db_player.id
+        return player.player_id
+
+    def _join_team(self, player, team):
+        """Put a player on one of the match teams"""
+        if team == CsgoMatch.TEAM_A:
+            self.team_a.add(player.id64)
+            self.team_b.discard(player.id64)
+        else:
+            self.team_b.add(player.id64)
+            self.team_a.discard(player.id64)
+        player.match_team = team
+
     def _start_round(self):
         if self.round:
             self._commit_round()
-        for player in self.players.values():
-            # count drops and spectators as alive since we don't want to record
-            # them as dead at the end of a round
-            player.alive = True
-            player.health = 100
-            player.damage = 0
-            player.assists = 0
-            player.rws = 0.0
-            player.bomb_defused = False
-            player.bomb_planted = False
-            player.won_1v = 0
+        self.players.reset_round()
         self.round = Round()
-        self.round.match_id = self.match.id
         self.round.period = self.period
         self.round_frags = []
         self.round_attacks = []
+        self._publish_live()
 
     def _end_round(self, event):
         rounds_played = self.t_score + self.ct_score
@@ -251,18 +788,10 @@ class GoonPugParser(object):
         else:
             raise ValueError(u'Unknown team: %s' % winning_team)
         team_damage = 0
-        team_players = []
-        for player in self.players.values():
-            if player.dropped:
-                player.won_1v = 0
-                player.rws = 0.0
+        for player in self.players:
             if not player.dropped and \
-                    ((self.round.winning_team == CsgoMatch.TEAM_A
-                      and player.steam_id.id64() in self.team_a)
-                        or (self.round.winning_team == CsgoMatch.TEAM_B
-                            and player.steam_id.id64() in self.team_b)):
+                    player.match_team == self.round.winning_team:
                 team_damage += player.damage
-                team_players.append(player)
             else:
                 player.won_1v = 0
                 player.rws = 0.0
@@ -270,25 +799,24 @@ class GoonPugParser(object):
             multi = 70.0
         else:
             multi = 100.0
-        for player in self.players.values():
-            if player.team == winning_team:
-                try:
-                    player.rws = multi * (player.damage / team_damage)
-                except ZeroDivisionError:
-                    player.rws = 0.0
-                if defused and player.bomb_defused:
-                    player.rws += 30.0
-                if exploded and player.bomb_planted:
-                    player.rws += 30.0
+        for player in self.players.sides[winning_team]:
+            try:
+                player.rws = multi * (player.damage / team_damage)
+            except ZeroDivisionError:
+                player.rws = 0.0
+            if defused and player.bomb_defused:
+                player.rws += 30.0
+            if exploded and player.bomb_planted:
+                player.rws += 30.0
 
     def handle_log_file(self, event):
-        self.players = {}
+        self.players = PlayerRoster()
         if event.closed and self.match:
             # something bad happened, like a server restart mid match
             self._abandon_match()
 
     def handle_change_map(self, event):
-        self.players = {}
+        self.players = PlayerRoster()
         if self.verbose:
             print unicode(event)
         if event.started:
@@ -301,40 +829,37 @@ class GoonPugParser(object):
         if self.verbose:
             print unicode(event)
         steam_id = event.player.steam_id.id64()
-        Player.get_or_create(steam_id, nickname=event.player.name)
+        player = Player.get_or_create(steam_id, nickname=event.player.name)
         db.session.commit()
+        if steam_id in self.players:
+            self.players[steam_id].player_id = player.id
 
     def _check_1v(self):
         if not self.round:
             return
-        live_ts = []
-        live_cts = []
-        for player in self.players.values():
-            if player.team == u'TERRORIST' and player.alive and \
-               not player.dropped:
-                live_ts.append(player)
-            elif player.team == u'CT' and player.alive and not player.dropped:
-                live_cts.append(player)
-        if len(live_ts) == 1 and live_ts[0].won_1v == 0:
-            live_ts[0].won_1v = len(live_cts)
-        elif len(live_cts) == 1 and live_cts[0].won_1v == 0:
-            live_cts[0].won_1v = len(live_ts)
+        live_ts = self.players.live[u'TERRORIST']
+        live_cts = self.players.live[u'CT']
+        if len(live_ts) == 1:
+            (player,) = live_ts
+            if player.won_1v == 0:
+                player.won_1v = len(live_cts)
+                return
+        if len(live_cts) == 1:
+            (player,) = live_cts
+            if player.won_1v == 0:
+                player.won_1v = len(live_ts)
 
     def handle_suicide(self, event):
         if not self.round:
             return
         if self.verbose:
             print unicode(event)
-        steam_id = event.player.steam_id.id64()
-        self.players[steam_id].alive = False
-        player = Player.query.filter_by(steam_id=steam_id).first()
-        frag = Frag()
-        frag.fragger = player.id
-        frag.victim = player.id
-        frag.weapon = event.weapon
-        frag.headshot = False
-        frag.tk = True
-        self.round_frags.append(frag)
+        player = self.players[event.player.steam_id.id64()]
+        self.players.kill(player)
+        player_id = self._player_id(player)
+        self.round_frags.append(dict(fragger=player_id, victim=player_id,
+                                     weapon=event.weapon, headshot=False,
+                                     tk=True))
         self._check_1v()
 
     def handle_disconnection(self, event):
@@ -383,6 +908,7 @@ class GoonPugParser(object):
         elif event.action == u'Round_End':
             if self.match:
                 self._end_round(event)
+                self._publish_live()
 
     def handle_goonpug_action(self, event):
         if self.verbose:
@@ -410,102 +936,366 @@ class GoonPugParser(object):
             return
         if self.verbose:
             print unicode(event)
-        steam_id = event.player.steam_id.id64()
-        target_id = event.target.steam_id.id64()
-        self.players[target_id].alive = False
-        fragger = Player.query.filter_by(steam_id=steam_id).first()
-        victim = Player.query.filter_by(steam_id=target_id).first()
-        frag = Frag()
-        frag.fragger = fragger.id
-        frag.victim = victim.id
-        frag.weapon = event.weapon
-        frag.headshot = event.headshot
-        if event.player.team == event.target.team:
-            frag.tk = True
-        self.round_frags.append(frag)
+        fragger = self.players[event.player_id64]
+        victim = self.players[event.target_id64]
+        self.players.kill(victim)
+        self.round_frags.append(dict(
+            fragger=self._player_id(fragger),
+            victim=self._player_id(victim),
+            weapon=event.weapon,
+            headshot=event.headshot,
+            tk=event.player_team == event.target_team,
+        ))
         self._check_1v()
+        if time.time() - self.live_published >= LIVE_PUBLISH_INTERVAL:
+            self._publish_live()
 
     def handle_attack(self, event):
         if not self.round:
             return
         if self.verbose:
             print unicode(event)
-        steam_id = event.player.steam_id.id64()
-        target_id = event.target.steam_id.id64()
+        attacker = self.players[event.player_id64]
+        target = self.players[event.target_id64]
         # RWS doesn't care about ff damage
-        if event.player.team != event.target.team:
+        if event.player_team != event.target_team:
             if event.health > 0:
                 # target still has health remaining
-                self.players[steam_id].damage += event.damage
+                attacker.damage += event.damage
             else:
                 # target is dead, we have to adjust for overkill damage
-                self.players[steam_id].damage += self.players[target_id].health
-        self.players[target_id].health = event.health
-        attacker = Player.query.filter_by(steam_id=steam_id).first()
-        target = Player.query.filter_by(steam_id=target_id).first()
-        attack = Attack()
-        attack.attacker = attacker.id
-        attack.target = target.id
-        attack.weapon = event.weapon
-        attack.hitgroup = event.hitgroup
-        attack.damage = event.damage
-        attack.damage_armor = event.damage_armor
-        if event.player.team == event.target.team:
-            attack.ff = True
-        self.round_attacks.append(attack)
+                attacker.damage += target.health
+        target.health = event.health
+        self.round_attacks.append(dict(
+            attacker=self._player_id(attacker),
+            target=self._player_id(target),
+            weapon=event.weapon,
+            hitgroup=event.hitgroup,
+            damage=event.damage,
+            damage_armor=event.damage_armor,
+            ff=event.player_team == event.target_team,
+        ))
 
     def handle_assist(self, event):
         if not self.round:
             return
         if self.verbose:
             print unicode(event)
-        steam_id = event.player.steam_id.id64()
-        self.players[steam_id].assists += 1
+        self.players[event.player_id64].assists += 1
 
     def handle_switch_team(self, event):
         if self.verbose:
             print unicode(event)
-        steam_id = event.player.steam_id.id64()
-        #player = db.session.query(Player).filter_by(steam_id=steam_id).first()
-        if not steam_id in self.players:
-            self.players[steam_id] = GoonPugPlayer(event.player.name,
-                                                   event.player.uid,
-                                                   event.player.steam_id)
-        self.players[steam_id].team = event.new_team
-        self.players[steam_id].dropped = False
+        steam_id = event.id64
+        if steam_id in self.players:
+            player = self.players[steam_id]
+        else:
+            player = self.players.add(event.player_name, event.uid, steam_id)
+            if self.match:
+                if steam_id in self.team_a:
+                    player.match_team = CsgoMatch.TEAM_A
+                elif steam_id in self.team_b:
+                    player.match_team = CsgoMatch.TEAM_B
+        self.players.update(player, team=event.new_team, dropped=False)
         if self.round:
-            self.players[steam_id].alive = True
-            self.players[steam_id].health = 100
-            self.players[steam_id].damage = 0
-            self.players[steam_id].assists = 0
-            self.players[steam_id].rws = 0.0
-            self.players[steam_id].bomb_defused = False
-            self.players[steam_id].bomb_planted = False
-            self.players[steam_id].won_1v = 0
+            self.players.reset_round(player)
         if self.match:
             if event.new_team == u'Unassigned' \
                     and event.orig_team in [u'CT', u'TERRORIST']:
-                self.players[steam_id].dropped = True
-                self.players[steam_id].alive = False
+                self.players.update(player, dropped=True, alive=False)
                 self._check_1v()
-            elif steam_id not in self.team_a and steam_id not in self.team_b:
+            elif player.match_team is None:
                 if (self.period % 2) == 1:
                     if event.new_team == u'TERRORIST':
-                        self.team_a.add(steam_id)
-                        self.team_b.discard(steam_id)
+                        self._join_team(player, CsgoMatch.TEAM_A)
                     elif event.new_team == u'CT':
-                        self.team_b.add(steam_id)
-                        self.team_a.discard(steam_id)
+                        self._join_team(player, CsgoMatch.TEAM_B)
                 else:
                     if event.new_team == u'TERRORIST':
-                        self.team_b.add(steam_id)
-                        self.team_a.discard(steam_id)
+                        self._join_team(player, CsgoMatch.TEAM_B)
                     elif event.new_team == u'CT':
-                        self.team_a.add(steam_id)
-                        self.team_b.discard(steam_id)
+                        self._join_team(player, CsgoMatch.TEAM_A)
         else:
             if event.new_team == u'Unassigned':
-                del self.players[steam_id]
+                self.players.remove(steam_id)
+
+
+class LogFollower(object):
+
+    """Follow the srcds log files written to a directory
+
+    Lines are handled in this process as soon as they are written, and the
+    position reached is saved to a JSON checkpoint file after every read.
+    Log files are read in name order, which for srcds is the order they
+    were written in.
+
+    Parser state (the map and who is on which team) is rebuilt from the
+    start of the current map, so the checkpoint records the offset of the
+    last map or log file start line as well as how far the log has been
+    handled. On restart the lines between the two are replayed without
+    --force, so matches that were already stored are skipped as unchanged
+    and a match that was still in progress is rebuilt from its start.
+
+    Parameters:
+        parser: The GoonPugParser for this server
+        path: The log directory
+        checkpoint: The checkpoint filename
+        interval: How often to poll for new lines when inotify is not
+            available
+    """
+
+    def __init__(self, parser, path, checkpoint, interval=1.0):
+        self.parser = parser
+        self.path = path
+        self.checkpoint = checkpoint
+        self.watcher = DirectoryWatcher(path, interval)
+        self.filename = None
+        self.anchor = 0
+        self.done = 0
+        if os.path.isfile(checkpoint):
+            with open(checkpoint) as fd:
+                state = json.load(fd)
+            self.filename = state['file']
+            self.anchor = state['anchor']
+            self.done = state['done']
+        self.offset = self.anchor
+        # set while skipping the rest of a line longer than BLOCK_SIZE
+        self.skipping = False
+
+    def _save_checkpoint(self):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump({'file': self.filename, 'anchor': self.anchor,
+                       'done': self.done}, fd)
+        os.rename(tmp, self.checkpoint)
+
+    def _next_file(self):
+        """Return the first log file after the current one"""
+        for filename in sorted(os.listdir(self.path)):
+            if filename.endswith('.log') and (self.filename is None
+                                              or filename > self.filename):
+                return filename
+        return None
+
+    def _open_next(self):
+        filename = self._next_file()
+        if filename is None:
+            return False
+        if self.verbose:
+            print u'goonpugd: following %s' % os.path.join(self.path,
+                                                           filename)
+        self.filename = filename
+        self.offset = self.anchor = self.done = 0
+        self.skipping = False
+        self._save_checkpoint()
+        return True
+
+    @property
+    def verbose(self):
+        return self.parser.verbose
+
+    def read(self):
+        """Handle any new complete lines in the current log file
+
+        Returns False if there was nothing new to read.
+        """
+        filename = os.path.join(self.path, self.filename)
+        if not os.path.isfile(filename):
+            return False
+        with open(filename, 'rb') as fd:
+            fd.seek(self.offset)
+            block = fd.read(BLOCK_SIZE)
+        if self.skipping:
+            eol = block.find('\n')
+        else:
+            eol = block.rfind('\n')
+        if eol < 0 and len(block) < BLOCK_SIZE:
+            return False
+        if eol < 0 and not self.skipping:
+            # no srcds line is this long, so skip it rather than wait
+            # forever for its end to fit in a block
+            if self.verbose:
+                print u'goonpugd: skipping a line longer than %d bytes ' \
+                    u'at %s:%d' % (BLOCK_SIZE, self.filename, self.offset)
+            self.skipping = True
+        if self.skipping:
+            self.skipping = eol < 0
+            self.offset += len(block) if eol < 0 else eol + 1
+            self.done = max(self.done, self.offset)
+            self._save_checkpoint()
+            return True
+        block = block[:eol + 1]
+        parser = self.parser
+        force = parser.force
+        for (pos, endpos) in line_spans(block):
+            event = parse_event(parser.event_types, block, pos, endpos)
+            if event is None:
+                continue
+            start = self.offset + pos
+            if isinstance(event, (generic_events.LogFileEvent,
+                                  generic_events.ChangeMapEvent)):
+                self.anchor = start
+            parser.force = force and start >= self.done
+            try:
+                parser.event_handlers[type(event)](event)
+            finally:
+                parser.force = force
+        self.offset += eol + 1
+        self.done = max(self.done, self.offset)
+        self._save_checkpoint()
+        return True
+
+    def run(self):
+        while True:
+            if self.filename is None or not os.path.isfile(
+                    os.path.join(self.path, self.filename)):
+                if not self._open_next():
+                    self.watcher.wait()
+                continue
+            if not self.read():
+                if self._next_file() is None:
+                    self.watcher.wait()
+                    continue
+                # srcds never writes to a log file again once it has
+                # started the next one, but it may have appended its last
+                # lines since the read above
+                while self.read():
+                    pass
+                self._open_next()
+
+
+def follow(server_address, path, checkpoint_dir, verbose=False, force=False,
+           summaryq=None):
+    """Follow a server's log directory (run in a separate process)"""
+    after_fork()
+    parser = GoonPugParser(server_address, verbose=verbose, force=force,
+                           summaryq=summaryq)
+    checkpoint = os.path.join(checkpoint_dir, '%s_%d.json' % server_address)
+    LogFollower(parser, path, checkpoint).run()
+
+
+def refresh_summaries(summaryq, verbose=False):
+    """Refresh player summaries and profiles (run in a separate process)
+
+    Parsers put the player ids from each stored match on summaryq. Ids that
+    queue up while a refresh is running are merged into the next one, so
+    under load each player's summary is refreshed once per batch of matches
+    instead of once per match. The process runs at a lower priority so that
+    it never competes with the parsers. A None on the queue stops it.
+    """
+    after_fork()
+    os.nice(SUMMARY_NICE)
+    while True:
+        player_ids = summaryq.get()
+        if player_ids is None:
+            return
+        player_ids = set(player_ids)
+        stop = False
+        while True:
+            try:
+                more = summaryq.get_nowait()
+            except Empty:
+                break
+            if more is None:
+                stop = True
+                break
+            player_ids.update(more)
+        if verbose:
+            print u'goonpugd: refreshing %d player summaries' % len(
+                player_ids)
+        PlayerOverallStatsSummary._refresh_stats(player_ids)
+        PlayerProfile._refresh_profiles(player_ids)
+        generation.bump()
+        if stop:
+            return
+
+
+class FairScheduler(object):
+
+    """Hand log lines from many servers to their parsers in turn
+
+    Every server gets its own bounded queue of pending lines, and the
+    dispatcher thread (run()) moves up to batch lines at a time from each
+    server with pending lines to that server's parser, round-robin. A
+    server whose parser has fallen behind (its event queue is full) is
+    skipped until the parser catches up instead of holding up everyone
+    else, and a server that floods the daemon can only fill its own queue.
+    UDP log senders can't be slowed down, so once a server's queue is full
+    its new lines are dropped and counted.
+
+    Parameters:
+        maxlen: The maximum number of pending lines per server
+        batch: The maximum number of lines dispatched to a server per turn
+    """
+
+    def __init__(self, maxlen=SERVER_QUEUE_SIZE, batch=DISPATCH_BATCH):
+        self.maxlen = maxlen
+        self.batch = batch
+        self.servers = OrderedDict()
+        self.dropped = {}
+        self.ready = threading.Condition()
+
+    def register(self, address, parser):
+        with self.ready:
+            self.servers[address] = (parser, deque())
+            self.dropped[address] = 0
+
+    def put(self, address, line):
+        """Queue a line from a server
+
+        Returns False if the line was dropped because the server's queue is
+        full.
+        """
+        with self.ready:
+            lines = self.servers[address][1]
+            if len(lines) >= self.maxlen:
+                self.dropped[address] += 1
+                dropped = self.dropped[address]
+                if dropped == 1 or dropped % 1000 == 0:
+                    print u'goonpugd: %s:%d is falling behind, dropped %d ' \
+                        u'lines' % (address[0], address[1], dropped)
+                return False
+            lines.append(line)
+            self.ready.notify()
+        return True
+
+    def _dispatch(self, parser, lines):
+        """Hand up to batch lines to a parser
+
+        Returns False if the parser's event queue is full.
+        """
+        if parser.eventq.full():
+            return False
+        for _ in xrange(self.batch):
+            with self.ready:
+                if not lines:
+                    return True
+                line = lines.popleft()
+            event = parse_event(parser.event_types, line)
+            if event is None:
+                continue
+            try:
+                parser.eventq.put_nowait(event)
+            except Full:
+                with self.ready:
+                    lines.appendleft(line)
+                return False
+        return True
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not any(lines for (_, lines) in self.servers.values()):
+                    self.ready.wait()
+                servers = self.servers.values()
+            blocked = True
+            for (parser, lines) in servers:
+                if lines and self._dispatch(parser, lines):
+                    blocked = False
+            if blocked:
+                # every server with pending lines is waiting on its parser
+                with self.ready:
+                    self.ready.wait(0.05)
 
 
 log_parsers = {}
@@ -515,6 +1305,8 @@ class GoonPugLogHandler(SocketServer.DatagramRequestHandler):
 
     verbose = False
     force = False
+    scheduler = None
+    summaryq = None
 
     def handle(self):
         data = self.request[0]
@@ -528,12 +1320,14 @@ class GoonPugLogHandler(SocketServer.DatagramRequestHandler):
             print u'Got new connection from {}'.format(self.client_address[0])
             parser = GoonPugParser(self.client_address,
                                    verbose=GoonPugLogHandler.verbose,
-                                   force=GoonPugLogHandler.force)
+                                   force=GoonPugLogHandler.force,
+                                   summaryq=GoonPugLogHandler.summaryq)
             process = multiprocessing.Process(target=parser.process_events)
             log_parsers[self.client_address] = (process, parser)
             process.daemon = True
             process.start()
-        log_parsers[self.client_address][1].parse_line(data)
+            GoonPugLogHandler.scheduler.register(self.client_address, parser)
+        GoonPugLogHandler.scheduler.put(self.client_address, data)
 
 
 class GoonPugDaemon(Daemon):
@@ -544,12 +1338,21 @@ class GoonPugDaemon(Daemon):
                                             stderr=stderr)
         GoonPugLogHandler.verbose = verbose
         GoonPugLogHandler.force = force
+        self.verbose = verbose
         self.port = port
         self.server = SocketServer.UDPServer(('0.0.0.0', self.port),
                                              GoonPugLogHandler)
         self.server.timeout = 30
 
     def run(self):
+        # started here rather than in __init__ so that they belong to the
+        # daemonized process
+        GoonPugLogHandler.summaryq = start_summary_process(self.verbose)
+        GoonPugLogHandler.scheduler = FairScheduler()
+        dispatcher = threading.Thread(
+            target=GoonPugLogHandler.scheduler.run)
+        dispatcher.daemon = True
+        dispatcher.start()
         print u"goonpugd: Listening for HL log connections on %s:%d" % (
             self.server.server_address)
         self.server.serve_forever()
@@ -564,6 +1367,16 @@ class GoonPugDaemon(Daemon):
             del log_parsers[server]
 
 
+def start_summary_process(verbose=False):
+    """Start the background summary refresh process and return its queue"""
+    summaryq = multiprocessing.Queue()
+    process = multiprocessing.Process(target=refresh_summaries,
+                                      args=(summaryq, verbose))
+    process.daemon = True
+    process.start()
+    return summaryq
+
+
 def main():
     parser = argparse.ArgumentParser(description='GoonPUG logparser')
     parser.add_argument('-p', '--port', dest='port', action='store', type=int,
@@ -582,31 +1395,73 @@ def main():
     parser.add_argument('-f', '--force', action='store_true', dest='force',
                         help='forces overwriting of any matches that already '
                              'exist in the database')
+    parser.add_argument('--follow', action='append', dest='follow',
+                        metavar='IP:PORT=DIR', default=[],
+                        help='follow the log files written to DIR by the '
+                             'server at IP:PORT instead of listening on a '
+                             'network port (may be given more than once)')
+    parser.add_argument('--checkpoint-dir', action='store',
+                        dest='checkpoint_dir',
+                        default='/tmp/goonpugd-checkpoints',
+                        help='directory for --follow checkpoint files')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='number of processes used to parse log lines '
+                             '(used with -s, default 1; check that more '
+                             'help with benchmarks/parse_jobs.py first)')
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help='verbose output')
     args = parser.parse_args()
+    create_app(web=False)
     verbose = args.verbose
     force = args.force
-    if args.stdin:
+    if args.follow:
+        if not os.path.isdir(args.checkpoint_dir):
+            os.makedirs(args.checkpoint_dir)
+        summaryq = start_summary_process(verbose)
+        processes = []
+        for spec in args.follow:
+            try:
+                (address, path) = spec.split('=', 1)
+                (host, port) = address.split(':', 1)
+                port = int(port)
+            except ValueError:
+                parser.error('Invalid --follow argument: %s' % spec)
+            if not os.path.isdir(path):
+                parser.error('No such log directory: %s' % path)
+            print u'goonpugd: Following %s for %s:%d' % (path, host, port)
+            process = multiprocessing.Process(
+                target=follow, args=((host, port), path, args.checkpoint_dir,
+                                     verbose, force, summaryq))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            sys.exit()
+    elif args.stdin:
         if not args.server_address:
             parser.error('No server address specified')
         (host, port) = args.server_address.split(':', 1)
         port = int(port)
-        log_parser = GoonPugParser((host, port), verbose=verbose, force=force)
+        log_parser = GoonPugParser((host, port), verbose=verbose, force=force,
+                                   summaryq=start_summary_process(verbose))
         print "goonpugd: Reading from STDIN"
         process = multiprocessing.Process(target=log_parser.process_events)
         process.daemon = True
         process.start()
         while True:
             try:
-                for line in sys.stdin.readlines():
-                    log_parser.parse_line(line)
+                log_parser.parse_blocks(iter_blocks(sys.stdin),
+                                        jobs=args.jobs)
             except KeyboardInterrupt:
                 sys.exit()
             except EOFError:
                 sys.exit()
     else:
-        daemon = GoonPugDaemon(args.pidfile, port=args.port)
+        daemon = GoonPugDaemon(args.pidfile, port=args.port, verbose=verbose,
+                               force=force)
         if not args.daemon:
             try:
                 print "goonpugd: Running in foreground"
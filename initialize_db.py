@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
-from goonpug import db
+from goonpug import create_app, db
 from goonpug.models import Player
 
 
+create_app(web=False)
 db.create_all()
 bot = Player.get_or_create(0, u'Bot')
 bot.nickname = u'Bot'
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Rebuild the player stats summary table and the stats menus
+
+Summaries are computed in chunks of players into a shadow table, which is
+swapped in for the live summary table once every player has been written.
+An interrupted rebuild can be resumed, since chunks that were already
+written to the shadow table are skipped.
+
+goonpugd keeps refreshing the live table while a rebuild runs. The highest
+match ID when the rebuild started is kept in a marker file, and before the
+swap the players of every match stored since then are rebuilt again (and
+refreshed once more after the swap for matches stored in between), so no
+refresh is lost. Every player profile document, which embeds the player's
+summary, is rebuilt after the swap.
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from goonpug import create_app, db, generation
+from goonpug.pool import after_fork
+from goonpug.models import Player, PlayerOverallStatsSummary, \
+    PlayerProfile, StatsDimension, CsgoMatch, match_players
+
+
+SHADOW_SUFFIX = '_rebuild'
+OLD_SUFFIX = '_old'
+
+
+def shadow_table():
+    """Return a copy of the summary table under the shadow name
+
+    Columns are copied along with their foreign keys, nullability and
+    index flags, so the table that is swapped in keeps the live table's
+    constraints and indexes.
+    """
+    summary = PlayerOverallStatsSummary.__table__
+    metadata = db.MetaData()
+    # the foreign keys need the tables they refer to
+    for foreign_key in summary.foreign_keys:
+        foreign_key.column.table.tometadata(metadata)
+    columns = [column.copy() for column in summary.columns]
+    # Column.copy() leaves out foreign keys
+    foreign_keys = [db.ForeignKeyConstraint(
+        [element.parent.name for element in constraint.elements],
+        [element.target_fullname for element in constraint.elements],
+        onupdate=constraint.onupdate, ondelete=constraint.ondelete)
+        for constraint in summary.constraints
+        if isinstance(constraint, db.ForeignKeyConstraint)]
+    return db.Table(summary.name + SHADOW_SUFFIX, metadata,
+                    *(columns + foreign_keys))
+
+
+def blank_row(table, player_id):
+    row = {}
+    for column in table.columns:
+        if column.default is not None:
+            row[column.name] = column.default.arg
+        else:
+            row[column.name] = None
+    row['player_id'] = player_id
+    return row
+
+
+def rebuild_chunk(player_ids):
+    """Write the summaries for a chunk of players to the shadow table"""
+    table = shadow_table()
+    rows = dict((row['player_id'], row) for row in
+                PlayerOverallStatsSummary._summary_rows(player_ids))
+    values = []
+    for player_id in player_ids:
+        values.append(rows.get(player_id, blank_row(table, player_id)))
+    db.session.execute(table.insert(), values)
+    db.session.commit()
+    db.session.remove()
+    return len(values)
+
+
+def latest_match_id():
+    return db.session.query(db.func.max(CsgoMatch.id)).scalar() or 0
+
+
+def players_since(match_id):
+    """Return the players of every match stored after match_id"""
+    query = db.session.query(match_players.c.player_id).filter(
+        match_players.c.match_id > match_id).distinct()
+    return sorted(player_id for (player_id,) in query
+                  if player_id is not None)
+
+
+def catch_up(table, marker, chunk_size):
+    """Rebuild the players of matches stored since marker was taken
+
+    Repeats until no new matches turn up, and returns the new marker.
+    """
+    while True:
+        latest = latest_match_id()
+        player_ids = players_since(marker)
+        if not player_ids:
+            return marker
+        print 'Rebuilding %d players from newer matches' % len(player_ids)
+        for i in range(0, len(player_ids), chunk_size):
+            chunk = player_ids[i:i + chunk_size]
+            db.session.execute(table.delete().where(
+                table.c.player_id.in_(chunk)))
+            db.session.commit()
+            rebuild_chunk(chunk)
+        marker = latest
+
+
+def swap_tables(table):
+    """Atomically replace the summary table with the rebuilt table"""
+    live = PlayerOverallStatsSummary.__table__.name
+    old = live + OLD_SUFFIX
+    engine = db.engine
+    if engine.dialect.name == 'mysql':
+        engine.execute('DROP TABLE IF EXISTS %s' % old)
+        engine.execute('RENAME TABLE %s TO %s, %s TO %s'
+                       % (live, old, table.name, live))
+    else:
+        # DDL is transactional everywhere else we run
+        with engine.begin() as conn:
+            conn.execute('DROP TABLE IF EXISTS %s' % old)
+            conn.execute('ALTER TABLE %s RENAME TO %s' % (live, old))
+            conn.execute('ALTER TABLE %s RENAME TO %s' % (table.name, live))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild the GoonPUG player stats summaries')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=200, help='number of players per chunk')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--restart', action='store_true',
+                        help='discard any partially rebuilt table and start '
+                             'over')
+    parser.add_argument('--keep-old', action='store_true', dest='keep_old',
+                        help='keep the previous summary table after the '
+                             'swap')
+    parser.add_argument('--no-swap', action='store_true', dest='no_swap',
+                        help='build the shadow table but do not swap it in')
+    parser.add_argument('--marker-file', dest='marker_file',
+                        default='/tmp/goonpug-rebuild_stats.json',
+                        help='file recording the latest match when the '
+                             'rebuild started')
+    args = parser.parse_args()
+    create_app(web=False)
+
+    table = shadow_table()
+    if args.restart:
+        table.drop(db.engine, checkfirst=True)
+        if os.path.isfile(args.marker_file):
+            os.remove(args.marker_file)
+    table.create(db.engine, checkfirst=True)
+
+    done = set(player_id for (player_id,) in
+               db.session.query(table.c.player_id))
+    if os.path.isfile(args.marker_file):
+        with open(args.marker_file) as fd:
+            marker = json.load(fd)['match_id']
+    else:
+        if done:
+            print 'No marker file, summaries refreshed by goonpugd before ' \
+                'this run may be lost (use --restart to avoid this)'
+        marker = latest_match_id()
+        with open(args.marker_file, 'w') as fd:
+            json.dump({'match_id': marker}, fd)
+    pending = sorted(player_id for (player_id,) in db.session.query(Player.id)
+                     if player_id not in done)
+    chunks = [pending[i:i + args.chunk_size]
+              for i in range(0, len(pending), args.chunk_size)]
+    total = len(done) + len(pending)
+    if done:
+        print 'Resuming rebuild, %d of %d players already done' % (
+            len(done), total)
+
+    db.session.remove()
+
+    count = len(done)
+    start = time.time()
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=after_fork)
+        results = pool.imap_unordered(rebuild_chunk, chunks)
+    else:
+        pool = None
+        results = (rebuild_chunk(chunk) for chunk in chunks)
+    try:
+        for written in results:
+            count += written
+            elapsed = time.time() - start
+            sys.stdout.write('\r%d/%d players (%.1f/s)' % (
+                count, total, (count - len(done)) / max(elapsed, 0.001)))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+        print '\nInterrupted, run again to resume'
+        sys.exit(1)
+    if pool:
+        pool.close()
+        pool.join()
+    print
+
+    if args.no_swap:
+        print 'Rebuilt summaries left in %s' % table.name
+        return
+    marker = catch_up(table, marker, args.chunk_size)
+    swap_tables(table)
+    # goonpugd may have refreshed the old table since the last catch up
+    PlayerOverallStatsSummary._refresh_stats(players_since(marker))
+    os.remove(args.marker_file)
+    if not args.keep_old:
+        db.engine.execute('DROP TABLE %s'
+                          % (PlayerOverallStatsSummary.__table__.name
+                             + OLD_SUFFIX))
+    print 'Swapped in rebuilt summaries for %d players' % count
+    StatsDimension._rebuild()
+    print 'Rebuilt the map and weapon lists'
+    # profile documents embed the summaries, so they are stale until rebuilt
+    PlayerProfile._update_all_profiles(args.chunk_size)
+    print 'Rebuilt player profiles'
+    generation.bump()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,11 @@
 
 from __future__ import absolute_import
 
-from goonpug import app
+from goonpug import create_app
 
 
 def main():
+    app = create_app()
     app.run(debug=True)
 
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Serve the GoonPUG web frontend in production
+
+The app is served by gunicorn with SERVER_WORKERS pre-forked worker
+processes of SERVER_THREADS threads each. It is created once in the master
+process before the workers are forked, so workers start instantly and
+share the master's imported code. Set CACHE_DIR to share cached pages
+between the workers as well.
+
+Long-polls and event streams from /api/live hold on to a worker thread
+while they wait, so they are only enabled with threaded workers, which
+need the futures package.
+"""
+
+from __future__ import absolute_import
+import sys
+import argparse
+import multiprocessing
+
+from goonpug import create_app
+from goonpug.pool import after_fork
+
+
+def run_gunicorn(app, options):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for (key, value) in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the GoonPUG web frontend')
+    parser.add_argument('-b', '--bind', action='store',
+                        help='address to listen on (default: SERVER_BIND)')
+    parser.add_argument('-w', '--workers', action='store', type=int,
+                        help='number of worker processes (default: '
+                             'SERVER_WORKERS)')
+    parser.add_argument('-t', '--threads', action='store', type=int,
+                        help='number of threads per worker (default: '
+                             'SERVER_THREADS)')
+    args = parser.parse_args()
+
+    app = create_app()
+    config = app.config
+    bind = args.bind or config['SERVER_BIND']
+    workers = args.workers or config['SERVER_WORKERS'] or \
+        multiprocessing.cpu_count() * 2 + 1
+    threads = args.threads or config['SERVER_THREADS']
+    try:
+        import gunicorn
+    except ImportError:
+        print >>sys.stderr, 'serve.py: gunicorn is not installed (see ' \
+            'requirements.txt), use run.py for development'
+        sys.exit(1)
+    worker_class = 'sync'
+    if threads > 1:
+        try:
+            # gunicorn's threaded workers need the futures backport
+            import concurrent.futures
+            worker_class = 'gthread'
+        except ImportError:
+            print >>sys.stderr, 'serve.py: futures is not installed, ' \
+                'using single threaded workers'
+            threads = 1
+    # waiting /api/live requests tie up a thread each, always leave one
+    # for everything else
+    config['LIVE_MAX_WAITERS'] = min(config['LIVE_MAX_WAITERS'], threads - 1)
+    if not config['LIVE_MAX_WAITERS']:
+        print >>sys.stderr, 'serve.py: single threaded workers, /api/live ' \
+            'long-polls and event streams are disabled'
+    run_gunicorn(app, {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': worker_class,
+        'preload_app': True,
+        'post_fork': lambda server, worker: after_fork(),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+"""WSGI entry point for the GoonPUG web frontend
+
+For WSGI servers other than serve.py, e.g.::
+
+    gunicorn --preload -w 5 wsgi:application
+
+The app is created when this module is imported, so with --preload (or
+the equivalent option of other pre-forking servers) it is only built once,
+in the master process.
+"""
+
+from __future__ import absolute_import
+
+from goonpug import create_app
+
+
+application = create_app()